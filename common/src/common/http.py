@@ -0,0 +1,74 @@
+import threading
+from typing import Any
+from typing import Final
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds. The read timeout bounds each socket read, not the whole transfer, so
+# large downloads still work while a stalled upstream fails instead of hanging the run.
+DEFAULT_TIMEOUT: Final[tuple[float, float]] = (10.0, 60.0)
+# Keep-alive connections kept per host.
+DEFAULT_POOL_MAXSIZE: Final[int] = 16
+# Connection errors are retried for every method since nothing was sent yet; read errors and
+# retryable statuses only for idempotent methods.
+DEFAULT_RETRY: Final[Retry] = Retry(
+    total=3,
+    connect=3,
+    read=2,
+    status=2,
+    backoff_factor=0.5,
+    backoff_jitter=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    # Hand the last response back so callers can inspect the status or fall back themselves.
+    raise_on_status=False,
+)
+
+# Named process-wide sessions, so call sites talking to the same hosts reuse connections.
+_SESSIONS: dict[str, requests.Session] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    # `requests` has no session-wide timeout, so apply ours to every request without one.
+
+    def __init__(self, timeout: tuple[float, float], **kwargs: Any) -> None:
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(  # type: ignore[override]
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def new_session(
+    pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    timeout: tuple[float, float] = DEFAULT_TIMEOUT,
+    retry: Retry = DEFAULT_RETRY,
+) -> requests.Session:
+    session = requests.Session()
+    # Offer every content coding urllib3 can decode here, i.e., zstd and br when their optional
+    # decoders are installed, instead of the fixed `gzip, deflate` of `requests`.
+    session.headers["Accept-Encoding"] = make_headers(accept_encoding=True)["accept-encoding"]
+    adapter = _TimeoutHTTPAdapter(
+        timeout=timeout,
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+        max_retries=retry,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(name: str = "default") -> requests.Session:
+    with _SESSIONS_LOCK:
+        if (session := _SESSIONS.get(name)) is None:
+            session = _SESSIONS[name] = new_session()
+        return session
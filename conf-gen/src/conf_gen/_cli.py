@@ -3,10 +3,16 @@
 """Generate config files for various clients from a common source spec."""
 
 import os
+import sys
 from argparse import ArgumentParser
 from typing import Any
+from typing import Sequence
 
 import yaml
+from conf_gen.fetch import Lockfile
+from conf_gen.fetch import collect_remote_resources
+from conf_gen.fetch import configure
+from conf_gen.fetch import prefetch
 from conf_gen.generator import generate_conf
 from conf_gen.proxy import ProxyBase
 from conf_gen.proxy import parse_clash_proxies
@@ -20,15 +26,135 @@ from conf_gen.rewrite import parse_rewrites
 from common import secrets
 
 
-def main() -> None:
-    parser = ArgumentParser("Generate Clash/QuantumultX/sing-box config from specified source.")
+def _add_fetch_arguments(parser: ArgumentParser) -> None:
     parser.add_argument("-s", "--src", required=True, help="Source spec in YAML format.")
+    parser.add_argument(
+        "--fetch-workers",
+        type=int,
+        default=16,
+        help="Maximum number of concurrent downloads when prefetching remote resources.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=os.environ.get(
+            "CONF_GEN_CACHE_DIR",
+            os.path.join(
+                os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "conf-gen"
+            ),
+        ),
+        help="Directory of the persistent HTTP cache of remote resources.",
+    )
+    parser.add_argument(
+        "--cache-subscriptions",
+        action="store_true",
+        help="Also cache subscriptions, which carry proxy credentials, e.g., to fall back to "
+        "the last copy when a subscription is down.",
+    )
+    parser.add_argument(
+        "--lock-file",
+        help="Path of the lockfile, defaults to `<src>.lock.json` next to the source.",
+    )
+
+
+def _load_source(src: str) -> dict[str, Any]:
+    src_conf: dict[str, Any] = yaml.safe_load(open(src, "r", encoding="utf-8"))
+    return secrets.expand_secret_object(src_conf)  # type: ignore[no-any-return]
+
+
+def fetch_main(argv: Sequence[str]) -> None:
+    parser = ArgumentParser(
+        prog="conf-gen fetch",
+        description="Download every remote dependency of a source spec into the cache.",
+    )
+    _add_fetch_arguments(parser)
+    parser.add_argument(
+        "--lock",
+        action="store_true",
+        help="Also pin the downloaded payloads and record them in the lockfile.",
+    )
+    args = parser.parse_args(argv)
+    lock_file = args.lock_file or f"{os.path.splitext(args.src)[0]}.lock.json"
+
+    src_conf = _load_source(args.src)
+    lockfile = Lockfile() if args.lock else None
+    configure(
+        max_workers=args.fetch_workers,
+        cache_dir=args.cache_dir,
+        max_age=src_conf["global"].get("cache_max_age"),
+        lockfile=lockfile,
+        cache_private=args.cache_subscriptions,
+    )
+    resources = collect_remote_resources(src_conf)
+    if failed := prefetch(resources):
+        parser.exit(1, f"Failed to fetch {len(failed)} of {len(resources)} remote resources.\n")
+
+    if lockfile is not None:
+        lockfile.dump(lock_file)
+        print(f"Locked {len(lockfile.payloads)} remote payloads to {lock_file}.")
+
+
+def generate_main(argv: Sequence[str]) -> None:
+    parser = ArgumentParser(
+        prog="conf-gen",
+        description="Generate Clash/QuantumultX/sing-box config from specified source.",
+    )
+    _add_fetch_arguments(parser)
     parser.add_argument("-o", "--dst", required=True, help="Directory of generated files.")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--generate-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Maximum number of processes generating independent configs concurrently.",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not read or write the persistent HTTP cache."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate every config, even if its inputs didn't change since the last run.",
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        metavar="NAME",
+        help="Only generate the named config (building its bases as needed), may be repeated.",
+    )
+    lock_mode = parser.add_mutually_exclusive_group()
+    lock_mode.add_argument(
+        "--lock",
+        action="store_true",
+        help="Pin every remote payload of this run in the cache and record it in the lockfile.",
+    )
+    lock_mode.add_argument(
+        "--frozen",
+        action="store_true",
+        help="Rebuild from the payloads recorded in the lockfile without accessing the network.",
+    )
+    args = parser.parse_args(argv)
+    if (args.lock or args.frozen) and args.no_cache:
+        parser.error("--lock and --frozen store payloads in the cache, drop --no-cache.")
+    lock_file = args.lock_file or f"{os.path.splitext(args.src)[0]}.lock.json"
 
-    src_conf: dict[str, Any] = yaml.safe_load(open(args.src, "r", encoding="utf-8"))
-    src_conf = secrets.expand_secret_object(src_conf)
+    src_conf = _load_source(args.src)
     src_file = os.path.split(args.src)[-1]
+    if args.only and (unknown := set(args.only) - {g["name"] for g in src_conf["generates"]}):
+        parser.error(f"Unknown generates: {', '.join(sorted(unknown))}.")
+    # Download every remote dependency up front; parsers below then read from memory.
+    lockfile = None
+    if args.frozen:
+        lockfile = Lockfile.load(lock_file)
+    elif args.lock:
+        lockfile = Lockfile()
+    configure(
+        max_workers=args.fetch_workers,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        max_age=src_conf["global"].get("cache_max_age"),
+        lockfile=lockfile,
+        frozen=args.frozen,
+        cache_private=args.cache_subscriptions,
+    )
+    prefetch(collect_remote_resources(src_conf))
 
     custom_proxies = parse_clash_proxies(src_conf["proxies"])
     subscription_proxies = parse_subscriptions(src_conf["subscriptions"])
@@ -53,8 +179,27 @@ def main() -> None:
         per_region_proxies=per_region_proxies,
         proxy_groups=proxy_groups,
         rewrites=rewrites,
+        max_workers=args.generate_workers,
+        force=args.force,
+        only=args.only,
     )
 
+    if args.lock:
+        assert lockfile is not None
+        lockfile.dump(lock_file)
+        print(f"Locked {len(lockfile.payloads)} remote payloads to {lock_file}.")
+
+
+def main(argv: Sequence[str] | None = None) -> None:
+    # `conf-gen [generate] ...` generates configs, `conf-gen fetch ...` only warms the cache.
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "fetch":
+        fetch_main(argv[1:])
+    elif argv and argv[0] == "generate":
+        generate_main(argv[1:])
+    else:
+        generate_main(argv)
+
 
 if __name__ == "__main__":
     main()
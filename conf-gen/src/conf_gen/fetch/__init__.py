@@ -0,0 +1,43 @@
+from conf_gen.fetch.cache import PayloadCache
+from conf_gen.fetch.fetcher import DEFAULT_HEDGE_DELAY
+from conf_gen.fetch.fetcher import DEFAULT_MAX_AGE
+from conf_gen.fetch.fetcher import PRIVATE_KINDS
+from conf_gen.fetch.fetcher import RULE_SET_HEADERS
+from conf_gen.fetch.fetcher import Fetcher
+from conf_gen.fetch.fetcher import Payload
+from conf_gen.fetch.fetcher import RemoteResource
+from conf_gen.fetch.fetcher import configure
+from conf_gen.fetch.fetcher import current_fetcher
+from conf_gen.fetch.fetcher import current_lockfile
+from conf_gen.fetch.fetcher import fetch
+from conf_gen.fetch.fetcher import join_requests
+from conf_gen.fetch.fetcher import prefetch
+from conf_gen.fetch.fetcher import release
+from conf_gen.fetch.fetcher import resolve_redirect
+from conf_gen.fetch.fetcher import set_fetcher
+from conf_gen.fetch.lockfile import LockedPayload
+from conf_gen.fetch.lockfile import Lockfile
+from conf_gen.fetch.parser import collect_remote_resources
+
+__all__ = (
+    "DEFAULT_HEDGE_DELAY",
+    "DEFAULT_MAX_AGE",
+    "PRIVATE_KINDS",
+    "RULE_SET_HEADERS",
+    "Fetcher",
+    "LockedPayload",
+    "Lockfile",
+    "Payload",
+    "PayloadCache",
+    "RemoteResource",
+    "collect_remote_resources",
+    "configure",
+    "current_fetcher",
+    "current_lockfile",
+    "fetch",
+    "join_requests",
+    "prefetch",
+    "release",
+    "resolve_redirect",
+    "set_fetcher",
+)
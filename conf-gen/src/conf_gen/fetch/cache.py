@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import replace
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Iterable
+
+# Bytes read or written at a time when streaming blobs.
+CHUNK_SIZE = 1 << 16
+
+zstd: Any
+try:
+    from compression import zstd  # type: ignore[import-not-found, no-redef, unused-ignore]
+except ImportError:
+    try:
+        from backports import zstd  # type: ignore[import-not-found, no-redef, unused-ignore]
+    except ImportError:
+        zstd = None
+
+# Blobs are compressed at rest, with zstd when available (Python 3.14+, or the `zstd` extra)
+# and gzip otherwise. The codec is told by the file suffix, so blobs written by either remain
+# readable.
+BLOB_SUFFIX = ".zst" if zstd is not None else ".gz"
+
+
+def open_blob(path: str | os.PathLike[str]) -> BinaryIO:
+    # Decompresses while reading, so blobs are never inflated in one piece.
+    suffix = Path(path).suffix
+    if suffix == ".zst":
+        if zstd is None:
+            raise RuntimeError(f"Reading {path} requires zstd support, install the `zstd` extra.")
+        return zstd.open(path, "rb")  # type: ignore[no-any-return]
+    elif suffix == ".gz":
+        return gzip.open(path, "rb")  # type: ignore[return-value]
+    return open(path, "rb")
+
+
+def _compressing_writer(f: BinaryIO) -> BinaryIO:
+    if zstd is not None:
+        return zstd.ZstdFile(f, "wb")  # type: ignore[no-any-return]
+    return gzip.GzipFile(fileobj=f, mode="wb", mtime=0)  # type: ignore[return-value]
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    url: str
+    fetched_at: float
+    encoding: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    # Of the uncompressed body, so it can be fingerprinted without reading it again.
+    sha256: str | None = None
+
+
+class PayloadCache:
+    # One `<sha256>.json` metadata file and one compressed `<sha256>.body.<codec>` blob per
+    # resource key. Writes go through a temporary file and `os.replace`, so concurrent runs never
+    # see partial blobs. Pinned blobs live under `objects/` and are addressed by the sha256 of
+    # their uncompressed content, so a lockfile keeps pointing at the same bytes after the keyed
+    # entries get refreshed. Payloads may carry secrets (e.g., pinned subscriptions), so the
+    # directory is created 0700 and files, all written through `mkstemp`, are 0600.
+
+    def __init__(self, directory: str | os.PathLike[str]) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    def _paths(self, key: str) -> tuple[Path, Path]:
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return (
+            self.directory / f"{digest}.json",
+            self.directory / f"{digest}.body{BLOB_SUFFIX}",
+        )
+
+    def _write_temp(self, chunks: Iterable[bytes], compress: bool) -> tuple[str, str]:
+        # Returns the temporary path and the sha256 of the uncompressed content.
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                f = _compressing_writer(raw) if compress else raw
+                with f:
+                    for chunk in chunks:
+                        digest.update(chunk)
+                        f.write(chunk)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return tmp, digest.hexdigest()
+
+    def _atomic_write(self, path: Path, chunks: Iterable[bytes], compress: bool = False) -> str:
+        tmp, digest = self._write_temp(chunks, compress)
+        os.replace(tmp, path)
+        return digest
+
+    def load(self, key: str) -> CacheEntry | None:
+        meta_path, body_path = self._paths(key)
+        if not (meta_path.is_file() and body_path.is_file()):
+            return None
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return CacheEntry(**json.load(f))
+        except (ValueError, TypeError):
+            # Corrupted or outdated metadata, treat as a cache miss.
+            return None
+
+    def body_path(self, key: str) -> Path:
+        return self._paths(key)[1]
+
+    def store(self, key: str, entry: CacheEntry, chunks: Iterable[bytes]) -> CacheEntry:
+        # Returns the entry along with the digest of the stored body.
+        meta_path, body_path = self._paths(key)
+        entry = replace(entry, sha256=self._atomic_write(body_path, chunks, compress=True))
+        self._atomic_write(meta_path, [json.dumps(asdict(entry)).encode("utf-8")])
+        return entry
+
+    def touch(self, key: str, entry: CacheEntry) -> None:
+        meta_path, _ = self._paths(key)
+        entry = CacheEntry(**{**asdict(entry), "fetched_at": time.time()})
+        self._atomic_write(meta_path, [json.dumps(asdict(entry)).encode("utf-8")])
+
+    def pin(self, stream: BinaryIO) -> tuple[str, str]:
+        # Returns the content digest and the blob path relative to the cache directory.
+        tmp, digest = self._write_temp(iter(lambda: stream.read(CHUNK_SIZE), b""), compress=True)
+        blob = Path("objects", digest[:2], f"{digest}{BLOB_SUFFIX}")
+        path = self.directory / blob
+        if path.is_file():
+            os.unlink(tmp)
+        else:
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            os.replace(tmp, path)
+        return digest, blob.as_posix()
+
+    def blob_path(self, blob: str) -> Path:
+        return self.directory / blob
@@ -0,0 +1,452 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+from typing import BinaryIO
+from typing import Final
+from typing import Iterable
+from typing import Mapping
+from typing import TextIO
+from warnings import warn
+
+import requests
+from common.http import new_session
+
+from conf_gen.fetch.cache import CHUNK_SIZE
+from conf_gen.fetch.cache import CacheEntry
+from conf_gen.fetch.cache import PayloadCache
+from conf_gen.fetch.cache import open_blob
+from conf_gen.fetch.lockfile import LockedPayload
+from conf_gen.fetch.lockfile import Lockfile
+
+# Clash-flavored rule set providers may serve different content to different clients.
+RULE_SET_HEADERS: Final[dict[str, str]] = {"user-agent": "clash"}
+
+# Seconds a cached payload is used as-is before being revalidated with the upstream. Rule lists
+# and rewrites change at most daily; subscriptions are always revalidated. Release tarballs are
+# addressed by version and never change.
+DEFAULT_MAX_AGE: Final[dict[str, int]] = {
+    "clash-classical": 3600,
+    "clash-ipcidr": 3600,
+    "dnsmasq": 3600,
+    "domain-list": 3600,
+    "quantumult": 3600,
+    "rewrite": 3600,
+    "sing-box": 30 * 86400,
+    "subscription": 0,
+}
+
+# Source types whose payloads carry credentials, e.g., the proxies' passwords in a subscription.
+# They only go to the persistent cache when explicitly asked for.
+PRIVATE_KINDS: Final[frozenset[str]] = frozenset({"subscription"})
+
+# Seconds to wait for a primary URL before racing its backup URL against it.
+DEFAULT_HEDGE_DELAY: Final[float] = 3.0
+
+
+@dataclass(frozen=True)
+class RemoteResource:
+    url: str
+    params: dict[str, str] | None = None
+    headers: dict[str, str] | None = None
+    backup_url: str | None = None
+    # Source type of this resource, e.g., `clash-classical` or `subscription`. Selects the
+    # max-age policy of cached payloads.
+    kind: str | None = None
+    hedge_delay: float = DEFAULT_HEDGE_DELAY
+
+    @property
+    def key(self) -> str:
+        # Headers only affect how we ask, not what we ask for, so they are not part of the key.
+        return requests.Request("GET", self.url, params=self.params).prepare().url or self.url
+
+
+@dataclass(frozen=True)
+class Payload:
+    url: str
+    encoding: str | None
+    # The body is either held in memory or, when it came through the cache, read from its
+    # compressed blob on demand so large payloads can be streamed instead of being loaded in one
+    # piece.
+    body: bytes | None = None
+    path: Path | None = None
+    # sha256 of the body when already known, e.g., from the cache metadata or the lockfile.
+    sha256: str | None = None
+
+    def open(self) -> BinaryIO:
+        if self.path is not None:
+            return open_blob(self.path)
+        assert self.body is not None
+        return io.BytesIO(self.body)
+
+    def open_text(self) -> TextIO:
+        # Decodes incrementally, so iterating lines only holds one buffered chunk at a time.
+        return io.TextIOWrapper(self.open(), encoding=self.encoding or "utf-8", errors="replace")
+
+    @property
+    def content(self) -> bytes:
+        if self.body is not None:
+            return self.body
+        with self.open() as f:
+            return f.read()
+
+    def hexdigest(self) -> str:
+        # Streams the body when its digest is not known yet.
+        if self.sha256 is not None:
+            return self.sha256
+        digest = hashlib.sha256()
+        with self.open() as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+
+def _close_response(future: Future[requests.Response]) -> None:
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class Fetcher:
+    # Payloads are kept per resource key for the whole run, so a prefetch stage can download
+    # everything concurrently and the parsers later read them. Bodies are streamed to disk:
+    # with a cache directory, payloads also persist across runs and are revalidated with
+    # ETag/Last-Modified; without one they go to a scratch directory removed with the fetcher.
+    # Payloads of `PRIVATE_KINDS` skip the cache unless `cache_private` is set, and are held in
+    # memory instead of the scratch directory, so credentials never touch the disk uncalled
+    # for; their consumers `release` them once parsed.
+    # With a lockfile, every consumed payload is pinned in the cache and recorded; in frozen mode
+    # the recorded blobs are replayed instead and the network is never touched.
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        cache_dir: str | os.PathLike[str] | None = None,
+        max_age: Mapping[str, int] | None = None,
+        lockfile: Lockfile | None = None,
+        frozen: bool = False,
+        cache_private: bool = False,
+    ) -> None:
+        if lockfile is not None and cache_dir is None:
+            raise ValueError("Locking or replaying payloads requires a cache directory.")
+        if frozen and lockfile is None:
+            raise ValueError("Frozen mode requires a lockfile to replay.")
+        self.max_workers = max_workers
+        self._cache = PayloadCache(cache_dir) if cache_dir is not None else None
+        self._max_age = {**DEFAULT_MAX_AGE, **(max_age or {})}
+        self._lockfile = lockfile
+        self._frozen = frozen
+        self._cache_private = cache_private
+        # Workers mostly hit a handful of hosts, so keep one pooled connection per worker.
+        self._session = new_session(pool_maxsize=max_workers)
+        self._payloads: dict[str, Payload] = {}
+        self._scratch: PayloadCache | None = None
+        self._scratch_dir: tempfile.TemporaryDirectory[str] | None = None
+        self._scratch_lock = threading.Lock()
+        # Pools of hedged races, whose losing requests may still be in flight.
+        self._hedging: list[ThreadPoolExecutor] = []
+        self._hedging_lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Pickled for generator workers, which get the payloads fetched so far but neither the
+        # connections nor the in-flight requests. Without a cache directory, workers download into
+        # this fetcher's scratch directory, which is removed along with this fetcher only.
+        if self._cache is None:
+            self._scratch_cache()
+        state = self.__dict__.copy()
+        for name in ("_session", "_scratch_dir", "_scratch_lock", "_hedging", "_hedging_lock"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._session = new_session(pool_maxsize=self.max_workers)
+        self._scratch_dir = None
+        self._scratch_lock = threading.Lock()
+        self._hedging = []
+        self._hedging_lock = threading.Lock()
+
+    @property
+    def lockfile(self) -> Lockfile | None:
+        return self._lockfile
+
+    def renew_session(self) -> None:
+        self._session = new_session(pool_maxsize=self.max_workers)
+
+    def _scratch_cache(self) -> PayloadCache:
+        # Created on first use, so fetchers that never download without a cache leave no trace.
+        with self._scratch_lock:
+            if self._scratch is None:
+                self._scratch_dir = tempfile.TemporaryDirectory(prefix="conf-gen-")
+                self._scratch = PayloadCache(self._scratch_dir.name)
+            return self._scratch
+
+    def _replay(self, resource: RemoteResource) -> Payload:
+        assert self._lockfile is not None and self._cache is not None
+        locked = self._lockfile.payloads.get(resource.key)
+        if locked is None:
+            raise RuntimeError(
+                f"{resource.url} is not recorded in the lockfile, rerun with `--lock` to update it."
+            )
+        path = self._cache.blob_path(locked.blob)
+        try:
+            digest = hashlib.sha256()
+            with open_blob(path) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            raise RuntimeError(f"Locked blob {locked.blob} of {resource.url} is missing.")
+        if digest.hexdigest() != locked.sha256:
+            raise RuntimeError(f"Locked blob {locked.blob} of {resource.url} is corrupted.")
+        return Payload(locked.url, locked.encoding, path=path, sha256=locked.sha256)
+
+    def _record(self, key: str, payload: Payload) -> None:
+        if self._lockfile is None or self._frozen:
+            return
+        assert self._cache is not None
+        with payload.open() as f:
+            digest, blob = self._cache.pin(f)
+        self._lockfile.record(key, LockedPayload(payload.url, digest, blob, payload.encoding))
+
+    def _get(
+        self, url: str, params: dict[str, str] | None, headers: dict[str, str] | None
+    ) -> requests.Response:
+        # Bodies are streamed, so with a cache they go to disk chunk by chunk.
+        r = self._session.get(url, params=params, headers=headers, stream=True)
+        if r.status_code not in (200, 304):
+            r.close()
+            raise requests.HTTPError(f"{r.status_code} {r.reason}", response=r)
+        return r
+
+    def _get_hedged(self, resource: RemoteResource, headers: dict[str, str]) -> requests.Response:
+        if resource.backup_url is None:
+            return self._get(resource.url, resource.params, headers)
+        # The backup is raced against the primary once the primary is slower than the hedge
+        # delay, or right away when it fails; whichever succeeds first wins. Conditional headers
+        # only describe the primary's cached copy, so the backup doesn't get them.
+        pool = ThreadPoolExecutor(max_workers=2)
+        with self._hedging_lock:
+            self._hedging.append(pool)
+        try:
+            primary = pool.submit(self._get, resource.url, resource.params, headers)
+            futures = [primary]
+            wait(futures, timeout=resource.hedge_delay)
+            if not primary.done() or primary.exception() is not None:
+                backup = pool.submit(
+                    self._get, resource.backup_url, resource.params, resource.headers
+                )
+                futures.append(backup)
+            pending = set(futures)
+            error: BaseException | None = None
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if (error := future.exception()) is None:
+                        for loser in futures:
+                            if loser is not future:
+                                loser.add_done_callback(_close_response)
+                        return future.result()
+                    if not isinstance(error, requests.RequestException):
+                        raise error
+            assert error is not None
+            raise error
+        finally:
+            # Don't wait for a losing request that is still in flight.
+            pool.shutdown(wait=False)
+
+    def _download(self, resource: RemoteResource) -> Payload:
+        if self._frozen:
+            return self._replay(resource)
+        key = resource.key
+        cache = self._cache
+        if resource.kind in PRIVATE_KINDS and not self._cache_private:
+            cache = None
+        entry = cache.load(key) if cache is not None else None
+        if entry is not None and cache is not None:
+            age = time.time() - entry.fetched_at
+            if age < self._max_age.get(resource.kind or "", 0):
+                print(f"Using cached {resource.url} ({int(age)}s old)...")
+                return Payload(
+                    entry.url, entry.encoding, path=cache.body_path(key), sha256=entry.sha256
+                )
+
+        headers = dict(resource.headers or {})
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        print(f"Requesting to get from {resource.url}...")
+        try:
+            r = self._get_hedged(resource, headers)
+        except requests.RequestException as e:
+            if entry is None or cache is None:
+                raise
+            # Stale beats nothing, e.g., when a subscription and its backup are both down.
+            warn(
+                f"Fetching {resource.url} failed ({e}), falling back to the copy cached at "
+                f"{time.ctime(entry.fetched_at)}."
+            )
+            return Payload(
+                entry.url, entry.encoding, path=cache.body_path(key), sha256=entry.sha256
+            )
+        if r.status_code == 304 and entry is not None and cache is not None:
+            r.close()
+            cache.touch(key, entry)
+            return Payload(
+                entry.url, entry.encoding, path=cache.body_path(key), sha256=entry.sha256
+            )
+        with r:
+            if r.status_code != 200:
+                raise requests.HTTPError(f"{r.status_code} {r.reason}")
+            # `apparent_encoding` runs charset detection over the whole body, which is
+            # prohibitive for binary payloads; `Payload.text` falls back to UTF-8 instead.
+            if cache is None and resource.kind in PRIVATE_KINDS:
+                return Payload(url=r.url, encoding=r.encoding, body=r.content)
+            if cache is None:
+                cache = self._scratch_cache()
+            entry = CacheEntry(
+                url=r.url,
+                fetched_at=time.time(),
+                encoding=r.encoding,
+                etag=r.headers.get("ETag"),
+                last_modified=r.headers.get("Last-Modified"),
+            )
+            entry = cache.store(key, entry, r.iter_content(CHUNK_SIZE))
+            return Payload(
+                url=r.url, encoding=r.encoding, path=cache.body_path(key), sha256=entry.sha256
+            )
+
+    def join_requests(self) -> None:
+        # Waits for the requests still in flight, e.g., the losers of hedged races, so that no
+        # thread holds a lock when the process forks.
+        with self._hedging_lock:
+            pools, self._hedging = self._hedging, []
+        for pool in pools:
+            pool.shutdown(wait=True)
+
+    def fetch(self, resource: RemoteResource) -> Payload:
+        key = resource.key
+        if (payload := self._payloads.get(key)) is None:
+            payload = self._payloads[key] = self._download(resource)
+            self._record(key, payload)
+        return payload
+
+    def release(self, resource: RemoteResource) -> None:
+        # Drops a parsed payload, e.g., an in-memory subscription, fetching it again downloads
+        # (or loads) it anew.
+        self._payloads.pop(resource.key, None)
+
+    def resolve_redirect(self, url: str) -> str:
+        # Final URL after redirects, e.g., the concrete version behind `releases/latest`.
+        if self._frozen:
+            assert self._lockfile is not None
+            if (target := self._lockfile.redirects.get(url)) is None:
+                raise RuntimeError(
+                    f"Redirect of {url} is not recorded in the lockfile, rerun with `--lock` to "
+                    f"update it."
+                )
+            return target
+        r = self._session.head(url, allow_redirects=True)
+        r.raise_for_status()
+        if self._lockfile is not None:
+            self._lockfile.record_redirect(url, r.url)
+        return r.url
+
+    def prefetch(self, resources: Iterable[RemoteResource]) -> list[RemoteResource]:
+        # Returns the resources that failed to download.
+        pending: dict[str, RemoteResource] = {}
+        failed: list[RemoteResource] = []
+        for resource in resources:
+            if resource.key not in self._payloads:
+                pending.setdefault(resource.key, resource)
+        if not pending:
+            return failed
+        print(f"Prefetching {len(pending)} remote resources...")
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+            futures = {pool.submit(self._download, r): k for k, r in pending.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    self._payloads[key] = future.result()
+                    self._record(key, self._payloads[key])
+                except requests.RequestException as e:
+                    # Leave it to the on-demand fetch, which raises in the parser's context.
+                    warn(f"Prefetching {pending[key].url} failed: {e}")
+                    failed.append(pending[key])
+        return failed
+
+
+_FETCHER: Fetcher = Fetcher()
+
+
+def configure(
+    max_workers: int = 16,
+    cache_dir: str | os.PathLike[str] | None = None,
+    max_age: Mapping[str, int] | None = None,
+    lockfile: Lockfile | None = None,
+    frozen: bool = False,
+    cache_private: bool = False,
+) -> None:
+    global _FETCHER
+    _FETCHER = Fetcher(
+        max_workers=max_workers,
+        cache_dir=cache_dir,
+        max_age=max_age,
+        lockfile=lockfile,
+        frozen=frozen,
+        cache_private=cache_private,
+    )
+
+
+def current_fetcher() -> Fetcher:
+    return _FETCHER
+
+
+def set_fetcher(fetcher: Fetcher) -> None:
+    # Installs a fetcher handed over from another process, e.g., to a generator worker.
+    global _FETCHER
+    _FETCHER = fetcher
+
+
+def fetch(resource: RemoteResource) -> Payload:
+    return _FETCHER.fetch(resource)
+
+
+def release(resource: RemoteResource) -> None:
+    _FETCHER.release(resource)
+
+
+def join_requests() -> None:
+    _FETCHER.join_requests()
+
+
+def current_lockfile() -> Lockfile | None:
+    return _FETCHER.lockfile
+
+
+def prefetch(resources: Iterable[RemoteResource]) -> list[RemoteResource]:
+    return _FETCHER.prefetch(resources)
+
+
+def resolve_redirect(url: str) -> str:
+    return _FETCHER.resolve_redirect(url)
+
+
+# Forked processes inherit the fetcher with its prefetched payloads, but must not share pooled
+# connections with their parent or each other.
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: _FETCHER.renew_session())
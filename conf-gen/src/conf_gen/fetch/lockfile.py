@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Final
+from typing import Mapping
+
+LOCKFILE_VERSION: Final[int] = 1
+
+
+@dataclass(frozen=True)
+class LockedPayload:
+    url: str
+    sha256: str
+    # Relative to the cache directory the lockfile was written with.
+    blob: str
+    encoding: str | None = None
+
+
+class Lockfile:
+    # Maps resource keys to the exact payloads a run consumed, plus the redirect targets it
+    # resolved (e.g., `releases/latest`). Written by `--lock`, replayed by `--frozen`.
+
+    def __init__(
+        self,
+        payloads: dict[str, LockedPayload] | None = None,
+        redirects: dict[str, str] | None = None,
+    ) -> None:
+        self.payloads = payloads or {}
+        self.redirects = redirects or {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict[str, Any]:
+        # Pickled for generator workers, each of which records into its own copy.
+        with self._lock:
+            return {"payloads": dict(self.payloads), "redirects": dict(self.redirects)}
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.payloads = state["payloads"]
+        self.redirects = state["redirects"]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str | os.PathLike[str]) -> "Lockfile":
+        with open(path, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+        if obj.get("version") != LOCKFILE_VERSION:
+            raise ValueError(
+                f"Lockfile {path} has version {obj.get('version')}, expected {LOCKFILE_VERSION}."
+            )
+        return cls(
+            payloads={k: LockedPayload(**v) for k, v in obj["payloads"].items()},
+            redirects=dict(obj["redirects"]),
+        )
+
+    def dump(self, path: str | os.PathLike[str]) -> None:
+        with self._lock:
+            obj = {
+                "version": LOCKFILE_VERSION,
+                "payloads": {k: asdict(self.payloads[k]) for k in sorted(self.payloads)},
+                "redirects": {k: self.redirects[k] for k in sorted(self.redirects)},
+            }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+    def record(self, key: str, payload: LockedPayload) -> None:
+        with self._lock:
+            self.payloads[key] = payload
+
+    def record_redirect(self, url: str, target: str) -> None:
+        with self._lock:
+            self.redirects[url] = target
+
+    def update(self, payloads: Mapping[str, LockedPayload], redirects: Mapping[str, str]) -> None:
+        # Merges what another process recorded into this lockfile, e.g., a generator worker.
+        with self._lock:
+            self.payloads.update(payloads)
+            self.redirects.update(redirects)
@@ -0,0 +1,47 @@
+from typing import Any
+
+from conf_gen.fetch.fetcher import DEFAULT_HEDGE_DELAY
+from conf_gen.fetch.fetcher import RULE_SET_HEADERS
+from conf_gen.fetch.fetcher import RemoteResource
+
+REMOTE_FILTER_TYPES = ("quantumult", "clash-classical", "clash-ipcidr", "domain-list", "dnsmasq")
+
+
+def _collect_filter_resources(node: Any, filters_key: str = "filters") -> list[RemoteResource]:
+    ret: list[RemoteResource] = []
+    if isinstance(node, dict):
+        for k, v in node.items():
+            if k == filters_key and isinstance(v, list):
+                for f in v:
+                    if isinstance(f, dict) and f.get("type") in REMOTE_FILTER_TYPES:
+                        ret.append(
+                            RemoteResource(url=f["url"], headers=RULE_SET_HEADERS, kind=f["type"])
+                        )
+            else:
+                ret += _collect_filter_resources(v, filters_key)
+    elif isinstance(node, (list, tuple)):
+        for v in node:
+            ret += _collect_filter_resources(v, filters_key)
+    return ret
+
+
+def collect_remote_resources(src_conf: dict[str, Any]) -> list[RemoteResource]:
+    # Filters may also live in generates, e.g., sing-box DNS rules are expanded from filters.
+    resources = _collect_filter_resources(src_conf.get("rules", []))
+    resources += _collect_filter_resources(src_conf.get("generates", []))
+    for sub_info in src_conf.get("subscriptions", []):
+        if sub_info["type"] == "clash":
+            resources.append(
+                RemoteResource(
+                    url=sub_info["url"],
+                    params=sub_info.get("params", {}),
+                    headers=sub_info.get("headers", {}),
+                    backup_url=sub_info.get("backup_url"),
+                    kind="subscription",
+                    hedge_delay=sub_info.get("hedge_delay", DEFAULT_HEDGE_DELAY),
+                )
+            )
+    for r_info in src_conf.get("rewrites", []):
+        if r_info["type"] == "quantumult":
+            resources.append(RemoteResource(url=r_info["url"], kind="rewrite"))
+    return resources
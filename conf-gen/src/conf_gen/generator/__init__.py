@@ -1,103 +1,272 @@
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
 from copy import copy
+from multiprocessing.context import BaseContext
 from typing import Any
+from typing import Collection
 from typing import Sequence
 
+from conf_gen.fetch import Fetcher
+from conf_gen.fetch import LockedPayload
+from conf_gen.fetch import collect_remote_resources
+from conf_gen.fetch import current_fetcher
+from conf_gen.fetch import current_lockfile
+from conf_gen.fetch import fetch
+from conf_gen.fetch import set_fetcher
 from conf_gen.generator._base_generator import GeneratorBase
+from conf_gen.generator._manifest import Manifest
+from conf_gen.generator._manifest import code_fingerprint
+from conf_gen.generator._manifest import fingerprint
 from conf_gen.generator.clash_generator import ClashGenerator
 from conf_gen.generator.quantumult_generator import QuantumultGenerator
+from conf_gen.generator.sing_box_generator import DEFAULT_RULESET_VERSION
 from conf_gen.generator.sing_box_generator import SingBoxGenerator
 from conf_gen.proxy._base_proxy import ProxyBase
 from conf_gen.proxy_group._base_proxy_group import ProxyGroupBase
 from conf_gen.rewrite._base_rewrite import RewriteBase
 
 
-def generate_conf(
-    generate_info: list[dict[str, Any]],
+def _generate_one(
+    gen_info: dict[str, Any],
+    generators: dict[str, GeneratorBase],
+    stale: bool,
     src: str,
     dst: str,
     proxies: Sequence[ProxyBase],
     per_region_proxies: Sequence[ProxyBase | ProxyGroupBase],
     proxy_groups: Sequence[ProxyGroupBase],
-    rewrites: Sequence[RewriteBase] | None = None,
+    rewrites: Sequence[RewriteBase] | None,
 ) -> None:
-    generators: dict[str, GeneratorBase] = {}
-    for gen_info in generate_info:
-        gen: GeneratorBase
-        if gen_info["type"] == "clash":
-            general_options = copy(gen_info)
-            general_options.pop("name")
-            general_options.pop("type")
-            gen = ClashGenerator(
-                src_file=src,
-                proxies=proxies,
-                per_region_proxies=per_region_proxies,
-                proxy_groups=proxy_groups,
-                **general_options,
+    gen: GeneratorBase
+    if gen_info["type"] == "clash":
+        general_options = copy(gen_info)
+        general_options.pop("name")
+        general_options.pop("type")
+        gen = ClashGenerator(
+            src_file=src,
+            proxies=proxies,
+            per_region_proxies=per_region_proxies,
+            proxy_groups=proxy_groups,
+            **general_options,
+        )
+        dst_dir = os.path.join(dst, f"{gen_info['name']}.yaml")
+    elif gen_info["type"] == "quantumult":
+        if rewrites is None:
+            raise ValueError("`rewrites` arg is required for generating Quantumult configs.")
+        additional_sections = copy(gen_info)
+        additional_sections.pop("name")
+        additional_sections.pop("type")
+        gen = QuantumultGenerator(
+            src_file=src,
+            proxies=proxies,
+            per_region_proxies=per_region_proxies,
+            proxy_groups=proxy_groups,
+            rewrites=rewrites,
+            **additional_sections,
+        )
+        dst_dir = os.path.join(dst, f"{gen_info['name']}.conf")
+    elif gen_info["type"] == "sing-box":
+        if gen_info.get("base"):
+            base_gen = generators[gen_info["base"]]
+            if not isinstance(base_gen, SingBoxGenerator):
+                raise ValueError(f"Base generator {gen_info['base']} is not a SingBoxGenerator")
+            if gen_info.get("included_process_irs"):
+                if gen_info["included_process_irs"] == "!clear":
+                    included_process_irs = None
+                else:
+                    included_process_irs = gen_info["included_process_irs"]
+            else:
+                included_process_irs = base_gen.included_process_irs
+            gen = SingBoxGenerator.from_base(
+                base_object=base_gen,
+                dns=gen_info.get("dns"),
+                inbounds=gen_info.get("inbounds"),
+                route=gen_info.get("route"),
+                experimental=gen_info.get("experimental"),
+                included_process_irs=included_process_irs,
+                ruleset_url=gen_info.get("ruleset_url"),
+                add_resolve_action=gen_info.get("add_resolve_action"),
+                ruleset_version=gen_info.get("ruleset_version"),
             )
-            dst_dir = os.path.join(dst, f"{gen_info['name']}.yaml")
-            gen.generate(dst_dir)
-        elif gen_info["type"] == "quantumult":
-            if rewrites is None:
-                raise ValueError("`rewrites` arg is required for generating Quantumult configs.")
-            additional_sections = copy(gen_info)
-            additional_sections.pop("name")
-            additional_sections.pop("type")
-            gen = QuantumultGenerator(
+        else:
+            args = copy(gen_info)
+            gen = SingBoxGenerator(
                 src_file=src,
-                proxies=proxies,
-                per_region_proxies=per_region_proxies,
-                proxy_groups=proxy_groups,
-                rewrites=rewrites,
-                **additional_sections,
+                proxies=list(proxies),
+                per_region_proxies=list(per_region_proxies),
+                proxy_groups=list(proxy_groups),
+                dns=args["dns"],
+                route=args["route"],
+                inbounds=args.get("inbounds"),
+                log=args.get("log"),
+                ntp=args.get("ntp"),
+                experimental=args.get("experimental"),
+                included_process_irs=args.get("included_process_irs"),
+                ruleset_url=args.get("ruleset_url"),
+                dial_fields=args.get("dial_fields"),
+                add_resolve_action=args.get("add_resolve_action"),
+                ruleset_version=args.get("ruleset_version", DEFAULT_RULESET_VERSION),
             )
-            dst_dir = os.path.join(dst, f"{gen_info['name']}.conf")
-            gen.generate(dst_dir)
-        elif gen_info["type"] == "sing-box":
-            if gen_info.get("base"):
-                base_gen = generators[gen_info["base"]]
-                if not isinstance(base_gen, SingBoxGenerator):
-                    raise ValueError(f"Base generator {gen_info['base']} is not a SingBoxGenerator")
-                if gen_info.get("included_process_irs"):
-                    if gen_info["included_process_irs"] == "!clear":
-                        included_process_irs = None
-                    else:
-                        included_process_irs = gen_info["included_process_irs"]
-                else:
-                    included_process_irs = base_gen.included_process_irs
-                gen = SingBoxGenerator.from_base(
-                    base_object=base_gen,
-                    dns=gen_info.get("dns"),
-                    inbounds=gen_info.get("inbounds"),
-                    route=gen_info.get("route"),
-                    experimental=gen_info.get("experimental"),
-                    included_process_irs=included_process_irs,
-                    ruleset_url=gen_info.get("ruleset_url"),
-                    add_resolve_action=gen_info.get("add_resolve_action"),
-                )
-            else:
-                args = copy(gen_info)
-                gen = SingBoxGenerator(
-                    src_file=src,
-                    proxies=list(proxies),
-                    per_region_proxies=list(per_region_proxies),
-                    proxy_groups=list(proxy_groups),
-                    dns=args["dns"],
-                    route=args["route"],
-                    inbounds=args.get("inbounds"),
-                    log=args.get("log"),
-                    ntp=args.get("ntp"),
-                    experimental=args.get("experimental"),
-                    included_process_irs=args.get("included_process_irs"),
-                    ruleset_url=args.get("ruleset_url"),
-                    dial_fields=args.get("dial_fields"),
-                    add_resolve_action=args.get("add_resolve_action"),
+        dst_dir = os.path.join(dst, gen_info["name"])
+    else:
+        raise ValueError(f"Unsupported generate type: {gen_info['type']}.")
+    if stale:
+        gen.generate(dst_dir)
+    generators[gen_info["name"]] = gen
+
+
+def _generation_chains(generate_info: list[dict[str, Any]]) -> list[list[dict[str, Any]]]:
+    # Entries are independent except for sing-box `base` references, which form trees. Each tree
+    # is one chain generated in declaration order, so a base is always generated before (and in
+    # the same process as) the entries deriving from it.
+    chains: dict[str, list[dict[str, Any]]] = {}
+    roots: dict[str, str] = {}
+    for gen_info in generate_info:
+        if base := gen_info.get("base"):
+            if base not in roots:
+                raise ValueError(
+                    f"Base generator {base} of {gen_info['name']} is not defined before."
                 )
-            dst_dir = os.path.join(dst, gen_info["name"])
-            gen.generate(dst_dir)
+            root = roots[base]
         else:
-            raise ValueError(f"Unsupported generate type: {gen_info['type']}.")
-        generators[gen_info["name"]] = gen
+            root = gen_info["name"]
+        roots[gen_info["name"]] = root
+        chains.setdefault(root, []).append(gen_info)
+    return list(chains.values())
+
+
+def _fingerprints(
+    generate_info: list[dict[str, Any]],
+    src: str,
+    dst: str,
+    proxies: Sequence[ProxyBase],
+    per_region_proxies: Sequence[ProxyBase | ProxyGroupBase],
+    proxy_groups: Sequence[ProxyGroupBase],
+    rewrites: Sequence[RewriteBase] | None,
+) -> dict[str, str]:
+    # An entry's output only depends on its block and those of its bases, the payloads these
+    # blocks reference (e.g., sing-box DNS rule sets), the parsed proxies, groups and rewrites,
+    # and conf-gen itself, which natively encodes the sing-box rule sets.
+    shared = fingerprint(code_fingerprint(), src, proxies, per_region_proxies, proxy_groups)
+    lineages: dict[str, list[dict[str, Any]]] = {}
+    ret: dict[str, str] = {}
+    for gen_info in generate_info:
+        lineage = lineages.get(gen_info.get("base") or "", []) + [gen_info]
+        lineages[gen_info["name"]] = lineage
+        payloads = [fetch(r).hexdigest() for r in collect_remote_resources({"generates": lineage})]
+        ret[gen_info["name"]] = fingerprint(
+            shared,
+            lineage,
+            payloads,
+            rewrites if gen_info["type"] == "quantumult" else None,
+        )
+    return ret
+
+
+def _generate_entries(
+    entries: list[dict[str, Any]], stale: set[str], shared_args: tuple[Any, ...]
+) -> dict[str, dict[str, str]]:
+    # Generates the stale entries and returns the files each wrote. Bases of stale entries are
+    # built (but not generated) even if they are fresh, since stale entries derive from them.
+    needed = set(stale)
+    for gen_info in reversed(entries):
+        if gen_info["name"] in needed and (base := gen_info.get("base")):
+            needed.add(base)
+    generators: dict[str, GeneratorBase] = {}
+    outputs: dict[str, dict[str, str]] = {}
+    for gen_info in entries:
+        if (name := gen_info["name"]) in needed:
+            _generate_one(gen_info, generators, name in stale, *shared_args)
+            if name in stale:
+                outputs[name] = generators[name].outputs
+    return outputs
+
+
+# Inputs shared with the workers, each of which unpickles them once instead of once per chain.
+_SHARED_ARGS: tuple[Any, ...] | None = None
+
+
+def _init_worker(shared_args: tuple[Any, ...], fetcher: Fetcher) -> None:
+    global _SHARED_ARGS
+    _SHARED_ARGS = shared_args
+    set_fetcher(fetcher)
+
+
+def _generate_chain(
+    chain: list[dict[str, Any]], stale: set[str]
+) -> tuple[dict[str, dict[str, str]], tuple[dict[str, LockedPayload], dict[str, str]] | None]:
+    assert _SHARED_ARGS is not None
+    outputs = _generate_entries(chain, stale, _SHARED_ARGS)
+    # Payloads first fetched by this worker, e.g., the sing-box release, are handed back to the
+    # parent's lockfile.
+    if (lockfile := current_lockfile()) is not None:
+        return outputs, (lockfile.payloads, lockfile.redirects)
+    return outputs, None
+
+
+def generate_conf(
+    generate_info: list[dict[str, Any]],
+    src: str,
+    dst: str,
+    proxies: Sequence[ProxyBase],
+    per_region_proxies: Sequence[ProxyBase | ProxyGroupBase],
+    proxy_groups: Sequence[ProxyGroupBase],
+    rewrites: Sequence[RewriteBase] | None = None,
+    max_workers: int | None = None,
+    force: bool = False,
+    only: Collection[str] | None = None,
+) -> None:
+    shared_args = (src, dst, proxies, per_region_proxies, proxy_groups, rewrites)
+    # Entries whose inputs and outputs are unchanged since the last run into `dst` are skipped,
+    # and so are those not in `only` when given, though bases of the others are still built.
+    fingerprints = _fingerprints(generate_info, *shared_args)
+    if only is not None and (unknown := set(only) - set(fingerprints)):
+        raise ValueError(f"Unknown generates: {', '.join(sorted(unknown))}.")
+    selected = [n for n in fingerprints if only is None or n in only]
+    manifest = Manifest.load(dst)
+    stale = {n for n in selected if force or not manifest.is_fresh(n, fingerprints[n])}
+    if skipped := [n for n in selected if n not in stale]:
+        print(f"Skipped {len(skipped)} unchanged generates: {', '.join(skipped)}.")
+
+    chains = [c for c in _generation_chains(generate_info) if any(g["name"] in stale for g in c)]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(chains))
+    outputs: dict[str, dict[str, str]] = {}
+    # Chains run concurrently on workers, so the wall time is roughly the slowest chain. Workers
+    # are not forked from this process, whose fetch threads may hold locks, but from a fork server
+    # (or spawned), and they get the inputs and the fetcher with its payloads pickled. With a
+    # single worker everything is generated in this process.
+    if max_workers <= 1:
+        outputs = _generate_entries(generate_info, stale, shared_args)
+    else:
+        mp_context: BaseContext
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+            mp_context.set_forkserver_preload([__name__])
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(shared_args, current_fetcher()),
+        ) as pool:
+            # Longest chains first, they are most likely on the critical path.
+            futures = [
+                pool.submit(_generate_chain, c, stale)
+                for c in sorted(chains, key=len, reverse=True)
+            ]
+            for future in as_completed(futures):
+                chain_outputs, records = future.result()
+                outputs.update(chain_outputs)
+                if records is not None and (lockfile := current_lockfile()) is not None:
+                    lockfile.update(*records)
+
+    manifest.entries = {n: e for n, e in manifest.entries.items() if n in fingerprints}
+    for name, files in outputs.items():
+        manifest.record(name, fingerprints[name], files)
+    manifest.dump()
 
 
 __all__ = (
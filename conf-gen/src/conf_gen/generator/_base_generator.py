@@ -1,7 +1,13 @@
+import contextlib
+import hashlib
+import os
+import types
 from copy import copy
 from datetime import datetime
+from typing import IO
 from typing import Any
 from typing import ClassVar
+from typing import Iterator
 from typing import Sequence
 
 from conf_gen.proxy._base_proxy import ProxyBase
@@ -9,6 +15,53 @@ from conf_gen.proxy_group._base_proxy_group import ProxyGroupBase
 from pytz import timezone
 
 
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class OutputFile:
+    # Streams to a temporary file next to `path`, which replaces `path` through a rename on exit,
+    # so readers never see partial outputs. If the content didn't change, `path` is left alone
+    # along with its mtime, which downstream caches key on. `digest` is the content's sha256.
+
+    def __init__(self, path: str, binary: bool = False) -> None:
+        self.path = path
+        self.binary = binary
+        self.digest: str | None = None
+        self._tmp = f"{path}.{os.getpid()}.tmp"
+
+    def __enter__(self) -> IO[Any]:
+        if self.binary:
+            self._f: IO[Any] = open(self._tmp, "wb")
+        else:
+            self._f = open(self._tmp, "w", encoding="utf-8", newline="\n")
+        return self._f
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: types.TracebackType | None,
+    ) -> None:
+        self._f.close()
+        if exc_type is not None:
+            os.unlink(self._tmp)
+            return
+        self.digest = file_digest(self._tmp)
+        if os.path.isfile(self.path) and file_digest(self.path) == self.digest:
+            os.unlink(self._tmp)
+        else:
+            os.replace(self._tmp, self.path)
+
+
+def write_output(path: str, content: str | bytes) -> str:
+    with (output := OutputFile(path, binary=isinstance(content, bytes))) as f:
+        f.write(content)
+    assert output.digest is not None
+    return output.digest
+
+
 class GeneratorBase:
 
     _SUPPORTED_PROXY_TYPE: ClassVar[tuple[type[ProxyBase], ...] | None] = None
@@ -21,11 +74,16 @@ class GeneratorBase:
         proxy_groups: Sequence[ProxyGroupBase],
     ) -> None:
         self.src_file = src_file
+        # Paths and sha256 digests of the files written by `generate`.
+        self.outputs: dict[str, str] = {}
         self._proxies: list[ProxyBase] = []
         self._proxy_groups: list[ProxyGroupBase] = []
         proxy_names = set(pg.name for pg in proxy_groups).union(self._DEFAULT_PROXY_NAMES)
         for proxy in proxies:
-            if self._SUPPORTED_PROXY_TYPE is not None and type(proxy) in self._SUPPORTED_PROXY_TYPE:
+            if (
+                self._SUPPORTED_PROXY_TYPE is not None
+                and type(proxy) in self._SUPPORTED_PROXY_TYPE
+            ):
                 self._proxies.append(proxy)
                 proxy_names.add(proxy.name)
         for proxy_group in proxy_groups:
@@ -41,6 +99,18 @@ class GeneratorBase:
         info += "# " + "=" * 78
         return info
 
+    @contextlib.contextmanager
+    def _open_output(self, path: str, binary: bool = False) -> Iterator[IO[Any]]:
+        output = OutputFile(path, binary=binary)
+        with output as f:
+            yield f
+        assert output.digest is not None
+        self.outputs[path] = output.digest
+
+    def _write_output(self, path: str, content: str | bytes) -> None:
+        with self._open_output(path, binary=isinstance(content, bytes)) as f:
+            f.write(content)
+
     def generate(self, file: str) -> None:
         raise NotImplementedError()
 
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+from functools import cache
+from pathlib import Path
+from typing import Any
+from typing import Final
+from typing import Sequence
+
+import common
+from conf_gen.generator._base_generator import file_digest
+from conf_gen.generator._base_generator import write_output
+from conf_gen.rule._base_ir import IRBase
+
+MANIFEST_FILE: Final[str] = ".conf-gen-manifest.json"
+MANIFEST_VERSION: Final[int] = 1
+
+
+def _tagged(digest: "hashlib._Hash", tag: bytes, data: bytes) -> None:
+    digest.update(b"%s%d:" % (tag, len(data)))
+    digest.update(data)
+
+
+def _digest(obj: Any) -> bytes:
+    digest = hashlib.sha256()
+    _update(digest, obj)
+    return digest.digest()
+
+
+def _update(digest: "hashlib._Hash", obj: Any) -> None:
+    # Feeds a type-tagged, length-prefixed encoding of `obj` that only depends on content, not
+    # on object identities, hash seeds or how filters are stored, so equal inputs always produce
+    # equal fingerprints. Values are fed one at a time, large groups are never serialized whole.
+    # Unordered containers are fed in the order of their entries' digests.
+    if obj is None:
+        digest.update(b"N")
+    elif isinstance(obj, bool):
+        digest.update(b"T" if obj else b"F")
+    elif isinstance(obj, int):
+        _tagged(digest, b"i", str(obj).encode("ascii"))
+    elif isinstance(obj, float):
+        _tagged(digest, b"f", repr(obj).encode("ascii"))
+    elif isinstance(obj, str):
+        _tagged(digest, b"s", obj.encode("utf-8"))
+    elif isinstance(obj, (bytes, bytearray)):
+        _tagged(digest, b"b", bytes(obj))
+    elif isinstance(obj, IRBase):
+        digest.update(b"R")
+        for field in (type(obj).__qualname__, obj._val, obj._resolve):
+            _update(digest, field)
+    elif isinstance(obj, dict):
+        items = sorted((_digest(k), v) for k, v in obj.items())
+        digest.update(b"d%d:" % len(items))
+        for key, value in items:
+            digest.update(key)
+            _update(digest, value)
+    elif isinstance(obj, (set, frozenset)):
+        digest.update(b"e%d:" % len(obj))
+        for item in sorted(_digest(v) for v in obj):
+            digest.update(item)
+    elif isinstance(obj, Sequence):
+        digest.update(b"l%d:" % len(obj))
+        for item in obj:
+            _update(digest, item)
+    elif hasattr(obj, "__dict__"):
+        _tagged(digest, b"o", type(obj).__qualname__.encode("utf-8"))
+        _update(digest, vars(obj))
+    else:
+        raise TypeError(f"Cannot fingerprint {type(obj).__qualname__} objects")
+
+
+def fingerprint(*inputs: Any) -> str:
+    digest = hashlib.sha256()
+    _update(digest, inputs)
+    return digest.hexdigest()
+
+
+@cache
+def code_fingerprint() -> str:
+    # Any change to conf-gen itself, or to the `common` package it builds on (e.g., its HTTP
+    # session), may change what it generates.
+    digest = hashlib.sha256()
+    for package in (Path(__file__).parents[1], Path(common.__file__).parent):
+        for path in sorted(package.rglob("*.py")):
+            digest.update(f"{package.name}/{path.relative_to(package)}\0".encode("utf-8"))
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+class Manifest:
+    # Records, per generate entry, the fingerprint of its inputs and the digests of the files it
+    # wrote (relative to the output directory). Entries whose fingerprint and files are unchanged
+    # are not generated again.
+
+    def __init__(self, dst: str, entries: dict[str, dict[str, Any]] | None = None) -> None:
+        self.dst = dst
+        self.entries = entries or {}
+
+    @classmethod
+    def load(cls, dst: str) -> "Manifest":
+        try:
+            with open(os.path.join(dst, MANIFEST_FILE), "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return cls(dst)
+        if not isinstance(obj, dict) or obj.get("version") != MANIFEST_VERSION:
+            return cls(dst)
+        return cls(dst, obj["entries"])
+
+    def dump(self) -> None:
+        obj = {
+            "version": MANIFEST_VERSION,
+            "entries": {k: self.entries[k] for k in sorted(self.entries)},
+        }
+        os.makedirs(self.dst, exist_ok=True)
+        write_output(
+            os.path.join(self.dst, MANIFEST_FILE), json.dumps(obj, indent=2, ensure_ascii=False)
+        )
+
+    def is_fresh(self, name: str, fingerprint: str) -> bool:
+        if (entry := self.entries.get(name)) is None or entry["fingerprint"] != fingerprint:
+            return False
+        for path, digest in entry["files"].items():
+            path = os.path.join(self.dst, path)
+            if not os.path.isfile(path) or file_digest(path) != digest:
+                return False
+        return True
+
+    def record(self, name: str, fingerprint: str, outputs: dict[str, str]) -> None:
+        files = {os.path.relpath(p, self.dst): d for p, d in outputs.items()}
+        self.entries[name] = {"fingerprint": fingerprint, "files": dict(sorted(files.items()))}
@@ -0,0 +1,56 @@
+import ipaddress
+from typing import Iterable
+from typing import Sequence
+
+# The matchers shared by the binary rule formats: mihomo's MRS copies both its domain set and
+# its CIDR set from sing-box's SRS, they only differ in how the pieces are framed.
+
+
+def _set_bit(words: list[int], i: int) -> None:
+    while len(words) <= i >> 6:
+        words.append(0)
+    words[i >> 6] |= 1 << (i & 63)
+
+
+def succinct_set(keys: Sequence[bytes]) -> tuple[list[int], list[int], bytes]:
+    # A succinct trie of the sorted, distinct `keys`, built like sing-box's `newSuccinctSet`:
+    # nodes are numbered breadth-first, `leaves` marks the nodes ending a key and the label
+    # bitmap has a 0 per child label followed by a 1 per node. Bitmaps are 64-bit words.
+    leaves: list[int] = []
+    label_bitmap: list[int] = []
+    labels = bytearray()
+    queue = [(0, len(keys), 0)]
+    label_index = 0
+    for node, (start, end, col) in enumerate(queue):
+        if start < end and col == len(keys[start]):
+            start += 1
+            _set_bit(leaves, node)
+        j = start
+        while j < end:
+            first = j
+            label = keys[first][col]
+            while j < end and keys[j][col] == label:
+                j += 1
+            queue.append((first, j, col + 1))
+            labels.append(label)
+            label_index += 1
+        _set_bit(label_bitmap, label_index)
+        label_index += 1
+    return leaves, label_bitmap, bytes(labels)
+
+
+def ip_ranges(payload: Iterable[str]) -> dict[int, list[list[int]]]:
+    # The sorted and merged address ranges of the CIDRs (or addresses) per IP version, as
+    # netipx's `IPSet` holds them.
+    ranges: dict[int, list[list[int]]] = {4: [], 6: []}
+    for entry in sorted(
+        (ipaddress.ip_network(entry, strict=False) for entry in payload),
+        key=lambda network: (network.version, int(network.network_address)),
+    ):
+        first, last = int(entry.network_address), int(entry.broadcast_address)
+        merged = ranges[entry.version]
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return ranges
@@ -1,10 +1,21 @@
 import os
+import re
+import struct
 from copy import copy
+from typing import IO
 from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import Literal
 from typing import Sequence
+from urllib.parse import urljoin
+from urllib.parse import urlparse
 
 import yaml
+from conf_gen.fetch.cache import zstd
 from conf_gen.generator._base_generator import GeneratorBase
+from conf_gen.generator._matchers import ip_ranges
+from conf_gen.generator._matchers import succinct_set
 from conf_gen.proxy import ProxyBase
 from conf_gen.proxy import ShadowSocksProxy
 from conf_gen.proxy import Socks5Proxy
@@ -14,6 +25,220 @@ from conf_gen.proxy import VMessProxy
 from conf_gen.proxy import VMessWebSocketProxy
 from conf_gen.proxy_group._base_proxy_group import ProxyGroupBase
 from conf_gen.proxy_group.selective_proxy_group import SelectProxyGroup
+from conf_gen.rule._base_ir import RuleToken
+
+# libyaml emits the same text as the pure-Python emitter, only several times faster, except that
+# it escapes characters beyond the BMP (e.g., flag emojis in group names) even with allow_unicode
+# and that NEL is a line break to the pure-Python emitter only. Pieces containing either, or
+# mapping keys that only libyaml writes as simple keys (empty ones and those near the
+# 128-character limit, which libyaml counts in bytes), are left to the pure-Python emitter.
+_LIBYAML_DIVERGENT = re.compile("[\x85\U00010000-\U0010ffff]")
+_SIMPLE_KEY_LENGTH = 32
+# Top-level sequences that may hold tens of thousands of items.
+_STREAMED_KEYS = ("payload", "proxies", "rules")
+_STREAMED_CHUNK_SIZE = 1024
+
+
+class _SafeDumper(yaml.SafeDumper):
+    # Pieces are dumped on their own, so an object shared between them (e.g., the same `alpn`
+    # list of many proxies) can't be anchored in one and aliased in another. It is written out
+    # wherever it appears instead.
+    def ignore_aliases(self, data: Any) -> bool:
+        return True
+
+
+_YAML_DUMPER: type = _SafeDumper
+if hasattr(yaml, "CSafeDumper"):
+
+    class _CSafeDumper(yaml.CSafeDumper):
+        def ignore_aliases(self, data: Any) -> bool:
+            return True
+
+    _YAML_DUMPER = _CSafeDumper
+
+
+def _strings(obj: Any, keys: list[str]) -> Iterator[str]:
+    # Yields the string values, mapping keys are collected separately.
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(key, str):
+                keys.append(key)
+            yield from _strings(value, keys)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            yield from _strings(item, keys)
+
+
+def _dump_yaml_piece(obj: Any, stream: IO[str], Dumper: type) -> None:
+    if Dumper is not _SafeDumper:
+        keys: list[str] = []
+        text = "\n".join(_strings(obj, keys))
+        if (
+            not all(0 < len(key) < _SIMPLE_KEY_LENGTH for key in keys)
+            or _LIBYAML_DIVERGENT.search(text)
+            or _LIBYAML_DIVERGENT.search("\n".join(keys))
+        ):
+            Dumper = _SafeDumper
+    yaml.dump(obj, stream, Dumper=Dumper, allow_unicode=True, line_break="\n")
+
+
+def dump_yaml(conf: dict[str, Any], stream: IO[str], Dumper: type = _YAML_DUMPER) -> None:
+    # Writes the same text as `yaml.dump(conf, stream, _SafeDumper)`, but the large sequences
+    # are represented and emitted a chunk at a time instead of as part of one document tree. Keys
+    # are sorted and block sequences in mappings are not indented, so a top-level `key: [...]` is
+    # `key:` followed by the items exactly as they are dumped on their own.
+    for key in sorted(conf):
+        value = conf[key]
+        if key in _STREAMED_KEYS and isinstance(value, list) and value:
+            stream.write(f"{key}:\n")
+            for i in range(0, len(value), _STREAMED_CHUNK_SIZE):
+                _dump_yaml_piece(value[i : i + _STREAMED_CHUNK_SIZE], stream, Dumper)
+        else:
+            _dump_yaml_piece({key: value}, stream, Dumper)
+
+
+# Rules that can be moved into rule providers, by prefix, and the behavior of those providers.
+# Domain and IP-CIDR providers are matched through Clash's domain trie and CIDR set.
+_RULE_PROVIDER_BEHAVIORS = {
+    "DOMAIN": "domain",
+    "DOMAIN-SUFFIX": "domain",
+    "IP-CIDR": "ipcidr",
+    "IP-CIDR6": "ipcidr",
+    "DOMAIN-KEYWORD": "classical",
+    "DOMAIN-WILDCARD": "classical",
+    "PROCESS-NAME": "classical",
+    "SRC-IP-CIDR": "classical",
+    "SRC-PORT": "classical",
+    "DST-PORT": "classical",
+}
+DEFAULT_RULE_PROVIDER_MIN_SIZE = 64
+_RULE_PROVIDER_INTERVAL = 86400
+
+
+def _rule_provider_entry(prefix: str, val: str, behavior: str) -> str:
+    if behavior == "domain":
+        return val if prefix == "DOMAIN" else f"+.{val}"
+    elif behavior == "ipcidr":
+        return val
+    else:
+        return f"{prefix},{val}"
+
+
+def extract_rule_providers(
+    sections: Sequence[Sequence[tuple[RuleToken, str]]],
+    min_size: int,
+) -> tuple[list[str], dict[str, tuple[str, list[str]]]]:
+    # Returns the rules with every policy's domain, IP-CIDR and classical rules of a section
+    # replaced by one `RULE-SET` rule if there are at least `min_size` of them, and the payloads
+    # of those rule sets by provider name, along with their behaviors. A policy's rules within a
+    # section are consecutive, so they may be reordered, and each `RULE-SET` rule takes the place
+    # of the first rule it replaces. Rules requiring resolution are in the last section.
+    rules: list[str] = []
+    providers: dict[str, tuple[str, list[str]]] = {}
+    for i, section in enumerate(sections):
+        suffix = ".resolve" if 0 < i else ""
+        start = 0
+        while start < len(section):
+            policy = section[start][1]
+            end = start
+            buckets: dict[str, list[tuple[RuleToken, str]]] = {}
+            while end < len(section) and section[end][1] == policy:
+                token = section[end][0]
+                behavior = _RULE_PROVIDER_BEHAVIORS.get(token.prefix)
+                # Classical payloads would need `no-resolve` on the individual rules.
+                if behavior and token.val is not None:
+                    if behavior != "classical" or not token.no_resolve:
+                        entry = _rule_provider_entry(token.prefix, token.val, behavior)
+                        buckets.setdefault(behavior, []).append((token, entry))
+                end += 1
+            # Normalize provider names to be compliant with URLs, the same as sing-box rule sets.
+            name_prefix = re.sub(r"(\s+\&\s+)|(\s+)", "_", policy) + suffix
+            extracted: dict[RuleToken, str | None] = {}
+            for behavior, bucket in buckets.items():
+                if len(bucket) < min_size:
+                    continue
+                name = f"{name_prefix}.{behavior}"
+                if name in providers:
+                    raise ValueError(f"Rule provider {name} of policy {policy} is not unique")
+                providers[name] = (behavior, [entry for _, entry in bucket])
+                # Whether IP rules resolve hostnames is the same within a section.
+                first_token = bucket[0][0]
+                rule_set = f"RULE-SET,{name},{policy}"
+                extracted[first_token] = rule_set + (
+                    ",no-resolve" if first_token.no_resolve else ""
+                )
+                extracted.update((token, None) for token, _ in bucket[1:])
+            for token, _ in section[start:end]:
+                if token not in extracted:
+                    rules.append(token.line(policy))
+                elif (rule := extracted[token]) is not None:
+                    rules.append(rule)
+            start = end
+    return rules, providers
+
+
+# Clash.Meta's binary rule provider format (`format: mrs`), a zstd frame of the magic bytes, the
+# behavior, the number of rules, the length of extra data (none) and the behavior's matcher in
+# the form mihomo loads without parsing. Only domain and ipcidr behaviors have one.
+_MRS_MAGIC = b"MRS\x01"
+_MRS_BEHAVIORS = {"domain": 0, "ipcidr": 1}
+_MRS_VERSION = b"\x01"
+_IPV4_MAPPED_PREFIX = bytes(10) + b"\xff\xff"
+
+
+def _mrs_words(words: Sequence[int]) -> bytes:
+    return struct.pack(f">q{len(words)}Q", len(words), *words)
+
+
+def _mrs_domain_set(payload: Iterable[str]) -> bytes:
+    # The succinct trie of the reversed domains, as mihomo's `DomainTrie.NewDomainSet` builds
+    # it. `+.example.com` is stored along with `example.com`, which it matches as well.
+    domains: set[str] = set()
+    for entry in payload:
+        domain = entry.lower()
+        if domain.startswith("+."):
+            domains.add(domain[2:])
+        domains.add(domain)
+    if not domains:
+        raise ValueError("MRS domain sets must not be empty")
+    leaves, label_bitmap, labels = succinct_set(sorted(d[::-1].encode() for d in domains))
+    return b"".join(
+        (
+            _MRS_VERSION,
+            _mrs_words(leaves),
+            _mrs_words(label_bitmap),
+            struct.pack(">q", len(labels)),
+            labels,
+        )
+    )
+
+
+def _mrs_ip_cidr_set(payload: Iterable[str]) -> bytes:
+    # Addresses are 16 bytes, IPv4 ones mapped into IPv6.
+    ranges = ip_ranges(payload)
+    chunks = [_MRS_VERSION, struct.pack(">q", len(ranges[4]) + len(ranges[6]))]
+    for first, last in ranges[4]:
+        chunks += (_IPV4_MAPPED_PREFIX, first.to_bytes(4), _IPV4_MAPPED_PREFIX, last.to_bytes(4))
+    for first, last in ranges[6]:
+        chunks += (first.to_bytes(16), last.to_bytes(16))
+    return b"".join(chunks)
+
+
+def encode_mrs(behavior: str, payload: Sequence[str]) -> bytes:
+    if zstd is None:
+        raise RuntimeError(
+            "Writing MRS rule providers requires zstd support, install the `zstd` extra."
+        )
+    if behavior == "domain":
+        matcher = _mrs_domain_set(payload)
+    elif behavior == "ipcidr":
+        matcher = _mrs_ip_cidr_set(payload)
+    else:
+        raise ValueError(f"MRS rule providers do not support {behavior=}")
+    header = _MRS_MAGIC + struct.pack(">Bqq", _MRS_BEHAVIORS[behavior], len(payload), 0)
+    return zstd.compress(header + matcher)  # type: ignore[no-any-return]
 
 
 class ClashGenerator(GeneratorBase):
@@ -33,6 +258,9 @@ class ClashGenerator(GeneratorBase):
         proxies: Sequence[ProxyBase],
         per_region_proxies: Sequence[ProxyBase | ProxyGroupBase],
         proxy_groups: Sequence[ProxyGroupBase],
+        rule_provider_url: str | None = None,
+        rule_provider_min_size: int = DEFAULT_RULE_PROVIDER_MIN_SIZE,
+        rule_provider_format: Literal["yaml", "mrs"] = "yaml",
         **general_options: Any,
     ) -> None:
         # Construct special group `PROXY` for clash.
@@ -44,6 +272,22 @@ class ClashGenerator(GeneratorBase):
         proxy_groups_list.insert(0, the_per_region_proxy_group)
         super().__init__(src_file, proxies, proxy_groups_list)
         self._general_options = general_options
+        # Large rule lists are written as rule provider files next to the config, to be served
+        # from this directory, instead of being inlined in `rules`.
+        if rule_provider_url and not urlparse(rule_provider_url).path.endswith("/"):
+            raise ValueError(
+                f"rule_provider_url must point to a directory, but got {rule_provider_url=}"
+            )
+        self._rule_provider_url = rule_provider_url or None
+        self._rule_provider_min_size = rule_provider_min_size
+        # Domain and ipcidr providers can be written in Clash.Meta's binary format instead.
+        if rule_provider_format not in ("yaml", "mrs"):
+            raise ValueError(f"invalid {rule_provider_format=}, expect yaml or mrs")
+        if rule_provider_format == "mrs" and zstd is None:
+            raise RuntimeError(
+                "Writing MRS rule providers requires zstd support, install the `zstd` extra."
+            )
+        self._rule_provider_format = rule_provider_format
 
     def generate(self, file: str) -> None:
         conf = {}
@@ -52,37 +296,68 @@ class ClashGenerator(GeneratorBase):
         conf["proxy-groups"] = [g.clash_proxy_group for g in self._proxy_groups]
 
         # Ensure rules that require hostname resolving go to the ending of Clash rules.
-        no_resolve_rules = []
-        resolve_rules = []
+        no_resolve_rules: list[tuple[RuleToken, str]] = []
+        resolve_rules: list[tuple[RuleToken, str]] = []
         for g in self._proxy_groups:
-            no_resolve_r, resolve_r = g.clash_rules
-            no_resolve_rules += no_resolve_r
-            resolve_rules += resolve_r
-        conf["rules"] = no_resolve_rules + resolve_rules
+            no_resolve_t, resolve_t = g.clash_tokens
+            no_resolve_rules += ((t, g.name) for t in no_resolve_t)
+            resolve_rules += ((t, g.name) for t in resolve_t)
 
         # Deduplicate rules. Clash performs rule traversal in O(N) thus this could improve perf.
         num_duplicates = 0
         existing_matchers = set()
-        deduplicated_rules = []
-        for rule in conf["rules"]:
-            matcher = ",".join(rule.split(",")[:2])
-            if matcher not in existing_matchers:
-                existing_matchers.add(matcher)
-                deduplicated_rules.append(rule)
-            else:
-                num_duplicates += 1
+        sections: list[list[tuple[RuleToken, str]]] = [[], []]
+        for section, rules in zip(sections, (no_resolve_rules, resolve_rules)):
+            for token, policy in rules:
+                matcher = token.matcher(policy)
+                if matcher not in existing_matchers:
+                    existing_matchers.add(matcher)
+                    section.append((token, policy))
+                else:
+                    num_duplicates += 1
         if 0 < num_duplicates:
             print(f"Filtered out {num_duplicates} duplications in Clash rules.")
-            conf["rules"] = deduplicated_rules
 
         base, _ = os.path.split(file)
         os.makedirs(base, exist_ok=True)
-        with open(file, "w", encoding="utf-8") as f:
-            f.write(f"{self.header}\n")
-            yaml.dump(
-                conf,
-                f,
-                Dumper=yaml.SafeDumper,
-                allow_unicode=True,
-                line_break="\n",
+        if self._rule_provider_url:
+            conf["rules"], providers = extract_rule_providers(
+                sections, self._rule_provider_min_size
             )
+            provider_dir = os.path.splitext(file)[0]
+            os.makedirs(provider_dir, exist_ok=True)
+            rule_providers = conf.setdefault("rule-providers", {})
+            num_extracted = 0
+            for name, (behavior, payload) in providers.items():
+                if name in rule_providers:
+                    raise ValueError(f"Rule provider {name} is already defined")
+                if self._rule_provider_format == "mrs" and behavior in _MRS_BEHAVIORS:
+                    fmt = "mrs"
+                else:
+                    fmt = "yaml"
+                rule_providers[name] = {
+                    "type": "http",
+                    "behavior": behavior,
+                    "url": urljoin(self._rule_provider_url, f"{name}.{fmt}"),
+                    "path": f"./rule-providers/{name}.{fmt}",
+                    "interval": _RULE_PROVIDER_INTERVAL,
+                }
+                # Without the timestamped header, unchanged providers keep their content.
+                provider_file = os.path.join(provider_dir, f"{name}.{fmt}")
+                if fmt == "mrs":
+                    rule_providers[name]["format"] = "mrs"
+                    self._write_output(provider_file, encode_mrs(behavior, payload))
+                else:
+                    with self._open_output(provider_file) as f:
+                        dump_yaml({"payload": payload}, f)
+                num_extracted += len(payload)
+            if providers:
+                print(f"Moved {num_extracted} Clash rules into {len(providers)} rule providers.")
+        else:
+            conf["rules"] = [
+                token.line(policy) for section in sections for token, policy in section
+            ]
+
+        with self._open_output(file) as f:
+            f.write(f"{self.header}\n")
+            dump_yaml(conf, f)
@@ -1,8 +1,11 @@
 import os
+import re
 from copy import copy
 from typing import Any
 from typing import ClassVar
 from typing import Sequence
+from urllib.parse import urljoin
+from urllib.parse import urlparse
 
 from conf_gen.generator._base_generator import GeneratorBase
 from conf_gen.proxy import ProxyBase
@@ -13,6 +16,10 @@ from conf_gen.proxy import VMessWebSocketProxy
 from conf_gen.proxy_group._base_proxy_group import ProxyGroupBase
 from conf_gen.proxy_group.selective_proxy_group import SelectProxyGroup
 from conf_gen.rewrite._base_rewrite import RewriteBase
+from conf_gen.rule._base_ir import RuleToken
+
+DEFAULT_FILTER_REMOTE_MIN_SIZE = 64
+_FILTER_REMOTE_INTERVAL = 86400
 
 
 class QuantumultGenerator(GeneratorBase):
@@ -44,6 +51,8 @@ class QuantumultGenerator(GeneratorBase):
         per_region_proxies: Sequence[ProxyBase | ProxyGroupBase],
         proxy_groups: Sequence[ProxyGroupBase],
         rewrites: Sequence[RewriteBase],
+        filter_remote_url: str | None = None,
+        filter_remote_min_size: int = DEFAULT_FILTER_REMOTE_MIN_SIZE,
         **additional_sections: Any,
     ) -> None:
         # Quantumult-X has a built-in "PROXY" selective group that contains all servers, thus we
@@ -59,6 +68,17 @@ class QuantumultGenerator(GeneratorBase):
         super().__init__(src_file, proxies, proxy_groups_list)
         self._rewrites = rewrites
         self._additional_sections = additional_sections
+        # Groups with many filters get a filter list next to the config, to be served from this
+        # directory and referenced in `filter_remote`, instead of being inlined in `filter_local`.
+        if filter_remote_url:
+            if not urlparse(filter_remote_url).path.endswith("/"):
+                raise ValueError(
+                    f"filter_remote_url must point to a directory, but got {filter_remote_url=}"
+                )
+            if "filter_remote" in additional_sections:
+                raise ValueError("filter_remote cannot be given along with filter_remote_url")
+        self._filter_remote_url = filter_remote_url or None
+        self._filter_remote_min_size = filter_remote_min_size
         for group in self._proxy_groups:
             # Replace the default "PROXY" name. The `group` has been copied in __init__.
             for i, p in enumerate(group._proxies):
@@ -83,11 +103,42 @@ class QuantumultGenerator(GeneratorBase):
 
         return ret
 
+    def _write_filter_lists(
+        self, file: str, remote_filters: list[tuple[ProxyGroupBase, list[str]]]
+    ) -> str:
+        # Writes each group's filter list and returns the `filter_remote` entries referring to
+        # them. Lists keep their filters' policies, which `force-policy` enforces regardless.
+        assert self._filter_remote_url is not None
+        list_dir = os.path.splitext(file)[0]
+        os.makedirs(list_dir, exist_ok=True)
+        entries: list[str] = []
+        names: set[str] = set()
+        for g, filters in remote_filters:
+            # Normalize list names to be compliant with URLs, the same as sing-box rule sets.
+            name = re.sub(r"(\s+\&\s+)|(\s+)", "_", g.name)
+            if name in names:
+                raise ValueError(f"Filter list {name} of group {g.name} is not unique")
+            names.add(name)
+            # Without the timestamped header, unchanged lists keep their content.
+            self._write_output(os.path.join(list_dir, f"{name}.list"), "\n".join(filters) + "\n")
+            url = urljoin(self._filter_remote_url, f"{name}.list")
+            entries.append(
+                f"{url}, tag={g.name}, force-policy={g.name}, "
+                f"update-interval={_FILTER_REMOTE_INTERVAL}, opt-parser=false, enabled=true\n"
+            )
+        if remote_filters:
+            num_filters = sum(len(filters) for _, filters in remote_filters)
+            print(
+                f"Moved {num_filters} Quantumult-x filters into {len(remote_filters)} remote "
+                "filter lists."
+            )
+        return "".join(entries)
+
     def generate(self, file: str) -> None:
         base, _ = os.path.split(file)
         os.makedirs(base, exist_ok=True)
         missing_sections = set(self._MANDATORY_SECTIONS)
-        with open(file, "w", encoding="utf-8") as f:
+        with self._open_output(file) as f:
             # Header.
             f.write(f"{self.header}\n")
             # Additional key-value items.
@@ -119,23 +170,56 @@ class QuantumultGenerator(GeneratorBase):
             missing_sections.remove("filter_local")
             no_resolve_filters: list[str] = []
             resolve_filters: list[str] = []
+            remote_filters: list[tuple[ProxyGroupBase, list[str]]] = []
+            grouped_filters: list[
+                tuple[ProxyGroupBase, list[tuple[RuleToken, str]], list[tuple[RuleToken, str]]]
+            ] = []
             existing_matchers: set[str] = set()
             num_duplications = 0
             for g in self._proxy_groups:
-                for filters, filters_in_g in zip(
-                    [no_resolve_filters, resolve_filters], g.quantumult_filters
-                ):
-                    for filter in filters_in_g:
-                        matcher = ",".join(filter.split(",")[:2])
+                group_filters: tuple[list[tuple[RuleToken, str]], ...] = ([], [])
+                for filters, tokens_in_g in zip(group_filters, g.quantumult_tokens):
+                    for token in tokens_in_g:
+                        matcher = token.matcher(g.name)
                         if matcher not in existing_matchers:
                             existing_matchers.add(matcher)
-                            filters.append(filter)
+                            filters.append((token, token.line(g.name)))
                         else:
                             num_duplications += 1
+                grouped_filters.append((g, group_filters[0], group_filters[1]))
+            # Filter lists match after all of `filter_local`, so only a tail of the match order can
+            # be moved without changing routing: the no-resolve filters of the first large group
+            # and of every group after it. Filters resolving hostnames stay local after all of
+            # them, hence nothing is moved if there are any. Filters without a value, i.e., final,
+            # match last anyway and stay local too.
+            first_moved = len(grouped_filters)
+            if self._filter_remote_url is not None and not any(
+                t.val is not None
+                for _, _, resolve_in_g in grouped_filters
+                for t, _ in resolve_in_g
+            ):
+                min_size = self._filter_remote_min_size
+                for i, (_, no_resolve_in_g, _) in enumerate(grouped_filters):
+                    if min_size <= sum(t.val is not None for t, _ in no_resolve_in_g):
+                        first_moved = i
+                        break
+            for i, (g, no_resolve_in_g, resolve_in_g) in enumerate(grouped_filters):
+                moved = first_moved <= i
+                movable = [line for t, line in no_resolve_in_g if t.val is not None]
+                if moved and movable:
+                    remote_filters.append((g, movable))
+                no_resolve_filters += (
+                    line for t, line in no_resolve_in_g if not moved or t.val is None
+                )
+                resolve_filters += (line for _, line in resolve_in_g)
             if 0 < num_duplications:
                 print(f"Filtered out {num_duplications} duplications in Quantumult-x filters.")
             f.write("\n".join(no_resolve_filters) + "\n")
             f.write("\n".join(resolve_filters) + "\n")
+            if self._filter_remote_url:
+                f.write("[filter_remote]\n")
+                missing_sections.remove("filter_remote")
+                f.write(self._write_filter_lists(file, remote_filters))
             # Rewrite.
             f.write("[rewrite_local]\n")
             missing_sections.remove("rewrite_local")
@@ -1,20 +1,26 @@
 import io
-import itertools
 import json
+import multiprocessing
 import os
 import platform
 import random
 import re
 import shutil
 import stat
+import struct
 import subprocess
 import tarfile
 import tempfile
 import types
+import zlib
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
 from copy import copy
 from copy import deepcopy
 from pathlib import Path
 from typing import Any
+from typing import Callable
 from typing import Literal
 from typing import Self
 from typing import Sequence
@@ -22,8 +28,13 @@ from urllib.parse import urljoin
 from urllib.parse import urlparse
 from warnings import warn
 
-import requests
+from conf_gen.fetch import RemoteResource
+from conf_gen.fetch import fetch
+from conf_gen.fetch import join_requests
+from conf_gen.fetch import resolve_redirect
 from conf_gen.generator._base_generator import GeneratorBase
+from conf_gen.generator._matchers import ip_ranges
+from conf_gen.generator._matchers import succinct_set
 from conf_gen.proxy import ProxyBase
 from conf_gen.proxy import ShadowSocks2022Proxy
 from conf_gen.proxy import ShadowSocksProxy
@@ -31,38 +42,14 @@ from conf_gen.proxy import TrojanProxy
 from conf_gen.proxy_group import ProxyGroupBase
 from conf_gen.proxy_group.fallback_proxy_group import FallbackProxyGroup
 from conf_gen.proxy_group.selective_proxy_group import SelectProxyGroup
+from conf_gen.rule._base_ir import SING_BOX_HEADLESS_RULE_FIELDS
 from conf_gen.rule.parser import parse_filter
 from conf_gen.rule.utils import group_sing_box_filters
+from conf_gen.rule.utils import prune_shadowed_sing_box_dst_ip_filters
 from conf_gen.rule.utils import split_sing_box_dst_ip_filters
 from packaging.version import Version
 from packaging.version import parse
 
-# TODO: Make this an attribute of rule IR.
-# https://sing-box.sagernet.org/configuration/rule-set/headless-rule/
-RULE_SET_COMPLIANT_IRS = frozenset(
-    [
-        "query_type",
-        "network",
-        "domain",
-        "domain_suffix",
-        "domain_keyword",
-        "domain_regex",
-        "source_ip_cidr",
-        "ip_cidr",
-        "source_port",
-        "source_port_range",
-        "port",
-        "port_range",
-        "process_name",
-        "process_path",
-        "process_path_regex",
-        "package_name",
-        "wifi_ssid",
-        "wifi_bssid",
-        "invert",
-    ]
-)
-
 
 def expand_filters_inplace(
     rule: Any,
@@ -126,7 +113,7 @@ def extract_ruleset_inplace(
         extracted_content = dict()
         num_rules = 0
         for k, v in rule.items():
-            if k in RULE_SET_COMPLIANT_IRS:
+            if k in SING_BOX_HEADLESS_RULE_FIELDS:
                 extracted_content[k] = v
                 num_rules += len(v) if isinstance(v, (list, tuple)) else 1
         if extracted_content and rules_per_set_minimum <= num_rules:
@@ -139,25 +126,323 @@ def extract_ruleset_inplace(
             return None
 
 
+# sing-box's binary rule set format (`format: binary`), the magic bytes and version followed by
+# the zlib stream of the rules as `sing-box rule-set compile` writes them: counts and lengths are
+# uvarints, numbers big-endian, and each item of a default rule is its type followed by its
+# values. Only the headless rule fields, i.e., those conf-gen extracts into rule sets, are
+# supported. Python's zlib does not deflate like Go's, so only the decompressed rules match.
+_SRS_MAGIC = b"SRS"
+_SRS_DEFAULT_RULE = 0
+_SRS_LOGICAL_RULE = 1
+_SRS_LOGICAL_MODES = {"and": 0, "or": 1}
+_SRS_ITEM_FINAL = 0xFF
+_SRS_DOMAIN_SET_VERSION = b"\x00"
+_SRS_IP_SET_VERSION = b"\x01"
+# Names of DNS query types as accepted by sing-box (miekg/dns' `StringToType`).
+_DNS_QUERY_TYPES = {
+    "A": 1,
+    "NS": 2,
+    "MD": 3,
+    "MF": 4,
+    "CNAME": 5,
+    "SOA": 6,
+    "MB": 7,
+    "MG": 8,
+    "MR": 9,
+    "NULL": 10,
+    "PTR": 12,
+    "HINFO": 13,
+    "MINFO": 14,
+    "MX": 15,
+    "TXT": 16,
+    "RP": 17,
+    "AFSDB": 18,
+    "X25": 19,
+    "ISDN": 20,
+    "RT": 21,
+    "NSAP-PTR": 23,
+    "SIG": 24,
+    "KEY": 25,
+    "PX": 26,
+    "GPOS": 27,
+    "AAAA": 28,
+    "LOC": 29,
+    "NXT": 30,
+    "EID": 31,
+    "NIMLOC": 32,
+    "SRV": 33,
+    "ATMA": 34,
+    "NAPTR": 35,
+    "KX": 36,
+    "CERT": 37,
+    "DNAME": 39,
+    "OPT": 41,
+    "APL": 42,
+    "DS": 43,
+    "SSHFP": 44,
+    "IPSECKEY": 45,
+    "RRSIG": 46,
+    "NSEC": 47,
+    "DNSKEY": 48,
+    "DHCID": 49,
+    "NSEC3": 50,
+    "NSEC3PARAM": 51,
+    "TLSA": 52,
+    "SMIMEA": 53,
+    "HIP": 55,
+    "NINFO": 56,
+    "RKEY": 57,
+    "TALINK": 58,
+    "CDS": 59,
+    "CDNSKEY": 60,
+    "OPENPGPKEY": 61,
+    "CSYNC": 62,
+    "ZONEMD": 63,
+    "SVCB": 64,
+    "HTTPS": 65,
+    "SPF": 99,
+    "UINFO": 100,
+    "UID": 101,
+    "GID": 102,
+    "UNSPEC": 103,
+    "NID": 104,
+    "L32": 105,
+    "L64": 106,
+    "LP": 107,
+    "EUI48": 108,
+    "EUI64": 109,
+    "NXNAME": 128,
+    "TKEY": 249,
+    "TSIG": 250,
+    "IXFR": 251,
+    "AXFR": 252,
+    "MAILB": 253,
+    "MAILA": 254,
+    "ANY": 255,
+    "URI": 256,
+    "CAA": 257,
+    "AVC": 258,
+    "AMTRELAY": 260,
+    "RESINFO": 261,
+    "TA": 32768,
+    "DLV": 32769,
+}
+
+
+def _uvarint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _listable(value: Any) -> list[Any]:
+    return value if isinstance(value, list) else [value]
+
+
+def _srs_strings(values: list[str]) -> bytes:
+    chunks = [_uvarint(len(values))]
+    for value in values:
+        chunks += (_uvarint(len(encoded := value.encode())), encoded)
+    return b"".join(chunks)
+
+
+def _srs_uint16s(values: list[int]) -> bytes:
+    return _uvarint(len(values)) + struct.pack(f">{len(values)}H", *values)
+
+
+def _srs_query_types(values: list[int | str]) -> bytes:
+    query_types: list[int] = []
+    for value in values:
+        if isinstance(value, str) and value not in _DNS_QUERY_TYPES:
+            raise ValueError(f"Unknown DNS query type: {value!r}")
+        query_types.append(_DNS_QUERY_TYPES[value] if isinstance(value, str) else value)
+    return _srs_uint16s(query_types)
+
+
+def _srs_words(words: Sequence[int]) -> bytes:
+    return _uvarint(len(words)) + struct.pack(f">{len(words)}Q", *words)
+
+
+def _srs_domain_set(domains: list[str], suffixes: list[str], version: int) -> bytes:
+    # The succinct trie of the reversed domains, where a trailing `\r` marks a suffix matching
+    # subdomains only (`.example.com`) and `\n` one matching the domain itself as well. Version
+    # 1 has no `\n` yet and stores such suffixes as the domain and its `\r` suffix instead.
+    seen: set[str] = set()
+    keys: set[str] = set()
+    for suffix in suffixes:
+        if suffix in seen:
+            continue
+        seen.add(suffix)
+        if suffix.startswith("."):
+            keys.add(suffix[::-1] + "\r")
+        elif version == 1:
+            keys.update((suffix[::-1], suffix[::-1] + ".\r"))
+        else:
+            keys.add(suffix[::-1] + "\n")
+    keys.update(domain[::-1] for domain in domains if domain not in seen)
+    leaves, label_bitmap, labels = succinct_set(sorted(key.encode() for key in keys))
+    return b"".join(
+        (
+            _SRS_DOMAIN_SET_VERSION,
+            _srs_words(leaves),
+            _srs_words(label_bitmap),
+            _uvarint(len(labels)),
+            labels,
+        )
+    )
+
+
+def _srs_ip_set(payload: list[str]) -> bytes:
+    ranges = ip_ranges(payload)
+    chunks = [_SRS_IP_SET_VERSION, struct.pack(">Q", len(ranges[4]) + len(ranges[6]))]
+    for size, version in ((4, 4), (16, 6)):
+        for first, last in ranges[version]:
+            chunks += (_uvarint(size), first.to_bytes(size), _uvarint(size), last.to_bytes(size))
+    return b"".join(chunks)
+
+
+# Items of default rules in the order they are written, `domain` also covers `domain_suffix`.
+_SRS_ITEMS: list[tuple[str, int, Callable[[list[Any]], bytes]]] = [
+    ("query_type", 0, _srs_query_types),
+    ("network", 1, _srs_strings),
+    ("domain", 2, _srs_strings),
+    ("domain_keyword", 3, _srs_strings),
+    ("domain_regex", 4, _srs_strings),
+    ("source_ip_cidr", 5, _srs_ip_set),
+    ("ip_cidr", 6, _srs_ip_set),
+    ("source_port", 7, _srs_uint16s),
+    ("source_port_range", 8, _srs_strings),
+    ("port", 9, _srs_uint16s),
+    ("port_range", 10, _srs_strings),
+    ("process_name", 11, _srs_strings),
+    ("process_path", 12, _srs_strings),
+    ("process_path_regex", 17, _srs_strings),
+    ("package_name", 13, _srs_strings),
+    ("wifi_ssid", 14, _srs_strings),
+    ("wifi_bssid", 15, _srs_strings),
+]
+
+
+def _srs_rule(rule: dict[str, Any], version: int) -> bytes:
+    if rule.get("type") == "logical":
+        if (mode := _SRS_LOGICAL_MODES.get(rule["mode"])) is None:
+            raise ValueError(f"Unknown logical rule mode: {rule['mode']!r}")
+        return b"".join(
+            (
+                bytes((_SRS_LOGICAL_RULE, mode)),
+                _uvarint(len(rule["rules"])),
+                *(_srs_rule(r, version) for r in rule["rules"]),
+                bytes((bool(rule.get("invert")),)),
+            )
+        )
+    if unsupported := rule.keys() - SING_BOX_HEADLESS_RULE_FIELDS - {"type"}:
+        raise ValueError(f"Rule sets do not support {sorted(unsupported)}: {rule}")
+    chunks = [bytes((_SRS_DEFAULT_RULE,))]
+    for field, item, encode in _SRS_ITEMS:
+        if field == "domain":
+            domains = _listable(rule.get("domain", []))
+            suffixes = _listable(rule.get("domain_suffix", []))
+            if domains or suffixes:
+                chunks += (bytes((item,)), _srs_domain_set(domains, suffixes, version))
+        elif values := _listable(rule.get(field, [])):
+            chunks += (bytes((item,)), encode(values))
+    chunks.append(bytes((_SRS_ITEM_FINAL, bool(rule.get("invert")))))
+    return b"".join(chunks)
+
+
+# The rule set versions encoded natively, mapped to the version in their header: sing-box
+# writes the oldest version able to hold the rules, but keeps version 1 (and its domain
+# suffixes) only when asked for it; the headless fields all fit version 2.
+_SRS_HEADER_VERSIONS = {1: 1, 2: 2, 3: 2, 4: 2}
+
+
+def encode_srs(rules: list[dict[str, Any]], version: int) -> bytes:
+    if (header_version := _SRS_HEADER_VERSIONS.get(version)) is None:
+        raise ValueError(
+            f"Unsupported rule set version {version}, expect any of {list(_SRS_HEADER_VERSIONS)}"
+        )
+    body = _uvarint(len(rules)) + b"".join(_srs_rule(rule, version) for rule in rules)
+    return _SRS_MAGIC + bytes((header_version,)) + zlib.compress(body, 9)
+
+
+# The rule set version native rule sets are encoded for unless a generate sets
+# `ruleset_version`, that of sing-box 1.13 and later.
+DEFAULT_RULESET_VERSION = 4
+
+# Rule values (e.g., domains) natively encoded in about the time it takes to fork a worker.
+_PARALLEL_MIN_SIZE = 2048
+
+
+def _rule_set_size(rules: list[dict[str, Any]]) -> int:
+    size = 0
+    for rule in rules:
+        if rule.get("type") == "logical":
+            size += _rule_set_size(rule["rules"])
+        else:
+            size += sum(len(v) if isinstance(v, list) else 1 for v in rule.values())
+    return size
+
+
+def _compile_rule_set(
+    rules: list[dict[str, Any]],
+    version: int,
+    sing_box: Path | None = None,
+    srs_file: Path | None = None,
+) -> bytes:
+    # Runs on the compiler's workers, so it only takes what the job needs.
+    if sing_box is None or srs_file is None:
+        return encode_srs(rules, version)
+    json_file = srs_file.with_suffix(".json")
+    with open(json_file, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "rules": rules}, f, ensure_ascii=False)
+    ret = subprocess.run(
+        [sing_box, "rule-set", "compile", json_file, "-o", srs_file],
+        capture_output=True,
+        encoding="utf-8",
+    )
+    if ret.returncode != 0:
+        raise RuntimeError(f"sing-box exited with {ret.returncode}: {ret.stderr.strip()}")
+    with open(srs_file, "rb") as f:
+        return f.read()
+
+
 class RuleSetCompiler:
-    # Use as a context manager: the workdir (and extracted binary) are cleaned up on exit.
-    # Downloaded tarballs are cached on the class so multiple instances only fetch once.
+    # Use as a context manager. Rule sets are encoded natively, without network access, for
+    # `ruleset_version`; with `native=False` they are compiled by `sing-box rule-set compile`
+    # instead, for the given version or else that of the sing-box, downloading sing-box unless
+    # it is on PATH, and the workdir (and extracted binary) are cleaned up on exit. Release
+    # lookups and tarballs go through the fetch layer, so they are memoized per run, cached
+    # across runs, and recorded by / replayed from lockfiles.
 
     _github_release = "https://github.com/SagerNet/sing-box/releases"
     _arch_map = {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "armv7"}
-    _download_cache: dict[str, bytes] = {}
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        native: bool = True,
+        max_workers: int | None = None,
+        ruleset_version: int | None = None,
+    ) -> None:
+        self._native = native
+        self._max_workers = max_workers
         self._tmpdir: tempfile.TemporaryDirectory[str] | None = None
         self._workdir: Path | None = None
         self._sing_box: Path | None = None
-        self._ruleset_version: int = 0
+        if native and ruleset_version is None:
+            ruleset_version = DEFAULT_RULESET_VERSION
+        self._ruleset_version: int = ruleset_version or 0
 
     def __enter__(self) -> Self:
+        if self._native:
+            return self
         self._tmpdir = tempfile.TemporaryDirectory()
         self._workdir = Path(self._tmpdir.__enter__())
         self._sing_box = self._resolve_sing_box()
-        self._ruleset_version = self._detect_ruleset_version()
+        if not self._ruleset_version:
+            self._ruleset_version = self._detect_ruleset_version(self._version(self._sing_box))
         return self
 
     def __exit__(
@@ -172,40 +457,47 @@ class RuleSetCompiler:
 
     @classmethod
     def _fetch_tarball(cls, url: str) -> bytes:
-        if url not in cls._download_cache:
-            print(f"Downloading {url} ...")
-            resp = requests.get(url, stream=True, timeout=60)
-            resp.raise_for_status()
-            cls._download_cache[url] = resp.content
-            print(f"Cached {len(cls._download_cache[url])} bytes for {url}")
-        else:
-            print(f"Using cached download for {url}")
-        return cls._download_cache[url]
+        return fetch(RemoteResource(url=url, kind="sing-box")).content
 
-    def _resolve_sing_box(self) -> Path:
-        assert self._workdir is not None
-        path = shutil.which("sing-box")
-        if path is not None:
-            return Path(path)
+    @classmethod
+    def _latest_release(cls) -> str:
+        latest = resolve_redirect(f"{cls._github_release}/latest")
+        match = re.search(r"/v(\d+\.\d+\.\d+)$", latest)
+        if not match:
+            raise RuntimeError(f"Could not determine latest sing-box version from {latest}")
+        return match.group(1)
 
+    @classmethod
+    def _release_tarball(cls) -> tuple[str, str, str]:
+        # Returns the version, name and URL of the latest release tarball for this machine.
         system = platform.system().lower()
         machine = platform.machine()
-        arch = self._arch_map.get(machine)
+        arch = cls._arch_map.get(machine)
         if system != "linux" or arch is None:
             raise RuntimeError(
                 f"sing-box not found in PATH and auto-download is not supported for "
                 f"{system}/{machine}. Please install sing-box manually."
             )
 
-        resp = requests.head(f"{self._github_release}/latest", allow_redirects=True, timeout=15)
-        resp.raise_for_status()
-        match = re.search(r"/v(\d+\.\d+\.\d+)$", resp.url)
-        if not match:
-            raise RuntimeError(f"Could not determine latest sing-box version from {resp.url}")
-        version = match.group(1)
-
+        version = cls._latest_release()
         tarball_name = f"sing-box-{version}-{system}-{arch}"
-        url = f"{self._github_release}/download/v{version}/{tarball_name}.tar.gz"
+        url = f"{cls._github_release}/download/v{version}/{tarball_name}.tar.gz"
+        return version, tarball_name, url
+
+    @staticmethod
+    def _version(sing_box: Path | str) -> str:
+        ret = subprocess.run(
+            [sing_box, "version"], check=True, capture_output=True, encoding="utf-8"
+        )
+        return ret.stdout
+
+    def _resolve_sing_box(self) -> Path:
+        assert self._workdir is not None
+        path = shutil.which("sing-box")
+        if path is not None:
+            return Path(path)
+
+        version, tarball_name, url = self._release_tarball()
         tarball_bytes = self._fetch_tarball(url)
 
         with tarfile.open(fileobj=io.BytesIO(tarball_bytes), mode="r:gz") as tar:
@@ -220,16 +512,10 @@ class RuleSetCompiler:
         print(f"sing-box {version} extracted to {binary}")
         return binary
 
-    def _detect_ruleset_version(self) -> int:
-        assert self._sing_box is not None
-        ret = subprocess.run(
-            [self._sing_box, "version"],
-            check=True,
-            capture_output=True,
-            encoding="utf-8",
-        )
+    @staticmethod
+    def _detect_ruleset_version(version_output: str) -> int:
         sing_box_version = parse(
-            re.search(r"sing-box version (.*)", ret.stdout).group(1)  # type: ignore[union-attr]
+            re.search(r"sing-box version (.*)", version_output).group(1)  # type: ignore[union-attr]
         )
         if Version("1.13") <= sing_box_version:
             return 4
@@ -241,51 +527,82 @@ class RuleSetCompiler:
             return 1
 
     def compile(self, ruleset_literals: dict[str, Any]) -> dict[str, io.BytesIO]:
-        assert self._workdir is not None and self._sing_box is not None
-        ruleset_binaries: dict[str, io.BytesIO] = dict()
+        # Rule sets are compiled concurrently on forked workers, one per CPU by default, and
+        # returned in the order of their tags; failures are collected and reported per tag.
+        # Natively encoding small rule sets takes less time than forking a worker.
+        jobs: dict[str, tuple[Any, ...]] = dict()
         for tag, rule in ruleset_literals.items():
-            normalized_tag = tag.replace(" ", "_")
-            ruleset = {
-                "version": self._ruleset_version,
-                "rules": rule if isinstance(rule, list) else [rule],
-            }
-            json_file = self._workdir / f"{normalized_tag}.json"
-            srs_file = self._workdir / f"{normalized_tag}.srs"
-            with open(json_file, "w", encoding="utf-8") as f:
-                json.dump(ruleset, f, ensure_ascii=False)
-            subprocess.run(
-                [self._sing_box, "rule-set", "compile", json_file, "-o", srs_file],
-                check=True,
-            )
-            with open(srs_file, "rb") as f:
-                ruleset_binaries[tag] = io.BytesIO(f.read())
-        return ruleset_binaries
+            rules = rule if isinstance(rule, list) else [rule]
+            if self._native:
+                jobs[tag] = (rules, self._ruleset_version)
+            else:
+                assert self._workdir is not None and self._sing_box is not None
+                srs_file = self._workdir / f"{tag.replace(' ', '_')}.srs"
+                jobs[tag] = (rules, self._ruleset_version, self._sing_box, srs_file)
+        sizes = {tag: _rule_set_size(job[0]) for tag, job in jobs.items()}
+        max_workers = min(self._max_workers or os.cpu_count() or 1, len(jobs))
+        if self._native and sum(sizes.values()) < _PARALLEL_MIN_SIZE:
+            max_workers = 1
+        # Workers of `generate_conf` already run in parallel, they do not nest pools of their own.
+        if multiprocessing.parent_process() is not None:
+            max_workers = 1
+
+        results: dict[str, Future[bytes]] = dict()
+        if max_workers <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for tag, job in jobs.items():
+                results[tag] = Future()
+                try:
+                    results[tag].set_result(_compile_rule_set(*job))
+                except Exception as e:
+                    results[tag].set_exception(e)
+        else:
+            # See `generate_conf`, no request thread may be running when forking.
+            join_requests()
+            with ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=multiprocessing.get_context("fork")
+            ) as pool:
+                # Largest rule sets first, they are most likely on the critical path.
+                for tag in sorted(jobs, key=sizes.__getitem__, reverse=True):
+                    results[tag] = pool.submit(_compile_rule_set, *jobs[tag])
+                wait(results.values())
+            results = {tag: results[tag] for tag in jobs}
+
+        if failed := {
+            tag: exc for tag, f in results.items() if (exc := f.exception()) is not None
+        }:
+            raise RuntimeError(
+                f"Failed to compile {len(failed)} of {len(jobs)} rule sets:\n"
+                + "\n".join(f"  {tag}: {exc}" for tag, exc in failed.items())
+            ) from next(iter(failed.values()))
+        return {tag: io.BytesIO(f.result()) for tag, f in results.items()}
 
     def build_rule_set(
         self,
-        rules: list[dict[str, Any]],
-        ruleset_prefix: str,
+        rules: dict[str, list[dict[str, Any]]],
         ruleset_url: str,
         download_detour: str,
     ) -> tuple[list[dict[str, Any]], dict[str, io.BytesIO]]:
+        # `rules` are keyed by the prefix of their rule set tags, e.g., `dns` and `route`. Rule
+        # sets of all of them are compiled at once.
         ruleset_literals: dict[str, Any] = dict()
-        for i, rule in enumerate(rules):
-            if rule["action"] == "route" and "server" in rule:
-                tag_prefix = rule["server"]
-            elif rule["action"] == "route" and "outbound" in rule:
-                tag_prefix = rule["outbound"]
-            elif rule["action"] == "reject":
-                tag_prefix = "Reject"
-            else:
-                print(f"Skip extracting ruleset from #{ruleset_prefix}.{i}: {rule}")
-                continue
-            # Normalize ruleset tag to be compliant with URLs.
-            tag_prefix = re.sub(r"(\s+\&\s+)|(\s+)", "_", tag_prefix)
-            extract_ruleset_inplace(
-                rule,
-                tag_prefix=f"{ruleset_prefix}.{i}.{tag_prefix}",
-                ruleset_literals=ruleset_literals,
-            )
+        for ruleset_prefix, prefixed_rules in rules.items():
+            for i, rule in enumerate(prefixed_rules):
+                if rule["action"] == "route" and "server" in rule:
+                    tag_prefix = rule["server"]
+                elif rule["action"] == "route" and "outbound" in rule:
+                    tag_prefix = rule["outbound"]
+                elif rule["action"] == "reject":
+                    tag_prefix = "Reject"
+                else:
+                    print(f"Skip extracting ruleset from #{ruleset_prefix}.{i}: {rule}")
+                    continue
+                # Normalize ruleset tag to be compliant with URLs.
+                tag_prefix = re.sub(r"(\s+\&\s+)|(\s+)", "_", tag_prefix)
+                extract_ruleset_inplace(
+                    rule,
+                    tag_prefix=f"{ruleset_prefix}.{i}.{tag_prefix}",
+                    ruleset_literals=ruleset_literals,
+                )
         ruleset_binaries = self.compile(ruleset_literals)
         ruleset: list[dict[str, Any]] = list()
         for tag in ruleset_literals.keys():
@@ -324,6 +641,7 @@ class SingBoxGenerator(GeneratorBase):
         ruleset_url: str | None = None,
         dial_fields: dict[Literal["direct", "proxy"], dict[str, str]] | None = None,
         add_resolve_action: dict[str, Any] | None = None,
+        ruleset_version: int = DEFAULT_RULESET_VERSION,
     ) -> None:
         # Construct the special group `PROXY` for sing-box.
         proxy_groups = copy(proxy_groups)
@@ -343,6 +661,7 @@ class SingBoxGenerator(GeneratorBase):
             self.ruleset_url = ruleset_url
         else:
             self.ruleset_url = None
+        self.ruleset_version = ruleset_version
 
         # Parse DNS rules using the same infra as in parsing route rules.
         if "rules" not in dns:
@@ -403,8 +722,10 @@ class SingBoxGenerator(GeneratorBase):
         included_process_irs: list[str] | None = None,
         ruleset_url: str | None = None,
         add_resolve_action: dict[str, Any] | None = None,
+        ruleset_version: int | None = None,
     ) -> Self:
         new_object = copy(base_object)
+        new_object.outputs = {}
         # `dns` only overwrites or appends DNS servers.
         if dns is not None:
             if dns.get("servers"):
@@ -444,6 +765,8 @@ class SingBoxGenerator(GeneratorBase):
         # Update ruleset download URL if specified.
         if ruleset_url is not None:
             new_object.ruleset_url = ruleset_url
+        if ruleset_version is not None:
+            new_object.ruleset_version = ruleset_version
         if add_resolve_action is not None:
             new_object.add_resolve_action = add_resolve_action
 
@@ -490,6 +813,8 @@ class SingBoxGenerator(GeneratorBase):
                     dst_ip_filters.append(filters.dst_ip_filters)
         self.route["rules"] += no_resolve_filters
         # If specified to add resolve action, also append dst_ip based rules.
+        if num_pruned := prune_shadowed_sing_box_dst_ip_filters(dst_ip_filters):
+            print(f"Pruned {num_pruned} sing-box IP rules shadowed by earlier groups.")
         if self.add_resolve_action and dst_ip_filters:
             self.route["rules"].append({"action": "resolve", **self.add_resolve_action})
             self.route["rules"] += dst_ip_filters
@@ -516,26 +841,14 @@ class SingBoxGenerator(GeneratorBase):
             # TODO: Enable specify the download detour from config file.
             assert (hk_group := next(g for g in self._proxy_groups if "🇭🇰" in g.name))
             download_detour = random.choice(hk_group._proxies)
-            with RuleSetCompiler() as compiler:
-                dns_ruleset, dns_ruleset_binaries = compiler.build_rule_set(
-                    rules=conf["dns"]["rules"],
-                    ruleset_prefix="dns",
-                    ruleset_url=self.ruleset_url,
-                    download_detour=download_detour,
-                )
-                route_ruleset, route_ruleset_binaries = compiler.build_rule_set(
-                    rules=conf["route"]["rules"],
-                    ruleset_prefix="route",
+            with RuleSetCompiler(ruleset_version=self.ruleset_version) as compiler:
+                ruleset, ruleset_binaries = compiler.build_rule_set(
+                    rules={"dns": conf["dns"]["rules"], "route": conf["route"]["rules"]},
                     ruleset_url=self.ruleset_url,
                     download_detour=download_detour,
                 )
-            for tag, binary in itertools.chain(
-                dns_ruleset_binaries.items(), route_ruleset_binaries.items()
-            ):
-                srs_file = os.path.join(dst_dir, f"{tag}.srs")
-                with open(srs_file, "wb") as f:
-                    f.write(binary.getbuffer())
-            conf["route"]["rule_set"] = dns_ruleset + route_ruleset
-        config_file = os.path.join(dst_dir, "config.json")
-        with open(config_file, "w", encoding="utf-8") as f:
+            for tag, binary in ruleset_binaries.items():
+                self._write_output(os.path.join(dst_dir, f"{tag}.srs"), binary.getvalue())
+            conf["route"]["rule_set"] = ruleset
+        with self._open_output(os.path.join(dst_dir, "config.json")) as f:
             json.dump(conf, f, ensure_ascii=False, indent=4, sort_keys=True)
@@ -1,8 +1,13 @@
 from typing import Any
 from typing import get_args
 
-import requests
 import yaml
+from conf_gen.fetch import DEFAULT_HEDGE_DELAY
+from conf_gen.fetch import RemoteResource
+from conf_gen.fetch import collect_remote_resources
+from conf_gen.fetch import fetch
+from conf_gen.fetch import prefetch
+from conf_gen.fetch import release
 from conf_gen.proxy import ProxyBase
 from conf_gen.proxy.shadowsocks_proxy import ShadowSocks2022CiphersT
 from conf_gen.proxy.shadowsocks_proxy import ShadowSocks2022Proxy
@@ -124,13 +129,20 @@ def parse_clash_subscription(
     backup_url: str | None = None,
     params: dict[str, str] | None = None,
     headers: dict[str, str] | None = None,
+    hedge_delay: float = DEFAULT_HEDGE_DELAY,
 ) -> list[ProxyBase]:
-    r = requests.get(url, params=params, headers=headers)
-    if r.status_code != 200 and backup_url is not None:
-        r = requests.get(backup_url)
-    if r.status_code != 200:
-        raise requests.HTTPError(f"{r.status_code} {r.reason}")
-    elif not (proxies := yaml.safe_load(r.text)["proxies"]):
+    resource = RemoteResource(
+        url=url,
+        params=params,
+        headers=headers,
+        backup_url=backup_url,
+        kind="subscription",
+        hedge_delay=hedge_delay,
+    )
+    # Subscriptions are parsed once, their (in-memory) payloads aren't kept for the whole run.
+    subscription = yaml.safe_load(fetch(resource).text)
+    release(resource)
+    if not (proxies := subscription["proxies"]):
         raise ValueError("No proxies found in subscription")
     return parse_clash_proxies(proxies)
 
@@ -139,14 +151,17 @@ def parse_subscriptions(
     subscriptions_info: list[dict[str, Any]],
 ) -> list[ProxyBase]:
     proxies: list[ProxyBase] = []
+    # Download all subscriptions concurrently; this is a no-op for the ones already prefetched.
+    prefetch(collect_remote_resources({"subscriptions": subscriptions_info}))
     for sub_info in subscriptions_info:
         sub_type = sub_info["type"]
         url = sub_info["url"]
         backup_url = sub_info.get("backup_url")
         params = sub_info.get("params", {})
         headers = sub_info.get("headers", {})
+        hedge_delay = sub_info.get("hedge_delay", DEFAULT_HEDGE_DELAY)
         if sub_type == "clash":
-            proxies += parse_clash_subscription(url, backup_url, params, headers)
+            proxies += parse_clash_subscription(url, backup_url, params, headers, hedge_delay)
         else:
             raise ValueError(f"Not supported subscription type: {sub_type}")
     return proxies
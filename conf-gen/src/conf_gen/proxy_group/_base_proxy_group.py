@@ -4,6 +4,7 @@ import re
 from collections import defaultdict
 from functools import lru_cache
 from typing import Any
+from typing import Literal
 from typing import Sequence
 from typing import TypeAlias
 
@@ -12,7 +13,9 @@ from conf_gen.rule import FilterT
 from conf_gen.rule import group_sing_box_filters
 from conf_gen.rule import parse_filter
 from conf_gen.rule._base_ir import IRBase
+from conf_gen.rule._base_ir import RuleToken
 from conf_gen.rule.ir import Match
+from conf_gen.rule.store import ColumnarFilters
 
 ProxyT: TypeAlias = ProxyBase | str | dict[str, str]
 ProxyLeafT: TypeAlias = ProxyBase | str
@@ -26,17 +29,26 @@ class ProxyGroupBase:
         proxies: Sequence[ProxyT | "ProxyGroupBase"],
         img_url: str | None = None,
         available_proxies: Sequence[ProxyT | "ProxyGroupBase"] | None = None,
+        storage: Literal["objects", "columnar"] = "objects",
     ) -> None:
         self.name = name
         self.img_url = img_url
         self.included_process_irs: list[str] | None = None
-        self._filters: list[IRBase] = []
+        # Columnar storage trades per-access IR construction for a fraction of the memory,
+        # which is worth it for groups with huge rule sets, e.g., reject domain sets.
+        self._filters: list[IRBase] | ColumnarFilters
+        if storage == "objects":
+            self._filters = []
+        elif storage == "columnar":
+            self._filters = ColumnarFilters()
+        else:
+            raise ValueError(f"invalid {storage=}, expect objects or columnar")
         self._proxies: list[str] = []
 
         if filters:  # `filters` could be None, e.g., clash's special PROXY group.
             for f in filters:
                 parsed = parse_filter(f)
-                self._filters += parsed
+                self._filters.extend(parsed)
 
         for proxy in proxies:
             if isinstance(proxy, str):
@@ -55,6 +67,15 @@ class ProxyGroupBase:
                     elif isinstance(available_proxy, str) and re.search(pattern, available_proxy):
                         self._proxies.append(available_proxy)
 
+    def _replace_filters(self, filters: Sequence[IRBase]) -> None:
+        # Keeps the storage the group was created with.
+        if isinstance(self._filters, ColumnarFilters):
+            if not isinstance(filters, ColumnarFilters):
+                filters = ColumnarFilters(filters)
+            self._filters = filters
+        else:
+            self._filters = list(filters)
+
     @property
     def prefer_reject(self) -> bool:
         return 0 < len(self._proxies) and self._proxies[0] == "REJECT"
@@ -71,55 +92,48 @@ class ProxyGroupBase:
     def quantumult_policy(self) -> str:
         raise NotImplementedError()
 
-    @property
-    def quantumult_filters(self) -> tuple[list[str], list[str]]:
-        no_resolve_filters: list[str] = []
-        resolve_filters: list[str] = []
+    def _split_tokens(
+        self, target: Literal["clash", "quantumult"]
+    ) -> tuple[list[RuleToken], list[RuleToken]]:
+        no_resolve_tokens: list[RuleToken] = []
+        resolve_tokens: list[RuleToken] = []
         for ir_filter in self._filters:
+            token = ir_filter.clash_token if target == "clash" else ir_filter.quantumult_token
+            if token is None:
+                continue
             if ir_filter._might_resolvable and ir_filter._resolve:
-                target_filters = resolve_filters
+                resolve_tokens.append(token)
             else:
-                target_filters = no_resolve_filters
-            try:
-                filter_parts = ir_filter.quantumult_rule.split(",")
-            except ValueError as e:
-                if str(e).endswith("is not supported by quantumult x."):
-                    continue
-                else:
-                    raise e
-            if filter_parts[-1] == "no-resolve":
-                filter_parts.insert(-1, self.name)
-            else:
-                filter_parts.append(self.name)
-            target_filters.append(",".join(filter_parts))
-        return no_resolve_filters, resolve_filters
+                no_resolve_tokens.append(token)
+        return no_resolve_tokens, resolve_tokens
+
+    @property
+    def quantumult_tokens(self) -> tuple[list[RuleToken], list[RuleToken]]:
+        return self._split_tokens("quantumult")
+
+    @property
+    def quantumult_filters(self) -> tuple[list[str], list[str]]:
+        no_resolve_tokens, resolve_tokens = self.quantumult_tokens
+        return (
+            [t.line(self.name) for t in no_resolve_tokens],
+            [t.line(self.name) for t in resolve_tokens],
+        )
 
     @property
     def clash_proxy_group(self) -> dict[str, str | list[str] | int]:
         raise NotImplementedError()
 
+    @property
+    def clash_tokens(self) -> tuple[list[RuleToken], list[RuleToken]]:
+        return self._split_tokens("clash")
+
     @property
     def clash_rules(self) -> tuple[list[str], list[str]]:
-        no_resolve_rules: list[str] = []
-        resolve_rules: list[str] = []
-        for ir_filter in self._filters:
-            if ir_filter._might_resolvable and ir_filter._resolve:
-                rules = resolve_rules
-            else:
-                rules = no_resolve_rules
-            try:
-                clash_rule = ir_filter.clash_rule.split(",")
-            except ValueError as e:
-                if str(e).endswith("is not supported by clash."):
-                    continue
-                else:
-                    raise e
-            if clash_rule[-1] == "no-resolve":
-                clash_rule.insert(-1, self.name)
-            else:
-                clash_rule.append(self.name)
-            rules.append(",".join(clash_rule))
-        return no_resolve_rules, resolve_rules
+        no_resolve_tokens, resolve_tokens = self.clash_tokens
+        return (
+            [t.line(self.name) for t in no_resolve_tokens],
+            [t.line(self.name) for t in resolve_tokens],
+        )
 
     @property
     def sing_box_outbound(self) -> dict[str, Any]:
@@ -11,6 +11,8 @@ from conf_gen.proxy_group import ProxyGroupBase
 from conf_gen.proxy_group._base_proxy_group import ProxyBase
 from conf_gen.proxy_group.fallback_proxy_group import FallbackProxyGroup
 from conf_gen.proxy_group.selective_proxy_group import SelectProxyGroup
+from conf_gen.rule import aggregate_ip_cidr_filters
+from conf_gen.rule import prune_shadowed_domain_filters
 
 
 def merge_proxy_by_region(
@@ -92,11 +94,32 @@ def parse_proxy_groups(
                 proxies=g_info["proxies"],
                 img_url=g_info["img-url"],
                 available_proxies=available_proxies,
+                storage=g_info.get("storage", "objects"),
             )
         else:
             raise ValueError(f"Unsupported proxy group type: {g_info['type']}.")
         proxy_groups.append(g)
 
+    # Clients scan rules linearly, drop domain rules shadowed by earlier suffixes.
+    num_filters = sum(len(g._filters) for g in proxy_groups)
+    for g, filters in zip(
+        proxy_groups, prune_shadowed_domain_filters([g._filters for g in proxy_groups])
+    ):
+        g._replace_filters(filters)
+    if 0 < (num_pruned := num_filters - sum(len(g._filters) for g in proxy_groups)):
+        print(f"Pruned {num_pruned} domain rules shadowed by earlier domain suffixes.")
+    # ...and aggregate IP rules into the fewest prefixes not covered by earlier groups.
+    num_filters -= num_pruned
+    for g, filters in zip(
+        proxy_groups,
+        aggregate_ip_cidr_filters(
+            [g._filters for g in proxy_groups], names=[g.name for g in proxy_groups]
+        ),
+    ):
+        g._replace_filters(filters)
+    if 0 < (num_aggregated := num_filters - sum(len(g._filters) for g in proxy_groups)):
+        print(f"Removed {num_aggregated} IP rules by aggregating adjacent and covered prefixes.")
+
     if available_proxies is not None:
         for proxy in available_proxies:
             if isinstance(proxy, ProxyGroupBase):
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from typing import Any
+from typing import Literal
 from typing import Sequence
 
 from conf_gen.proxy_group._base_proxy_group import ProxyGroupBase
@@ -16,9 +17,15 @@ class SelectProxyGroup(ProxyGroupBase):
         proxies: Sequence[ProxyT | ProxyGroupBase],
         img_url: str | None = None,
         available_proxies: Sequence[ProxyT | ProxyGroupBase] | None = None,
+        storage: Literal["objects", "columnar"] = "objects",
     ) -> None:
         super().__init__(
-            name, filters, proxies, img_url=img_url, available_proxies=available_proxies
+            name,
+            filters,
+            proxies,
+            img_url=img_url,
+            available_proxies=available_proxies,
+            storage=storage,
         )
 
     @property
@@ -1,4 +1,5 @@
-import requests
+from conf_gen.fetch import RemoteResource
+from conf_gen.fetch import fetch
 from conf_gen.rewrite._base_rewrite import RewriteBase
 
 from common import COMMENT_BEGINS
@@ -8,9 +9,7 @@ class QuantumultRewrite(RewriteBase):
     def __init__(self, name: str, url: str) -> None:
         super().__init__(name, url)
 
-        r = requests.get(url)
-        if r.status_code != 200:
-            raise requests.HTTPError(r.reason)
+        r = fetch(RemoteResource(url=url, kind="rewrite"))
         for line in r.text.splitlines():
             line = line.strip()
             if (
@@ -1,13 +1,21 @@
 from conf_gen.rule.parser import FilterT
 from conf_gen.rule.parser import parse_filter
+from conf_gen.rule.utils import IPIntervalIndex
 from conf_gen.rule.utils import SplittedSingBoxFilters
+from conf_gen.rule.utils import aggregate_ip_cidr_filters
 from conf_gen.rule.utils import group_sing_box_filters
+from conf_gen.rule.utils import prune_shadowed_domain_filters
+from conf_gen.rule.utils import prune_shadowed_sing_box_dst_ip_filters
 from conf_gen.rule.utils import split_sing_box_dst_ip_filters
 
 __all__ = (
     "FilterT",
+    "IPIntervalIndex",
     "SplittedSingBoxFilters",
     "parse_filter",
+    "aggregate_ip_cidr_filters",
     "group_sing_box_filters",
+    "prune_shadowed_domain_filters",
+    "prune_shadowed_sing_box_dst_ip_filters",
     "split_sing_box_dst_ip_filters",
 )
@@ -1,18 +1,96 @@
 import functools
 import re
+from dataclasses import dataclass
+from enum import IntFlag
 from typing import Any
 from typing import Callable
 from typing import Hashable
 from warnings import warn
 
+# Fields allowed in sing-box headless rules, i.e., in rule sets.
+# https://sing-box.sagernet.org/configuration/rule-set/headless-rule/
+SING_BOX_HEADLESS_RULE_FIELDS = frozenset(
+    [
+        "query_type",
+        "network",
+        "domain",
+        "domain_suffix",
+        "domain_keyword",
+        "domain_regex",
+        "source_ip_cidr",
+        "ip_cidr",
+        "source_port",
+        "source_port_range",
+        "port",
+        "port_range",
+        "process_name",
+        "process_path",
+        "process_path_regex",
+        "package_name",
+        "wifi_ssid",
+        "wifi_bssid",
+        "invert",
+    ]
+)
 
-class IRBase:
+
+class IRCapability(IntFlag):
+    # Computed per IR class on registration, so emitters filter on flags instead of rendering.
+    CLASH = 1
+    QUANTUMULT = 2
+    SING_BOX = 4
+    # Every sing-box field the IR renders to may be used in rule sets.
+    RULE_SET_COMPLIANT = 8
+    DST_IP = 16
+    PROCESS = 32
+
+
+@dataclass(frozen=True, slots=True)
+class RuleToken:
+    # A Clash/Quantumult-X rule split into its fields, e.g., `IP-CIDR,1.0.0.0/24,no-resolve`.
+    # Rules like `MATCH` carry no value and take the policy as their second field.
+    prefix: str
+    val: str | None
+    no_resolve: bool
+
+    def line(self, policy: str) -> str:
+        fields = [self.prefix, policy] if self.val is None else [self.prefix, self.val, policy]
+        if self.no_resolve:
+            fields.append("no-resolve")
+        return ",".join(fields)
+
+    def matcher(self, policy: str) -> str:
+        # Two rules with the same matcher shadow each other, only the first one takes effect.
+        return f"{self.prefix},{policy if self.val is None else self.val}"
+
+
+class _IRMeta(type):
+    def __new__(mcs, name: str, bases: tuple[type, ...], namespace: dict[str, Any]) -> "_IRMeta":
+        # Subclasses only override class-level prefixes and properties, keep them dict-free.
+        namespace.setdefault("__slots__", ())
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class IRBase(metaclass=_IRMeta):
+
+    __slots__ = (
+        "_val",
+        "_resolve",
+        "_hash",
+    )
 
     _clash_prefix: str | None = None
     _quantumult_prefix: str | None = None
     _sing_box_prefix: str | None = None
     _might_resolvable: bool = False
     _val_is_domain: bool | None = None
+    # sing-box fields rendered by `sing_box_rule`, defaults to the `_sing_box_prefix`.
+    _sing_box_fields: tuple[str, ...] | None = None
+    _capabilities: IRCapability = IRCapability(0)
+
+    _val: str
+    _resolve: bool | None
+    _hash: int
 
     def __init__(self, val: str, resolve: bool | None = None):
         if self._might_resolvable and resolve is None:
@@ -24,22 +102,61 @@ class IRBase:
             warn(f"Got port numbers in {self.__class__.__name__} item: {val}, trying to remove...")
             val = val.split(":")[0]
 
-        self._val = val
-        self._resolve = resolve
+        object.__setattr__(self, "_val", val)
+        object.__setattr__(self, "_resolve", resolve)
+        object.__setattr__(self, "_hash", hash((self.__class__.__qualname__, val, resolve)))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{self.__class__.__name__} is immutable.")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{self.__class__.__name__} is immutable.")
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # Slotted instances without a `__dict__` are rebuilt through the constructor.
+        return self.__class__, (self._val, self._resolve)
 
     def __hash__(self) -> int:
-        return hash((
-            self._clash_prefix,
-            self._quantumult_prefix,
-            self._sing_box_prefix,
-            self._might_resolvable,
-            self._val_is_domain,
-            self._val,
-            self._resolve,
-        ))
+        return self._hash
 
     def __eq__(self, rhs: Any) -> bool:
-        return type(rhs) == type(self) and hash(rhs) == hash(self)
+        if rhs is self:
+            return True
+        return (
+            type(rhs) is type(self)
+            and rhs._hash == self._hash
+            and rhs._val == self._val
+            and rhs._resolve == self._resolve
+        )
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self._val!r}, resolve={self._resolve!r})"
+
+    def _render_token(self, rule: str) -> RuleToken:
+        fields = rule.split(",")
+        no_resolve = 1 < len(fields) and fields[-1] == "no-resolve"
+        if no_resolve:
+            fields.pop()
+        return RuleToken(fields[0], ",".join(fields[1:]) or None, no_resolve)
+
+    # Tokens are rendered on each access, None if the target does not support this IR.
+    # Columnar groups materialize fresh IRs per pass, so caching them per instance rarely hits.
+
+    @property
+    def clash_token(self) -> RuleToken | None:
+        if not self._capabilities & IRCapability.CLASH:
+            return None
+        return self._render_token(self.clash_rule)
+
+    @property
+    def quantumult_token(self) -> RuleToken | None:
+        if not self._capabilities & IRCapability.QUANTUMULT:
+            return None
+        return self._render_token(self.quantumult_rule)
+
+    @property
+    def sing_box_token(self) -> tuple[str, str] | None:
+        return self.sing_box_rule if self._capabilities & IRCapability.SING_BOX else None
 
     @property
     def clash_rule(self) -> str:
@@ -85,6 +202,10 @@ class IRBase:
 class IRRegistry:
     def __init__(self) -> None:
         self._registry: dict[tuple[str, ...], type[IRBase]] = {}
+        # Raw spellings of rule types, e.g., `IP-CIDR` and `ip_cidr`, mapped to their IR, so the
+        # type of each rule set line is a single dict lookup. Unregistered spellings are not kept,
+        # since rule sets may carry any number of them.
+        self._flat: dict[str, type[IRBase]] = {}
 
     @staticmethod
     @functools.lru_cache(maxsize=128)
@@ -106,19 +227,50 @@ class IRRegistry:
                 keys.add(self.prefix2key(cls._sing_box_prefix))
             for k in keys:
                 self._registry[k] = cls
+                for spelling in ("-".join(k), "_".join(k)):
+                    self._flat[spelling] = self._flat[spelling.upper()] = cls
+            cls._capabilities = self._capabilities(cls)
             return cls
 
         return _do_register
 
+    @staticmethod
+    def _capabilities(cls: type[IRBase]) -> IRCapability:
+        capabilities = IRCapability(0)
+        # Subclasses without a prefix may still render rules by overriding the properties.
+        if cls._clash_prefix is not None or cls.clash_rule is not IRBase.clash_rule:
+            capabilities |= IRCapability.CLASH
+        if cls._quantumult_prefix is not None or cls.quantumult_rule is not IRBase.quantumult_rule:
+            capabilities |= IRCapability.QUANTUMULT
+        sing_box_fields = cls._sing_box_fields
+        if sing_box_fields is None and cls._sing_box_prefix is not None:
+            sing_box_fields = (cls._sing_box_prefix,)
+        if sing_box_fields:
+            capabilities |= IRCapability.SING_BOX
+            if SING_BOX_HEADLESS_RULE_FIELDS.issuperset(sing_box_fields):
+                capabilities |= IRCapability.RULE_SET_COMPLIANT
+            if set(sing_box_fields) == {"ip_cidr"}:
+                capabilities |= IRCapability.DST_IP
+            if set(sing_box_fields) <= {"process_name", "package_name"}:
+                capabilities |= IRCapability.PROCESS
+        return capabilities
+
+    def lookup(self, key: str) -> type[IRBase] | None:
+        try:
+            return self._flat[key]
+        except KeyError:
+            # Other spellings of registered types are normalized once and memoized.
+            ir_type = self._registry.get(self.prefix2key(key))
+            if ir_type is not None:
+                self._flat[key] = ir_type
+            return ir_type
+
     def __contains__(self, key: Hashable) -> bool:
-        if isinstance(key, str) and self.prefix2key(key) in self._registry:
-            return True
-        else:
-            return False
+        return isinstance(key, str) and self.lookup(key) is not None
 
     def __getitem__(self, key: Hashable) -> type[IRBase]:
-        if isinstance(key, str) and self.prefix2key(key) in self._registry:
-            return self._registry[self.prefix2key(key)]
+        if isinstance(key, str) and (ir_type := self.lookup(key)) is not None:
+            return ir_type
         else:
             raise RuntimeError(f"{key} was not registered as an IR.")
 
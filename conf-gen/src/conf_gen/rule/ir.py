@@ -54,6 +54,7 @@ class DomainWildcard(_IRBase):
     _clash_prefix = "DOMAIN-WILDCARD"
     _quantumult_prefix = "host-wildcard"
     _val_is_domain = True
+    _sing_box_fields = ("domain_regex",)
 
     @property
     def sing_box_rule(self) -> tuple[str, str]:
@@ -69,6 +70,7 @@ class DomainListItem(_IRBase):
     _quantumult_prefix = None
     _sing_box_prefix = None
     _val_is_domain = True
+    _sing_box_fields = ("domain", "domain_suffix", "domain_regex")
 
     @property
     def clash_rule(self) -> str:
@@ -164,6 +166,7 @@ class IPCIDR6(_IRBase):
     _clash_prefix = "IP-CIDR6"
     _quantumult_prefix = "ip6-cidr"
     _might_resolvable = True
+    _sing_box_fields = ("ip_cidr",)
     
     @property
     def sing_box_rule(self) -> tuple[str, str]:
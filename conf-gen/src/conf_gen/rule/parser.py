@@ -1,12 +1,21 @@
+import collections
+import itertools
 import re
 import warnings
+from functools import lru_cache
+from typing import Any
+from typing import Iterable
+from typing import Iterator
 from typing import Literal
 from typing import NotRequired
 from typing import Sequence
+from typing import TextIO
 from typing import TypedDict
 
-import requests
 import yaml
+from conf_gen.fetch import RULE_SET_HEADERS
+from conf_gen.fetch import RemoteResource
+from conf_gen.fetch import fetch
 from conf_gen.rule._base_ir import _IR_REGISTRY
 from conf_gen.rule._base_ir import IRBase
 from conf_gen.rule.ir import IPCIDR
@@ -18,6 +27,7 @@ from conf_gen.rule.ir import DomainSuffix
 from conf_gen.rule.ir import DomainWildcard
 from conf_gen.rule.ir import PackageName
 from conf_gen.rule.ir import ProcessName
+from conf_gen.rule.store import ColumnarFilters
 
 from common import CLASH_RULESET_FORMATS
 from common import COMMENT_BEGINS
@@ -41,125 +51,163 @@ DNS_RESPONSE_MATCHERS = (
 
 EXCLUDED_DOMAIN_KEYWORDS = ("this_ruleset_is_made_by_sukkaw",)
 
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _iter_yaml_payload(stream: TextIO) -> Iterator[str]:
+    # Walks parser events instead of composing the document, so only the current scalar of the
+    # top-level `payload` sequence is held in memory.
+    depth = 0
+    expect_key = True
+    key: str | None = None
+    in_payload = False
+    for event in yaml.parse(stream, Loader=_YAML_LOADER):
+        if in_payload:
+            if isinstance(event, yaml.ScalarEvent):
+                yield event.value
+            elif isinstance(event, yaml.SequenceEndEvent):
+                in_payload = False
+                depth -= 1
+                expect_key = True
+            else:
+                raise ValueError(f"Expect scalar items in rule set payload, got {event}")
+        elif isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            in_payload = (
+                depth == 1
+                and not expect_key
+                and key == "payload"
+                and isinstance(event, yaml.SequenceStartEvent)
+            )
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+            expect_key = True
+        elif isinstance(event, (yaml.ScalarEvent, yaml.AliasEvent)) and depth == 1:
+            if expect_key:
+                key = event.value if isinstance(event, yaml.ScalarEvent) else None
+            expect_key = not expect_key
+
 
-def _fetch_rule_set_payload(url: str, format: Literal["yaml", "text"]) -> Sequence[str]:
+def _iter_rule_set_payload(
+    url: str,
+    format: Literal["yaml", "text"],
+    source_type: str,
+) -> Iterator[str]:
     if format not in CLASH_RULESET_FORMATS:
         raise ValueError(f"Unsupported format {format}, expect any of {CLASH_RULESET_FORMATS}")
 
-    print(f"Requesting to get from {url}...")
-    r = requests.get(url, headers={"user-agent": "clash"})
-    if r.status_code != 200:
-        raise requests.HTTPError(r.reason)
-
-    filters = []
-    if format == "yaml":
-        filters = [
-            l.strip()
-            for l in yaml.load(r.text, Loader=yaml.SafeLoader)["payload"]
-            if not any(p in l for p in EXCLUDED_DOMAIN_KEYWORDS)
-        ]
-    elif format == "text":
-        filters = [
-            l.strip()
-            for l in r.text.splitlines()
-            if l
-            and not l.lstrip().startswith(COMMENT_BEGINS)
-            and not any(p in l for p in EXCLUDED_DOMAIN_KEYWORDS)
-        ]
-
-    return filters
+    r = fetch(RemoteResource(url=url, headers=RULE_SET_HEADERS, kind=source_type))
+
+    # Lines are decoded, filtered and handed over one at a time, so peak memory is bounded by
+    # the read chunk size instead of the size of the rule set.
+    with r.open_text() as stream:
+        if format == "yaml":
+            lines = _iter_yaml_payload(stream)
+        else:
+            lines = (l for l in stream if not l.lstrip().startswith(COMMENT_BEGINS))
+        for l in lines:
+            l = l.strip()
+            if l and not any(p in l for p in EXCLUDED_DOMAIN_KEYWORDS):
+                yield l
 
 
 def parse_clash_classical_filter(
     url: str,
     format: Literal["yaml", "text"],
     resolve: bool | Literal["literal"],
-) -> Sequence[IRBase]:
+    source_type: Literal["clash-classical", "quantumult"] = "clash-classical",
+) -> Iterator[IRBase]:
     if not resolve in ("literal", True, False):
         raise ValueError(f"Unsupported resolve argument {resolve}, expect boolean or 'literal'")
-    filters = _fetch_rule_set_payload(url, format)
-    ret = []
-    for l in filters:
-        rule_type, *args = l.split(",")
-        rule_requires_resolve: bool | None
-        if len(args) < 1:
-            raise ValueError(f"Got unparsable rule {l}")
-        elif len(args) == 1:
-            val = args[0]
-            if resolve == "literal":
-                raise ValueError(f"Given resolve='literal' but rule {l} didn't have resolve info")
-            rule_requires_resolve = resolve
-        else:
-            val = args[0]
-            # Resolve condition in the rule literal only takes effect when resolve set to "literal".
-            if resolve == "literal":
-                if (
-                    args[-1].lower() not in ("no-resolve", "resolve")
-                    and _IR_REGISTRY[rule_type]._might_resolvable
-                ):
-                    raise ValueError(
-                        f"Specified resolve=literal but the rule {l} did not indicate whether to "
-                        f"resolve hostname or not"
-                    )
-                elif args[-1].lower() == "no-resolve":
-                    rule_requires_resolve = False
-                elif args[-1].lower() == "resolve":
-                    rule_requires_resolve = True
-                else:
-                    rule_requires_resolve = None
-            else:
-                rule_requires_resolve = resolve
-        try:
-            ir = _IR_REGISTRY[rule_type](val, rule_requires_resolve)
-        except RuntimeError as e:
-            if re.match(r"^[^\s]+ was not registered as an IR\.", str(e)):
-                warnings.warn(f"{e} (when parsing from {url})")
+    unregistered = collections.Counter[str]()
+
+    def classify() -> Iterator[tuple[type[IRBase], str, bool | None]]:
+        lookup = _IR_REGISTRY.lookup
+        for l in _iter_rule_set_payload(url, format, source_type):
+            rule_type, sep, val = l.partition(",")
+            if not sep:
+                raise ValueError(f"Got unparsable rule {l}")
+            flag = None
+            if "," in val:
+                val, *_, flag = val.split(",")
+            if (ir_type := lookup(rule_type)) is None:
+                unregistered[rule_type] += 1
                 continue
+            # Resolve condition in the rule literal only takes effect with resolve="literal".
+            rule_requires_resolve: bool | None
+            if resolve != "literal":
+                rule_requires_resolve = resolve
+            elif flag is None:
+                raise ValueError(f"Given resolve='literal' but rule {l} didn't have resolve info")
+            elif (flag := flag.lower()) == "no-resolve":
+                rule_requires_resolve = False
+            elif flag == "resolve":
+                rule_requires_resolve = True
+            elif ir_type._might_resolvable:
+                raise ValueError(
+                    f"Specified resolve=literal but the rule {l} did not indicate whether to "
+                    f"resolve hostname or not"
+                )
             else:
-                raise e
-        ret.append(ir)
-    return ret
+                rule_requires_resolve = None
+            yield ir_type, val, rule_requires_resolve
+
+    yield from (ir_type(val, resolve) for ir_type, val, resolve in classify())
+    if unregistered:
+        counts = ", ".join(f"{t} ({n})" for t, n in unregistered.most_common())
+        warnings.warn(
+            f"Skipped {unregistered.total()} rules of types not registered as IRs: {counts} "
+            f"(when parsing from {url})"
+        )
 
 
 def parse_clash_ipcidr_filter(
     url: str,
     format: Literal["yaml", "text"],
     resolve: bool | None,
-) -> Sequence[IRBase]:
+) -> Iterator[IRBase]:
     if resolve is None:
         raise ValueError("Must explicitly specify IP rules resolve, but got None instead.")
-    filters = _fetch_rule_set_payload(url, format)
-    ret = []
-    for l in filters:
-        if re.search(r"[0-9]+(?:\.[0-9]+){3}", l):  # Is it IPv4?
-            rule_type = "IP-CIDR"
-        else:
-            rule_type = "IP-CIDR6"
-        ir = _IR_REGISTRY[rule_type](l, resolve)
-        ret.append(ir)
-    return ret
+    lines = _iter_rule_set_payload(url, format, "clash-ipcidr")
+    yield from ((IPCIDR6 if ":" in l else IPCIDR)(l, resolve) for l in lines)
 
 
-def parse_domain_list(url: str, format: Literal["yaml", "text"]) -> Sequence[IRBase]:
-    filters = _fetch_rule_set_payload(url, format)
-    ret = []
-    for l in filters:
-        ir = DomainListItem(l)
-        ret.append(ir)
-    return ret
+def parse_domain_list(url: str, format: Literal["yaml", "text"]) -> Iterator[IRBase]:
+    for l in _iter_rule_set_payload(url, format, "domain-list"):
+        yield DomainListItem(l)
 
 
-def parse_dnsmasq_conf(url: str) -> Sequence[IRBase]:
+def parse_dnsmasq_conf(url: str) -> Iterator[IRBase]:
     dnsmasq_template = r"server=/([^/]+)/.*"
-    filters = _fetch_rule_set_payload(url, format="text")
-    ret = []
-    for l in filters:
+    for l in _iter_rule_set_payload(url, format="text", source_type="dnsmasq"):
         m = re.search(dnsmasq_template, l)
         if m:
             d = m.group(1)
-            ir = DomainSuffix(d)
-            ret.append(ir)
-    return ret
+            yield DomainSuffix(d)
+
+
+@lru_cache(maxsize=None)
+def _parse_rule_set(
+    type: Literal["quantumult", "clash-classical", "clash-ipcidr", "domain-list", "dnsmasq"],
+    url: str,
+    format: Literal["yaml", "text"],
+    resolve: Any,
+) -> ColumnarFilters:
+    # Remote rule sets don't change within a run and IRs are never mutated, so each
+    # (type, url, format, resolve) is fetched and parsed once, and every group, generate and
+    # sing-box `base` re-expansion referencing it shares the same table. Tables are columnar,
+    # so memoized rule sets don't pin one IR object per line for the whole run.
+    if type == "quantumult":
+        irs = parse_clash_classical_filter(url, "text", resolve, source_type="quantumult")
+    elif type == "clash-classical":
+        irs = parse_clash_classical_filter(url, format, resolve)
+    elif type == "clash-ipcidr":
+        irs = parse_clash_ipcidr_filter(url, format, resolve)
+    elif type == "domain-list":
+        irs = parse_domain_list(url, format)
+    else:
+        irs = parse_dnsmasq_conf(url)
+    return ColumnarFilters(irs)
 
 
 class RuleItemKwargsT(TypedDict):
@@ -230,28 +278,27 @@ FilterT = str | RuleItemT | QuantumultXRuleSetT | DomainListT | ClashRuleSetT |
 def parse_filter(
     filter: FilterT,
     match_with_dns: Literal["response", "request"] | None = None,
-) -> Sequence[IRBase]:
-    ret: Sequence[IRBase]
+) -> Iterator[IRBase]:
+    # Remote rule sets are parsed lazily while the caller consumes the returned iterator.
+    ret: Iterable[IRBase]
 
     if isinstance(filter, dict):
         if "type" not in filter:
             raise ValueError(f"filter_info must contain a `type` kwarg if it is a dict")
         if filter["type"] == "quantumult":
-            ret = parse_clash_classical_filter(
-                url=filter["url"], format="text", resolve=filter["resolve"]
-            )
+            ret = _parse_rule_set("quantumult", filter["url"], "text", filter["resolve"])
         elif filter["type"] == "clash-classical":
-            ret = parse_clash_classical_filter(
-                url=filter["url"], format=filter["format"], resolve=filter["resolve"]
+            ret = _parse_rule_set(
+                "clash-classical", filter["url"], filter["format"], filter["resolve"]
             )
         elif filter["type"] == "clash-ipcidr":
-            ret = parse_clash_ipcidr_filter(
-                url=filter["url"], format=filter["format"], resolve=filter["resolve"]
+            ret = _parse_rule_set(
+                "clash-ipcidr", filter["url"], filter["format"], filter["resolve"]
             )
         elif filter["type"] == "domain-list":
-            ret = parse_domain_list(url=filter["url"], format=filter["format"])
+            ret = _parse_rule_set("domain-list", filter["url"], filter["format"], None)
         elif filter["type"] == "dnsmasq":
-            ret = parse_dnsmasq_conf(url=filter["url"])
+            ret = _parse_rule_set("dnsmasq", filter["url"], "text", None)
         elif filter["type"] in _IR_REGISTRY:
             if "args" in filter:
                 if isinstance(filter["args"], Sequence):
@@ -306,8 +353,10 @@ def parse_filter(
                 ir,
             ]
 
-    if not ret:
+    irs = iter(ret)
+    if (first := next(irs, None)) is None:
         raise ValueError(f"Got empty parsing result from: {filter}")
+    ret = itertools.chain((first,), irs)
     if match_with_dns is not None:
         dns_matcher: tuple[type[IRBase], ...]
         if match_with_dns == "request":
@@ -316,6 +365,6 @@ def parse_filter(
             dns_matcher = DNS_RESPONSE_MATCHERS
         else:
             raise ValueError(f"Unsupported {match_with_dns=}, expect request or response")
-        ret = [r for r in ret if isinstance(r, dns_matcher)]
+        ret = (r for r in ret if isinstance(r, dns_matcher))
 
-    return ret
+    return iter(ret)
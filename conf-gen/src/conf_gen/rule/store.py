@@ -0,0 +1,105 @@
+import threading
+from array import array
+from typing import Iterable
+from typing import Iterator
+from typing import Sequence
+from typing import overload
+
+from conf_gen.rule._base_ir import IRBase
+
+# IR types are numbered on first use, codes only live within one process.
+_IR_TYPES: list[type[IRBase]] = []
+_IR_TYPE_CODES: dict[type[IRBase], int] = {}
+_IR_TYPES_LOCK = threading.Lock()
+
+# Resolve options are stored as one byte each.
+_RESOLVE_CODES: dict[bool | None, int] = {None: 0, False: 1, True: 2}
+_RESOLVES: tuple[bool | None, ...] = (None, False, True)
+
+
+def _ir_type_code(ir_type: type[IRBase]) -> int:
+    if (code := _IR_TYPE_CODES.get(ir_type)) is None:
+        with _IR_TYPES_LOCK:
+            if (code := _IR_TYPE_CODES.get(ir_type)) is None:
+                code = _IR_TYPE_CODES[ir_type] = len(_IR_TYPES)
+                _IR_TYPES.append(ir_type)
+    return code
+
+
+class ColumnarFilters(Sequence[IRBase]):
+    # An append-only table of IRs, one row per filter: a type code array, a resolve code array
+    # and (offset, length) arrays into one UTF-8 pool of values. Rows take ~10 bytes plus the
+    # value instead of an IR object and its value string each. IRs are materialized only while
+    # being iterated, so large rule sets like domain sets with 100k+ entries stay compact
+    # between generators.
+
+    def __init__(self, irs: Iterable[IRBase] = ()) -> None:
+        self._types = array("B")
+        self._resolves = bytearray()
+        self._offsets = array("I")
+        self._lengths = array("I")
+        self._pool = bytearray()
+        self.extend(irs)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[tuple[type[IRBase], str, bool | None]]) -> "ColumnarFilters":
+        table = cls()
+        table.extend_rows(rows)
+        return table
+
+    def extend(self, irs: Iterable[IRBase]) -> None:
+        self.extend_rows((type(ir), ir._val, ir._resolve) for ir in irs)
+
+    def extend_rows(self, rows: Iterable[tuple[type[IRBase], str, bool | None]]) -> None:
+        # Appends `(type, val, resolve)` rows as the IRs would be stored, without creating them.
+        # Identical values appended by the same call share one pool entry.
+        pooled: dict[str, int] = {}
+        for ir_type, val, resolve in rows:
+            self._types.append(_ir_type_code(ir_type))
+            self._resolves.append(_RESOLVE_CODES[resolve])
+            encoded = val.encode("utf-8")
+            if (offset := pooled.get(val)) is None:
+                offset = pooled[val] = len(self._pool)
+                self._pool += encoded
+            self._offsets.append(offset)
+            self._lengths.append(len(encoded))
+
+    def __len__(self) -> int:
+        return len(self._types)
+
+    def _row(self, i: int) -> IRBase:
+        offset = self._offsets[i]
+        val = self._pool[offset : offset + self._lengths[i]].decode("utf-8")
+        return _IR_TYPES[self._types[i]](val, _RESOLVES[self._resolves[i]])
+
+    @overload
+    def __getitem__(self, index: int) -> IRBase: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> list[IRBase]: ...
+
+    def __getitem__(self, index: int | slice) -> IRBase | list[IRBase]:
+        if isinstance(index, slice):
+            return [self._row(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ColumnarFilters index out of range")
+        return self._row(index)
+
+    def rows(self) -> Iterator[tuple[type[IRBase], str, bool | None]]:
+        # Walks the columns in lockstep, decoding values straight from a view of the pool.
+        pool = memoryview(self._pool)
+        for code, resolve, offset, length in zip(
+            self._types, self._resolves, self._offsets, self._lengths
+        ):
+            yield _IR_TYPES[code], str(pool[offset : offset + length], "utf-8"), _RESOLVES[resolve]
+
+    def __iter__(self) -> Iterator[IRBase]:
+        for ir_type, val, resolve in self.rows():
+            yield ir_type(val, resolve)
+
+    def __eq__(self, rhs: object) -> bool:
+        if not isinstance(rhs, Sequence):
+            return NotImplemented
+        return len(self) == len(rhs) and all(a == b for a, b in zip(self, rhs))
@@ -1,46 +1,52 @@
+import bisect
+import ipaddress
 from collections import defaultdict
 from dataclasses import dataclass
 from typing import Any
+from typing import Iterable
+from typing import Iterator
 from typing import Literal
+from typing import Sequence
+from warnings import warn
 
 from conf_gen.rule._base_ir import _IR_REGISTRY
 from conf_gen.rule._base_ir import IRBase
-from conf_gen.rule.ir import IPCIDR
-from conf_gen.rule.ir import IPCIDR6
-from conf_gen.rule.ir import PackageName
-from conf_gen.rule.ir import ProcessName
+from conf_gen.rule._base_ir import IRCapability
+from conf_gen.rule.ir import Domain
+from conf_gen.rule.ir import DomainListItem
+from conf_gen.rule.ir import DomainSuffix
+from conf_gen.rule.ir import DstPort
+from conf_gen.rule.ir import SrcIPCIDR
+from conf_gen.rule.ir import SrcPort
+from conf_gen.rule.store import ColumnarFilters
 
-_DST_IP_IRS = (IPCIDR, IPCIDR6)
-_PROCESS_IRS = (PackageName, ProcessName)
+# sing-box ANDs these with the domain matchers of the same rule, see
+# https://sing-box.sagernet.org/configuration/route/rule/.
+_SING_BOX_CONDITIONAL_IRS = (DstPort, SrcIPCIDR, SrcPort)
+
+# The type, value and resolve option of a filter, as columnar filters store it.
+_Row = tuple[type[IRBase], str, bool | None]
 
 
 def group_sing_box_filters(
-    filters: list[IRBase],
+    filters: Sequence[IRBase],
     included_process_irs: list[str] | None = None,
     process_irs_combination_mode: Literal["and", "or"] = "or",
 ) -> dict[str, Any]:
     normal_filters: defaultdict[str, list[str]] = defaultdict(list)
     process_filters: defaultdict[str, list[str]] = defaultdict(list)
-    if included_process_irs is not None:
-        included_process_ir_types = tuple[type[IRBase], ...](_IR_REGISTRY[t] for t in included_process_irs)
-        excluded_process_ir_types = tuple[type[IRBase], ...](set(_PROCESS_IRS) - set(included_process_ir_types))
-    else:
-        included_process_ir_types = None
-        excluded_process_ir_types = _PROCESS_IRS
+    # Process IRs are dropped unless included.
+    included_process_ir_types = tuple[type[IRBase], ...](
+        _IR_REGISTRY[t] for t in included_process_irs or ()
+    )
     for f in filters:
-        try:
-            k, v = f.sing_box_rule
-        except ValueError as e:
-            if str(e).endswith("is not supported by sing-box."):
-                continue
-            else:
-                raise e
-        if excluded_process_ir_types and isinstance(f, excluded_process_ir_types):
+        if (token := f.sing_box_token) is None:
             continue
-        elif included_process_ir_types and isinstance(f, included_process_ir_types):
-            process_filters[k].append(v)
-        else:
+        k, v = token
+        if not f._capabilities & IRCapability.PROCESS:
             normal_filters[k].append(v)
+        elif isinstance(f, included_process_ir_types):
+            process_filters[k].append(v)
     # NOTE: We enforce process-related IRs to take precedence over others if applicable.
     grouped_filters: dict[str, Any]
     if process_filters:
@@ -50,7 +56,7 @@ def group_sing_box_filters(
             "rules": [
                 dict(process_filters),
                 dict(normal_filters),
-            ]
+            ],
         }
     else:
         grouped_filters = dict(normal_filters)
@@ -73,7 +79,9 @@ def split_sing_box_dst_ip_filters(
         for i, sub_rules in enumerate(grouped_filters["rules"]):
             if 0 == i:
                 # The first sub rule group should only consists of process matchers.
-                assert all(_IR_REGISTRY[t] in _PROCESS_IRS for t in sub_rules.keys())
+                assert all(
+                    _IR_REGISTRY[t]._capabilities & IRCapability.PROCESS for t in sub_rules.keys()
+                )
                 process_rules = sub_rules
                 continue
             splitted_sub_rules = split_sing_box_dst_ip_filters(sub_rules, must_have_action=False)
@@ -124,3 +132,347 @@ def split_sing_box_dst_ip_filters(
     if dst_ip_filters:
         dst_ip_filters.update(action)
     return SplittedSingBoxFilters(no_resolve_filters, dst_ip_filters)
+
+
+def _rows(filters: Sequence[IRBase]) -> Iterator[_Row]:
+    # Columnar filters are walked without materializing their IRs.
+    if isinstance(filters, ColumnarFilters):
+        return filters.rows()
+    return ((type(f), f._val, f._resolve) for f in filters)
+
+
+def _rebuild(
+    filters: Sequence[IRBase], keep: bytearray, inserted: dict[int, list[_Row]] | None = None
+) -> Sequence[IRBase]:
+    # The filters flagged in `keep`, where rows `inserted` at a position take the place of the
+    # filter there. Columnar filters are rebuilt from their rows, in the same storage.
+    inserted = inserted or {}
+    if not inserted and all(keep):
+        return filters
+    if isinstance(filters, ColumnarFilters):
+        columnar = filters
+
+        def rows() -> Iterator[_Row]:
+            for i, row in enumerate(columnar.rows()):
+                if i in inserted:
+                    yield from inserted[i]
+                elif keep[i]:
+                    yield row
+
+        return ColumnarFilters.from_rows(rows())
+    rebuilt: list[IRBase] = []
+    for i, f in enumerate(filters):
+        if i in inserted:
+            rebuilt += (ir_type(val, resolve) for ir_type, val, resolve in inserted[i])
+        elif keep[i]:
+            rebuilt.append(f)
+    return rebuilt
+
+
+def _is_conditional(filters: Sequence[IRBase]) -> bool:
+    return any(issubclass(ir_type, _SING_BOX_CONDITIONAL_IRS) for ir_type, _, _ in _rows(filters))
+
+
+def _domain_matcher(ir_type: type[IRBase], val: str) -> tuple[str, bool] | None:
+    # Returns the matched domain and whether it is a suffix, if every target agrees on it.
+    if issubclass(ir_type, Domain):
+        domain, is_suffix = val, False
+    elif issubclass(ir_type, DomainSuffix):
+        domain, is_suffix = val, True
+    elif issubclass(ir_type, DomainListItem):
+        domain = val
+        if "*" in domain:
+            return None
+        elif "+" in domain:
+            # Only `+.example.com` is a plain suffix for all targets, others become regexes.
+            if not (domain.startswith("+") and domain.count("+") == 1):
+                return None
+            domain, is_suffix = domain[1:], True
+        else:
+            is_suffix = False
+        if domain.startswith("."):
+            domain = domain[1:]
+    else:
+        return None
+    if not domain:
+        return None
+    return domain.lower(), is_suffix
+
+
+class _DomainIndex:
+    # Suffixes and exact domains in two flat sets, which take a fraction of the memory of a
+    # trie of nested dicts. A domain is shadowed by a suffix equal to it or to any of its parent
+    # domains, e.g., `cdn.example.com` by `example.com` or `com`.
+
+    def __init__(self) -> None:
+        self._suffixes: set[str] = set()
+        self._exacts: set[str] = set()
+
+    def shadows(self, domain: str, is_suffix: bool) -> bool:
+        i = -1
+        while True:
+            if domain[i + 1 :] in self._suffixes:
+                return True
+            if (i := domain.find(".", i + 1)) == -1:
+                break
+        return not is_suffix and domain in self._exacts
+
+    def add(self, domain: str, is_suffix: bool) -> None:
+        (self._suffixes if is_suffix else self._exacts).add(domain)
+
+
+def prune_shadowed_domain_filters(
+    filters_list: Iterable[Sequence[IRBase]],
+) -> Iterator[Sequence[IRBase]]:
+    # Drops domain filters that can never match since an earlier suffix (or the same domain) in
+    # the same or a preceding list catches them first. Lists are given in rule order, and each
+    # is yielded once pruned, so callers can repack it before the next one is materialized.
+    # Columnar lists are pruned by their rows and yielded columnar.
+    global_index = _DomainIndex()
+    for filters in filters_list:
+        # Domains of a list with port or source conditions only match under these conditions in
+        # sing-box, so they only shadow later domains of the same list.
+        local_index = _DomainIndex() if _is_conditional(filters) else global_index
+        keep = bytearray()
+        for ir_type, val, _ in _rows(filters):
+            if (matcher := _domain_matcher(ir_type, val)) is not None:
+                if global_index.shadows(*matcher) or local_index.shadows(*matcher):
+                    keep.append(False)
+                    continue
+                local_index.add(*matcher)
+            keep.append(True)
+        yield _rebuild(filters, keep)
+
+
+def _cidr_to_range(val: str) -> tuple[int, int, int] | None:
+    # Returns the IP version and the first and last addresses of an IP-CIDR filter.
+    try:
+        network = ipaddress.ip_network(val, strict=False)
+    except ValueError:
+        return None
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def _merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    merged: list[tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if merged[-1][1] < end:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Ranges added at once from which splicing them into the index beats inserting them one by one.
+_SPLICE_MIN_RANGES = 32
+
+
+class IPIntervalIndex:
+    # Sorted, disjoint address ranges of one IP version, each owned by the first list that
+    # routed it. The union of all ranges is kept merged as well, so containment is a single
+    # bisection.
+
+    def __init__(self) -> None:
+        self._starts: list[int] = []
+        self._ends: list[int] = []
+        self._owners: list[int] = []
+        self._union_starts: list[int] = []
+        self._union_ends: list[int] = []
+
+    def covers(self, start: int, end: int) -> bool:
+        i = bisect.bisect_right(self._union_starts, start) - 1
+        return 0 <= i and end <= self._union_ends[i]
+
+    def owners(self, start: int, end: int) -> list[int]:
+        # Owners of ranges intersecting [start, end], in address order.
+        owners: list[int] = []
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        while i < len(self._starts) and self._starts[i] <= end:
+            if start <= self._ends[i] and self._owners[i] not in owners:
+                owners.append(self._owners[i])
+            i += 1
+        return owners
+
+    def _insert(self, start: int, end: int, owner: int) -> None:
+        i = bisect.bisect_left(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._owners.insert(i, owner)
+        i = bisect.bisect_left(self._union_starts, start)
+        joins_prev = 0 < i and self._union_ends[i - 1] + 1 == start
+        joins_next = i < len(self._union_starts) and self._union_starts[i] == end + 1
+        if joins_prev and joins_next:
+            self._union_ends[i - 1] = self._union_ends.pop(i)
+            del self._union_starts[i]
+        elif joins_prev:
+            self._union_ends[i - 1] = end
+        elif joins_next:
+            self._union_starts[i] = start
+        else:
+            self._union_starts.insert(i, start)
+            self._union_ends.insert(i, end)
+
+    def add(self, ranges: list[tuple[int, int]], owner: int) -> None:
+        # Only the parts of `ranges` not covered yet become owned by `owner`.
+        new_ranges = []
+        for start, end in _merge_ranges(ranges):
+            # Walk the union ranges intersecting [start, end] and keep the gaps between them.
+            i = max(bisect.bisect_right(self._union_starts, start) - 1, 0)
+            while start <= end:
+                if i < len(self._union_starts) and self._union_starts[i] <= end:
+                    if start < self._union_starts[i]:
+                        new_ranges.append((start, self._union_starts[i] - 1, owner))
+                    start = max(start, self._union_ends[i] + 1)
+                    i += 1
+                else:
+                    new_ranges.append((start, end, owner))
+                    break
+        # New ranges only fill gaps of the union, so they are put into place (and joined with the
+        # union ranges they touch) instead of re-sorting everything. A few are inserted one by
+        # one, more are spliced in one pass over the lists.
+        if len(new_ranges) < _SPLICE_MIN_RANGES:
+            for start, end, owner in new_ranges:
+                self._insert(start, end, owner)
+            return
+        starts: list[int] = []
+        ends: list[int] = []
+        owners: list[int] = []
+        union_starts: list[int] = []
+        union_ends: list[int] = []
+        prev = prev_union = 0
+        for start, end, owner in new_ranges:
+            i = bisect.bisect_left(self._starts, start)
+            starts += self._starts[prev:i]
+            ends += self._ends[prev:i]
+            owners += self._owners[prev:i]
+            starts.append(start)
+            ends.append(end)
+            owners.append(owner)
+            prev = i
+            i = bisect.bisect_left(self._union_starts, start)
+            union_starts += self._union_starts[prev_union:i]
+            union_ends += self._union_ends[prev_union:i]
+            prev_union = i
+            if union_ends and union_ends[-1] + 1 == start:
+                union_ends[-1] = end
+            else:
+                union_starts.append(start)
+                union_ends.append(end)
+            if i < len(self._union_starts) and self._union_starts[i] == end + 1:
+                union_ends[-1] = self._union_ends[i]
+                prev_union = i + 1
+        self._starts = starts + self._starts[prev:]
+        self._ends = ends + self._ends[prev:]
+        self._owners = owners + self._owners[prev:]
+        self._union_starts = union_starts + self._union_starts[prev_union:]
+        self._union_ends = union_ends + self._union_ends[prev_union:]
+
+
+def _range_to_cidrs(version: int, start: int, end: int) -> list[str]:
+    # Splits [start, end] into the fewest aligned prefixes.
+    max_bits = 32 if version == 4 else 128
+    address = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    cidrs = []
+    while start <= end:
+        bits = min(
+            (start & -start).bit_length() - 1 if start else max_bits,
+            (end - start + 1).bit_length() - 1,
+        )
+        cidrs.append(f"{address(start)}/{max_bits - bits}")
+        start += 1 << bits
+    return cidrs
+
+
+def aggregate_ip_cidr_filters(
+    filters_list: Iterable[Sequence[IRBase]],
+    names: Sequence[str] | None = None,
+) -> Iterator[Sequence[IRBase]]:
+    # Merges adjacent and overlapping IP-CIDR filters of each list into the fewest covering
+    # prefixes, and drops prefixes already covered by preceding lists with the same resolve
+    # option. Resolving and non-resolving IP rules are ordered differently by the clients, so
+    # they never cover each other. Prefixes only partly covered by preceding lists are
+    # reported with the lists owning the overlap, as they are often configuration mistakes.
+    # Lists are given in rule order, columnar lists are aggregated by their rows.
+    indices: dict[tuple[int, bool | None], IPIntervalIndex] = defaultdict(IPIntervalIndex)
+    for i, filters in enumerate(filters_list):
+        ranges: dict[tuple[type[IRBase], int, bool | None], list[tuple[int, int]]] = {}
+        # Aggregated prefixes take the place of the first filter of their kind.
+        firsts: dict[int, tuple[type[IRBase], int, bool | None]] = {}
+        keep = bytearray()
+        overlaps: defaultdict[int, list[str]] = defaultdict(list)
+        for j, (ir_type, val, resolve) in enumerate(_rows(filters)):
+            if (
+                not ir_type._capabilities & IRCapability.DST_IP
+                or (r := _cidr_to_range(val)) is None
+            ):
+                keep.append(True)
+                continue
+            keep.append(False)
+            version, start, end = r
+            key = (ir_type, version, resolve)
+            if (index := indices.get((version, resolve))) is not None:
+                if index.covers(start, end):
+                    continue
+                for owner in index.owners(start, end):
+                    overlaps[owner].append(val)
+            if key not in ranges:
+                ranges[key] = []
+                firsts[j] = key
+            ranges[key].append((start, end))
+        for owner, partial in overlaps.items():
+            name, owner_name = (names[i], names[owner]) if names else (f"#{i}", f"#{owner}")
+            warn(
+                f"{len(partial)} IP rules of {name} partially overlap {owner_name} which "
+                f"precedes it, e.g., {partial[0]}."
+            )
+
+        inserted: dict[int, list[_Row]] = {}
+        for j, (ir_type, version, resolve) in firsts.items():
+            inserted[j] = [
+                (ir_type, cidr, resolve)
+                for start, end in _merge_ranges(ranges[(ir_type, version, resolve)])
+                for cidr in _range_to_cidrs(version, start, end)
+            ]
+        yield _rebuild(filters, keep, inserted)
+
+        # Like domains, IPs of lists with port or source conditions don't shadow other lists.
+        if not _is_conditional(filters):
+            for (_, version, resolve), group_ranges in ranges.items():
+                indices[(version, resolve)].add(group_ranges, owner=i)
+
+
+def prune_shadowed_sing_box_dst_ip_filters(dst_ip_filters: list[dict[str, Any]]) -> int:
+    # sing-box matches every group's `ip_cidr` after one shared `resolve` action, regardless of
+    # the resolve option of the IR, so a prefix covered by preceding groups' prefixes is
+    # unreachable there even when Clash and Quantumult X still reach it. Prunes these in place,
+    # dropping rules left empty, and returns the number of pruned prefixes.
+    indices: dict[int, IPIntervalIndex] = defaultdict(IPIntervalIndex)
+    num_pruned = 0
+    for i, rule in enumerate(list(dst_ip_filters)):
+        # Process matchers are combined in a logical rule, see `split_sing_box_dst_ip_filters`.
+        matchers = rule["rules"][1] if rule.get("type") == "logical" else rule
+        kept_cidrs: list[str] = []
+        ranges: defaultdict[int, list[tuple[int, int]]] = defaultdict(list)
+        for cidr in matchers["ip_cidr"]:
+            try:
+                network = ipaddress.ip_network(cidr, strict=False)
+            except ValueError:
+                kept_cidrs.append(cidr)
+                continue
+            start, end = int(network.network_address), int(network.broadcast_address)
+            if indices[network.version].covers(start, end):
+                num_pruned += 1
+                continue
+            kept_cidrs.append(cidr)
+            ranges[network.version].append((start, end))
+        matchers["ip_cidr"] = kept_cidrs
+        if rule.get("type") != "logical" or rule["mode"] == "or":
+            for version, version_ranges in ranges.items():
+                indices[version].add(version_ranges, owner=i)
+    dst_ip_filters[:] = [
+        r
+        for r in dst_ip_filters
+        if (r["rules"][1] if r.get("type") == "logical" else r)["ip_cidr"]
+    ]
+    return num_pruned
@@ -318,7 +318,8 @@ def redact_sing_box_config(config: dict[str, Any]) -> dict[str, Any]:
 def rule_set_compiler() -> Iterator[RuleSetCompiler]:
     from conf_gen.generator.sing_box_generator import RuleSetCompiler
 
-    with RuleSetCompiler() as compiler:
+    # The subprocess path, whose binary the tests use to check and run the configs.
+    with RuleSetCompiler(native=False) as compiler:
         yield compiler
 
 
@@ -0,0 +1,385 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import threading
+import time
+from collections import Counter
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+import requests
+
+_PAYLOADS = {
+    "/direct.txt": b"# comment\nDOMAIN-SUFFIX,example.com\nDOMAIN,www.example.org\n",
+    "/ip.txt": b"1.0.0.0/24\n2001:db8::/32\n",
+    "/literal.txt": (
+        b"IP-ASN,13335,no-resolve\nip_cidr,1.0.0.0/24,no-resolve\nDOMAIN,example.com,resolve\n"
+        b"URL-REGEX,^https?://ads\\.,resolve\nIP-ASN,15169,no-resolve\nPROCESS-NAME,curl,x\n"
+    ),
+    "/media.yaml": (
+        b"# comment\nmeta: {name: media, tags: [a, b]}\npayload:\n"
+        b"  - DOMAIN-SUFFIX,example.net\n  - 'DOMAIN-KEYWORD,this_ruleset_is_made_by_sukkaw'\n"
+        b'  - "IP-CIDR,1.1.1.0/24,no-resolve"\nupdated: 2024-01-01\n'
+    ),
+}
+
+
+class _PayloadHandler(BaseHTTPRequestHandler):
+    hits: Counter[str] = Counter()
+    not_modified: Counter[str] = Counter()
+    compressed: Counter[str] = Counter()
+
+    def do_GET(self) -> None:
+        path = self.path.split("?")[0]
+        self.hits[path] += 1
+        if path == "/slow.txt":
+            time.sleep(1)
+            path = "/direct.txt"
+        if (body := _PAYLOADS.get(path)) is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.not_modified[path] += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("ETag", etag)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            self.compressed[path] += 1
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def payload_server() -> Iterator[str]:
+    _PayloadHandler.hits.clear()
+    _PayloadHandler.not_modified.clear()
+    _PayloadHandler.compressed.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _PayloadHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join(timeout=5)
+
+
+def test_collect_remote_resources_covers_rules_subscriptions_and_rewrites() -> None:
+    from conf_gen.fetch import collect_remote_resources
+
+    src_conf = {
+        "rules": [
+            {
+                "name": "Direct",
+                "filters": [
+                    "DOMAIN,example.com",
+                    {"type": "clash-classical", "url": "https://a/direct.txt"},
+                    {"type": "domain-list", "url": "https://a/cdn.txt"},
+                ],
+            },
+            {"name": "Final", "filters": [{"type": "match"}]},
+        ],
+        "subscriptions": [
+            {"type": "clash", "url": "https://b/sub", "backup_url": "https://b/backup"},
+        ],
+        "rewrites": [{"type": "quantumult", "url": "https://c/rewrite.list"}],
+        "generates": [
+            {"dns": {"rules": [{"filters": [{"type": "dnsmasq", "url": "https://a/d.conf"}]}]}},
+        ],
+    }
+
+    urls = [r.url for r in collect_remote_resources(src_conf)]
+
+    assert urls == [
+        "https://a/direct.txt",
+        "https://a/cdn.txt",
+        "https://a/d.conf",
+        "https://b/sub",
+        "https://c/rewrite.list",
+    ]
+
+
+def test_prefetched_payloads_are_served_without_refetching(payload_server: str) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    fetcher = Fetcher(max_workers=4)
+    resources = [
+        RemoteResource(url=f"{payload_server}/direct.txt"),
+        RemoteResource(url=f"{payload_server}/ip.txt"),
+        RemoteResource(url=f"{payload_server}/direct.txt"),
+    ]
+
+    fetcher.prefetch(resources)
+    payload = fetcher.fetch(RemoteResource(url=f"{payload_server}/direct.txt"))
+
+    assert payload.text.splitlines()[1] == "DOMAIN-SUFFIX,example.com"
+    assert _PayloadHandler.hits == Counter({"/direct.txt": 1, "/ip.txt": 1})
+
+
+def test_failed_prefetch_is_raised_on_demand(payload_server: str) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    fetcher = Fetcher()
+    missing = RemoteResource(url=f"{payload_server}/missing.txt")
+    present = RemoteResource(url=f"{payload_server}/direct.txt")
+
+    with pytest.warns(UserWarning, match="Prefetching"):
+        assert fetcher.prefetch([missing, present]) == [missing]
+    with pytest.raises(requests.HTTPError, match="404"):
+        fetcher.fetch(missing)
+
+
+def test_cached_payloads_are_revalidated_across_runs(payload_server: str, tmp_path: Path) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    resource = RemoteResource(url=f"{payload_server}/direct.txt", kind="clash-classical")
+
+    first = Fetcher(cache_dir=tmp_path, max_age={"clash-classical": 0}).fetch(resource)
+    second = Fetcher(cache_dir=tmp_path, max_age={"clash-classical": 0}).fetch(resource)
+
+    assert second.content == first.content
+    assert _PayloadHandler.hits["/direct.txt"] == 2
+    assert _PayloadHandler.not_modified["/direct.txt"] == 1
+
+
+def test_fresh_cached_payloads_skip_the_network(payload_server: str, tmp_path: Path) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    resource = RemoteResource(url=f"{payload_server}/ip.txt", kind="clash-ipcidr")
+
+    Fetcher(cache_dir=tmp_path).fetch(resource)
+    payload = Fetcher(cache_dir=tmp_path).fetch(resource)
+
+    assert payload.text.startswith("1.0.0.0/24")
+    assert _PayloadHandler.hits["/ip.txt"] == 1
+    assert payload.sha256 == hashlib.sha256(payload.content).hexdigest()
+    assert replace(payload, sha256=None).hexdigest() == payload.sha256
+
+
+def test_frozen_fetcher_replays_locked_payloads_offline(
+    payload_server: str, tmp_path: Path
+) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import Lockfile
+    from conf_gen.fetch import RemoteResource
+
+    resource = RemoteResource(url=f"{payload_server}/direct.txt", kind="clash-classical")
+    lockfile = Lockfile()
+    locked = Fetcher(cache_dir=tmp_path / "cache", lockfile=lockfile).fetch(resource)
+    lockfile.dump(tmp_path / "source.lock.json")
+
+    frozen = Fetcher(
+        cache_dir=tmp_path / "cache",
+        lockfile=Lockfile.load(tmp_path / "source.lock.json"),
+        frozen=True,
+    )
+    replayed = frozen.fetch(resource)
+
+    assert replayed.content == locked.content
+    assert _PayloadHandler.hits["/direct.txt"] == 1
+    with pytest.raises(RuntimeError, match="not recorded in the lockfile"):
+        frozen.fetch(RemoteResource(url=f"{payload_server}/ip.txt"))
+    with pytest.raises(RuntimeError, match="not recorded in the lockfile"):
+        frozen.resolve_redirect(f"{payload_server}/latest")
+
+
+def test_rule_sets_are_streamed_from_cached_payloads(payload_server: str, tmp_path: Path) -> None:
+    from conf_gen.fetch import configure
+    from conf_gen.rule import parse_filter
+
+    text_filter = {"type": "clash-classical", "url": f"{payload_server}/direct.txt"}
+    yaml_filter = {"type": "clash-classical", "url": f"{payload_server}/media.yaml"}
+
+    configure(cache_dir=tmp_path)
+    try:
+        text_irs = parse_filter({**text_filter, "format": "text", "resolve": False})
+        yaml_irs = parse_filter({**yaml_filter, "format": "yaml", "resolve": False})
+        assert [ir.clash_rule for ir in text_irs] == [
+            "DOMAIN-SUFFIX,example.com",
+            "DOMAIN,www.example.org",
+        ]
+        assert [ir.clash_rule for ir in yaml_irs] == [
+            "DOMAIN-SUFFIX,example.net",
+            "IP-CIDR,1.1.1.0/24,no-resolve",
+        ]
+    finally:
+        configure()
+
+
+def test_rule_sets_are_parsed_once_per_run(payload_server: str) -> None:
+    from conf_gen.rule import parse_filter
+
+    ip_filter = {"type": "clash-ipcidr", "url": f"{payload_server}/ip.txt", "format": "text"}
+
+    first = list(parse_filter({**ip_filter, "resolve": False}))
+    second = list(parse_filter({**ip_filter, "resolve": False}))
+    resolved = list(parse_filter({**ip_filter, "resolve": True}))
+
+    assert first == second
+    assert [ir.clash_rule for ir in resolved] == ["IP-CIDR,1.0.0.0/24", "IP-CIDR6,2001:db8::/32"]
+    assert _PayloadHandler.hits["/ip.txt"] == 1
+
+
+def test_unregistered_rule_types_are_reported_once(payload_server: str) -> None:
+    from conf_gen.rule import parse_filter
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import Domain
+    from conf_gen.rule.ir import ProcessName
+
+    literal_filter = {"type": "clash-classical", "url": f"{payload_server}/literal.txt"}
+
+    with pytest.warns(UserWarning, match=r"Skipped 3 rules .*: IP-ASN \(2\), URL-REGEX \(1\)"):
+        irs = list(parse_filter({**literal_filter, "format": "text", "resolve": "literal"}))
+    assert irs == [
+        IPCIDR("1.0.0.0/24", resolve=False),
+        Domain("example.com", resolve=True),
+        ProcessName("curl"),
+    ]
+
+
+def test_slow_primary_is_hedged_with_backup(payload_server: str) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    resource = RemoteResource(
+        url=f"{payload_server}/slow.txt",
+        backup_url=f"{payload_server}/ip.txt",
+        hedge_delay=0.1,
+    )
+
+    fetcher = Fetcher()
+    threads = set(threading.enumerate())
+
+    start = time.monotonic()
+    payload = fetcher.fetch(resource)
+
+    assert time.monotonic() - start < 0.9
+    assert payload.url == f"{payload_server}/ip.txt"
+    # The slow primary is still in flight until joined, e.g., before forking.
+    fetcher.join_requests()
+    assert not [
+        t for t in set(threading.enumerate()) - threads if t.name.startswith("ThreadPoolExecutor")
+    ]
+
+
+def test_failed_primary_and_backup_fall_back_to_cache(
+    payload_server: str, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    url = f"{payload_server}/direct.txt"
+    fetcher = Fetcher(cache_dir=tmp_path, cache_private=True)
+    cached = fetcher.fetch(RemoteResource(url=url, kind="subscription"))
+    monkeypatch.delitem(_PAYLOADS, "/direct.txt")
+    resource = RemoteResource(
+        url=url, backup_url=f"{payload_server}/missing.txt", kind="subscription"
+    )
+
+    with pytest.warns(UserWarning, match="falling back to the copy cached"):
+        payload = Fetcher(cache_dir=tmp_path, cache_private=True).fetch(resource)
+
+    assert payload.content == cached.content
+    assert _PayloadHandler.hits["/missing.txt"] == 1
+
+
+def test_subscriptions_are_only_cached_on_request(payload_server: str, tmp_path: Path) -> None:
+    import stat
+
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    cache_dir = tmp_path / "cache"
+    subscription = RemoteResource(url=f"{payload_server}/direct.txt", kind="subscription")
+    Fetcher(cache_dir=cache_dir).fetch(subscription)
+    assert not list(cache_dir.iterdir())
+
+    Fetcher(cache_dir=cache_dir, cache_private=True).fetch(subscription)
+    assert stat.S_IMODE(cache_dir.stat().st_mode) == 0o700
+    assert list(cache_dir.iterdir())
+    assert all(stat.S_IMODE(path.stat().st_mode) == 0o600 for path in cache_dir.iterdir())
+
+
+def test_uncached_payloads_are_streamed_to_scratch(payload_server: str) -> None:
+    import gc
+
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    fetcher = Fetcher()
+    rules = RemoteResource(url=f"{payload_server}/ip.txt")
+    subscription = RemoteResource(url=f"{payload_server}/direct.txt", kind="subscription")
+
+    payload = fetcher.fetch(rules)
+    assert payload.body is None and payload.path is not None
+    assert payload.text.splitlines()[0] == "1.0.0.0/24"
+    # Credentials never go to disk unless asked for, and are dropped once parsed.
+    assert fetcher.fetch(subscription).path is None
+    fetcher.release(subscription)
+    fetcher.fetch(subscription)
+    assert _PayloadHandler.hits == Counter({"/ip.txt": 1, "/direct.txt": 2})
+
+    scratch = payload.path.parent
+    del fetcher, payload
+    gc.collect()
+    assert not scratch.exists()
+
+
+def test_pickled_fetchers_keep_payloads_and_the_scratch_owner(payload_server: str) -> None:
+    import gc
+    import pickle
+
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+
+    fetcher = Fetcher()
+    rules = RemoteResource(url=f"{payload_server}/direct.txt")
+    fetcher.prefetch([rules])
+
+    worker = pickle.loads(pickle.dumps(fetcher))
+    assert worker.fetch(rules).text == fetcher.fetch(rules).text
+    # The copy downloads into the original's scratch directory, which only the original removes.
+    payload = worker.fetch(RemoteResource(url=f"{payload_server}/ip.txt"))
+    assert payload.path is not None and payload.path.parent == fetcher.fetch(rules).path.parent
+    del worker
+    gc.collect()
+    assert payload.path.exists()
+    assert _PayloadHandler.hits == Counter({"/direct.txt": 1, "/ip.txt": 1})
+
+
+def test_payloads_are_compressed_on_the_wire_and_at_rest(
+    payload_server: str, tmp_path: Path
+) -> None:
+    from conf_gen.fetch import Fetcher
+    from conf_gen.fetch import RemoteResource
+    from conf_gen.fetch.cache import BLOB_SUFFIX
+    from conf_gen.fetch.cache import open_blob
+
+    payload = Fetcher(cache_dir=tmp_path).fetch(RemoteResource(url=f"{payload_server}/ip.txt"))
+
+    assert _PayloadHandler.compressed["/ip.txt"] == 1
+    assert payload.path is not None and payload.path.name.endswith(BLOB_SUFFIX)
+    assert payload.path.read_bytes() != _PAYLOADS["/ip.txt"]
+    with open_blob(payload.path) as f:
+        assert f.read() == _PAYLOADS["/ip.txt"]
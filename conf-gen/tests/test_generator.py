@@ -0,0 +1,465 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+
+def test_generation_chains_follow_base_references() -> None:
+    from conf_gen.generator import _generation_chains
+
+    generate_info = [
+        {"name": "clash", "type": "clash"},
+        {"name": "sing-box", "type": "sing-box"},
+        {"name": "quantumult", "type": "quantumult"},
+        {"name": "sing-box-daemon", "type": "sing-box", "base": "sing-box"},
+        {"name": "sing-box-tun", "type": "sing-box", "base": "sing-box-daemon"},
+    ]
+
+    chains = _generation_chains(generate_info)
+
+    assert [[g["name"] for g in c] for c in chains] == [
+        ["clash"],
+        ["sing-box", "sing-box-daemon", "sing-box-tun"],
+        ["quantumult"],
+    ]
+    with pytest.raises(ValueError, match="not defined before"):
+        _generation_chains(generate_info[::-1])
+
+
+def test_only_the_selected_generates_are_written(tmp_path: Path) -> None:
+    from conf_gen.generator import generate_conf
+
+    generate_info = [{"name": "clash", "type": "clash"}, {"name": "clash-lite", "type": "clash"}]
+    generate_args: dict[str, Any] = dict(
+        src="source.yaml", dst=str(tmp_path), proxies=[], per_region_proxies=[], proxy_groups=[]
+    )
+
+    generate_conf(generate_info, only=["clash-lite"], **generate_args)
+    assert sorted(p.name for p in tmp_path.glob("*.yaml")) == ["clash-lite.yaml"]
+    generate_conf(generate_info, **generate_args)
+    assert sorted(p.name for p in tmp_path.glob("*.yaml")) == ["clash-lite.yaml", "clash.yaml"]
+    with pytest.raises(ValueError, match="Unknown generates: quantumult"):
+        generate_conf(generate_info, only=["quantumult"], **generate_args)
+
+
+def _generate_in_worker(ruleset_literals: dict[str, Any]) -> tuple[Any, dict[str, bytes]]:
+    from conf_gen.generator import _SHARED_ARGS
+    from conf_gen.generator import sing_box_generator
+
+    # Workers compile serially instead of forking a pool of their own.
+    sing_box_generator.ProcessPoolExecutor = None  # type: ignore[assignment, misc]
+    compiler = sing_box_generator.RuleSetCompiler(max_workers=2)
+    binaries = compiler.compile(ruleset_literals)
+    return _SHARED_ARGS, {tag: b.getvalue() for tag, b in binaries.items()}
+
+
+def test_generate_workers_get_the_inputs_and_compile_serially() -> None:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from conf_gen.fetch import Fetcher
+    from conf_gen.generator import _init_worker
+    from conf_gen.generator.sing_box_generator import _PARALLEL_MIN_SIZE
+    from conf_gen.generator.sing_box_generator import RuleSetCompiler
+
+    ruleset_literals: dict[str, Any] = {
+        f"route.{i}": {"domain_suffix": [f"{j}.example{i}.com" for j in range(_PARALLEL_MIN_SIZE)]}
+        for i in range(2)
+    }
+    shared_args = ("source.yaml", "output", [], [], [], None)
+    with ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(shared_args, Fetcher()),
+    ) as pool:
+        worker_args, binaries = pool.submit(_generate_in_worker, ruleset_literals).result()
+
+    assert worker_args == shared_args
+    expected = RuleSetCompiler(max_workers=1).compile(ruleset_literals)
+    assert binaries == {tag: b.getvalue() for tag, b in expected.items()}
+
+
+def test_fingerprints_only_depend_on_content() -> None:
+    from conf_gen.generator._manifest import fingerprint
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.store import ColumnarFilters
+
+    irs = [DomainSuffix("example.com"), DomainSuffix("example.org")]
+
+    assert fingerprint({"a": 1, "b": {2, 3}}, irs) == fingerprint(
+        {"b": {3, 2}, "a": 1}, ColumnarFilters(irs)
+    )
+    assert fingerprint(irs) != fingerprint(irs[::-1])
+    assert fingerprint(["1", 1]) != fingerprint([1, "1"]) != fingerprint([[1], 1])
+    with pytest.raises(TypeError, match="Cannot fingerprint"):
+        fingerprint(object())
+
+
+def test_manifest_tracks_fingerprints_and_outputs(tmp_path: Path) -> None:
+    from conf_gen.generator._base_generator import write_output
+    from conf_gen.generator._manifest import Manifest
+
+    dst = str(tmp_path)
+    path = str(tmp_path / "clash.yaml")
+    manifest = Manifest.load(dst)
+    manifest.record("clash", "fp", {path: write_output(path, "rules: []\n")})
+    manifest.dump()
+    mtime = os.stat(path).st_mtime_ns
+
+    manifest = Manifest.load(dst)
+    assert manifest.is_fresh("clash", "fp")
+    assert not manifest.is_fresh("clash", "other-fp") and not manifest.is_fresh("sing-box", "fp")
+    write_output(path, "rules: []\n")
+    assert os.stat(path).st_mtime_ns == mtime
+    write_output(path, "rules: [MATCH,DIRECT]\n")
+    assert not manifest.is_fresh("clash", "fp")
+    assert sorted(os.listdir(tmp_path)) == [".conf-gen-manifest.json", "clash.yaml"]
+
+
+def test_streamed_yaml_matches_pure_python_emitter() -> None:
+    import io
+
+    import yaml
+    from conf_gen.generator.clash_generator import _STREAMED_CHUNK_SIZE
+    from conf_gen.generator.clash_generator import dump_yaml
+
+    if not hasattr(yaml, "CSafeDumper"):
+        pytest.skip("PyYAML is built without libyaml")
+    group = "\U0001f1ed\U0001f1f0 Hong Kong"
+    conf = {
+        "rules": [
+            f"DOMAIN-SUFFIX,{i}.example.com,{group}" for i in range(_STREAMED_CHUNK_SIZE + 1)
+        ]
+        + ['DOMAIN-KEYWORD,"quoted",\U0001f600', "MATCH,DIRECT"],
+        "proxies": [{"name": f"{group} {i}", "port": 443, "udp": True} for i in range(3)],
+        "proxy-groups": [{"name": group, "type": "select", "proxies": []}],
+        "dns": {"": None, "nameserver": ["例子.example.com", "null", "1e3", "- x"]},
+        "hosts": {"\U0001f600": "\x85", "k" * 200: "#"},
+        "mode": "rule",
+    }
+    stream = io.StringIO()
+
+    dump_yaml(conf, stream)
+
+    assert stream.getvalue() == yaml.dump(
+        conf, Dumper=yaml.SafeDumper, allow_unicode=True, line_break="\n"
+    )
+
+
+def test_streamed_yaml_does_not_alias_objects_shared_across_chunks() -> None:
+    import io
+
+    import yaml
+    from conf_gen.generator.clash_generator import _STREAMED_CHUNK_SIZE
+    from conf_gen.generator.clash_generator import _SafeDumper
+    from conf_gen.generator.clash_generator import dump_yaml
+
+    alpn = ["h2", "http/1.1"]
+    proxies = [{"name": f"p{i}", "alpn": alpn} for i in range(_STREAMED_CHUNK_SIZE * 2 + 1)]
+    conf = {"proxies": proxies, "proxy-groups": [{"name": "all", "alpn": alpn}]}
+    stream = io.StringIO()
+
+    dump_yaml(conf, stream)
+
+    assert "&id" not in stream.getvalue()
+    assert yaml.safe_load(stream.getvalue()) == conf
+    assert stream.getvalue() == yaml.dump(
+        conf, Dumper=_SafeDumper, allow_unicode=True, line_break="\n"
+    )
+
+
+def test_large_clash_rule_lists_are_moved_into_rule_providers() -> None:
+    from conf_gen.generator.clash_generator import extract_rule_providers
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import Domain
+    from conf_gen.rule.ir import DomainKeyword
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.ir import GeoIP
+    from conf_gen.rule.ir import Match
+
+    def section(*rules):
+        return [(ir.clash_token, policy) for policy, irs in rules for ir in irs]
+
+    no_resolve = section(
+        ("Ad Block", [DomainKeyword("ad"), Domain("a.example.com"), DomainSuffix("example.org")]),
+        ("Ad Block", [IPCIDR("10.0.0.0/8", resolve=False), GeoIP("CN", resolve=False)]),
+        ("Global", [DomainSuffix("example.net"), IPCIDR("11.0.0.0/8", resolve=False)]),
+    )
+    resolve = section(
+        ("Global", [IPCIDR("1.0.0.0/8", resolve=True), IPCIDR("2.0.0.0/8", resolve=True)]),
+        ("DIRECT", [Match(resolve=True)]),
+    )
+
+    rules, providers = extract_rule_providers([no_resolve, resolve], min_size=2)
+
+    assert rules == [
+        "DOMAIN-KEYWORD,ad,Ad Block",
+        "RULE-SET,Ad_Block.domain,Ad Block",
+        "IP-CIDR,10.0.0.0/8,Ad Block,no-resolve",
+        "GEOIP,CN,Ad Block,no-resolve",
+        "DOMAIN-SUFFIX,example.net,Global",
+        "IP-CIDR,11.0.0.0/8,Global,no-resolve",
+        "RULE-SET,Global.resolve.ipcidr,Global",
+        "MATCH,DIRECT",
+    ]
+    assert providers == {
+        "Ad_Block.domain": ("domain", ["a.example.com", "+.example.org"]),
+        "Global.resolve.ipcidr": ("ipcidr", ["1.0.0.0/8", "2.0.0.0/8"]),
+    }
+
+
+def test_mrs_matchers_are_encoded_like_mihomo() -> None:
+    import struct
+
+    from conf_gen.generator.clash_generator import _mrs_domain_set
+    from conf_gen.generator.clash_generator import _mrs_ip_cidr_set
+
+    # `+.A` is stored as the reversed keys `a` and `a.+`: 4 nodes, of which 1 and 3 are leaves.
+    assert (
+        _mrs_domain_set(["+.A"]) == b"\x01" + struct.pack(">qQqQq", 1, 0b1010, 1, 106, 3) + b"a.+"
+    )
+    mapped = bytes(10) + b"\xff\xff"
+    assert _mrs_ip_cidr_set(["2001:db8::/32", "10.0.0.128/25", "10.0.0.0/25", "10.0.0.1/32"]) == (
+        b"\x01"
+        + struct.pack(">q", 2)
+        + mapped
+        + bytes([10, 0, 0, 0])
+        + mapped
+        + bytes([10, 0, 0, 255])
+        + bytes.fromhex("20010db8" + "00" * 12)
+        + bytes.fromhex("20010db8" + "ff" * 12)
+    )
+
+
+def test_mrs_rule_providers_have_a_header() -> None:
+    from conf_gen.fetch.cache import zstd
+    from conf_gen.generator.clash_generator import _mrs_ip_cidr_set
+    from conf_gen.generator.clash_generator import encode_mrs
+
+    if zstd is None:
+        pytest.skip("zstd is not available")
+    payload = ["10.0.0.0/8", "10.0.0.0/16"]
+
+    assert zstd.decompress(encode_mrs("ipcidr", payload)) == (
+        b"MRS\x01\x01" + bytes(7) + b"\x02" + bytes(8) + _mrs_ip_cidr_set(payload)
+    )
+    with pytest.raises(ValueError, match="do not support"):
+        encode_mrs("classical", ["DOMAIN-KEYWORD,example"])
+
+
+def test_large_quantumult_filter_lists_are_moved_to_filter_remote(tmp_path: Path) -> None:
+    from conf_gen.generator.quantumult_generator import QuantumultGenerator
+    from conf_gen.proxy_group.selective_proxy_group import SelectProxyGroup
+
+    def generate(filters: dict[str, list[str]], filter_remote_url: str | None) -> list[str]:
+        groups = [
+            SelectProxyGroup(name=name, filters=filters_in_g, proxies=["DIRECT"])
+            for name, filters_in_g in filters.items()
+        ]
+        gen = QuantumultGenerator(
+            src_file="source.yaml",
+            proxies=[],
+            per_region_proxies=[],
+            proxy_groups=groups,
+            rewrites=[],
+            filter_remote_url=filter_remote_url,
+            filter_remote_min_size=3,
+        )
+        gen.generate(str(tmp_path / "quantumult-x.conf"))
+        conf = (tmp_path / "quantumult-x.conf").read_text()
+        # Filters in the order Quantumult-X matches them: filter_local, then filter_remote.
+        local = conf.split("[filter_local]\n")[1].split("[")[0].splitlines()
+        if filter_remote_url is None:
+            return local
+        remote = conf.split("[filter_remote]\n")[1].split("[")[0].splitlines()
+        remote_filters = [
+            line
+            for entry in remote
+            for line in (tmp_path / "quantumult-x" / entry.split("/")[-1].split(",")[0])
+            .read_text()
+            .splitlines()
+        ]
+        # Final matches last wherever it is.
+        return (
+            [line for line in local if not line.startswith("final,")]
+            + remote_filters
+            + [line for line in local if line.startswith("final,")]
+        )
+
+    filters = {
+        "Mainland": ["DOMAIN-SUFFIX,0.example.com", "DOMAIN,example.org"],
+        "Ad Block": [f"DOMAIN-SUFFIX,{i}.example.com" for i in range(1, 4)],
+        "Streaming": ["DOMAIN,example.net"],
+        "Final": ["final"],
+    }
+    ordered = generate(filters, None)
+    assert generate(filters, "https://example.test/qx/") == ordered
+    conf = (tmp_path / "quantumult-x.conf").read_text()
+    local = conf.split("[filter_local]\n")[1].split("[")[0]
+    remote = conf.split("[filter_remote]\n")[1].split("[")[0]
+    # The large group and every group after it are moved, the ones before it stay local.
+    assert local.splitlines() == [
+        "host-suffix,0.example.com,Mainland",
+        "host,example.org,Mainland",
+        "final,Final",
+    ]
+    assert remote == "".join(
+        f"https://example.test/qx/{name}.list, tag={tag}, force-policy={tag}, "
+        "update-interval=86400, opt-parser=false, enabled=true\n"
+        for name, tag in [("Ad_Block", "Ad Block"), ("Streaming", "Streaming")]
+    )
+    assert (tmp_path / "quantumult-x" / "Ad_Block.list").read_text().splitlines() == [
+        f"host-suffix,{i}.example.com,Ad Block" for i in range(1, 4)
+    ]
+
+    # Filters resolving hostnames stay local and would be overtaken, so nothing is moved.
+    filters["Mainland"].append("GEOIP,CN,resolve")
+    ordered = generate(filters, None)
+    assert "geoip,CN,Mainland" in ordered
+    assert generate(filters, "https://example.test/qx/") == ordered
+    conf = (tmp_path / "quantumult-x.conf").read_text()
+    assert conf.split("[filter_remote]\n")[1].split("[")[0] == ""
+
+
+def test_srs_rule_sets_are_encoded_like_sing_box() -> None:
+    import shutil
+    import zlib
+
+    from conf_gen.generator.sing_box_generator import RuleSetCompiler
+
+    if shutil.which("sing-box") is None:
+        pytest.skip("sing-box is not installed")
+    ruleset_literals = {
+        "domains": {
+            "domain": ["example.com", "a.example.org", ".example.net", "例子.example.com"],
+            "domain_suffix": ["example.org", ".example.net", "Example.COM"],
+            "domain_keyword": "example",
+            "domain_regex": [r"^ad\d+\."],
+        },
+        "ips": [
+            {"ip_cidr": ["10.0.0.128/25", "10.0.0.0/25", "2001:db8::/32", "1.1.1.1"]},
+            {"source_ip_cidr": "192.168.0.0/16", "source_port": [53], "invert": True},
+        ],
+        "misc": {
+            "query_type": ["A", "HTTPS", 28],
+            "network": "udp",
+            "port": [443, 8443],
+            "port_range": ["1000:2000"],
+            "source_port_range": ":1024",
+            "process_name": ["curl"],
+            "process_path": "/usr/bin/curl",
+            "process_path_regex": ["^/usr/"],
+            "package_name": "com.example",
+            "wifi_ssid": "home",
+            "wifi_bssid": "00:11:22:33:44:55",
+        },
+        "logical": {
+            "type": "logical",
+            "mode": "and",
+            "invert": True,
+            "rules": [{"domain_suffix": "example.com"}, {"port": 443, "network": "tcp"}],
+        },
+    }
+
+    with RuleSetCompiler() as native, RuleSetCompiler(native=False) as oracle:
+        for version in range(1, 5):
+            native._ruleset_version = oracle._ruleset_version = version
+            expected = oracle.compile(ruleset_literals)
+            for tag, binary in native.compile(ruleset_literals).items():
+                srs, expected_srs = binary.getvalue(), expected[tag].getvalue()
+                assert srs[:4] == expected_srs[:4], (version, tag)
+                assert zlib.decompress(srs[4:]) == zlib.decompress(expected_srs[4:]), (
+                    version,
+                    tag,
+                )
+    with pytest.raises(RuntimeError, match="geo: Rule sets do not support"):
+        native.compile({"geo": {"geoip": ["cn"]}})
+
+
+def test_srs_rule_sets_match_golden_bytes() -> None:
+    import zlib
+
+    from conf_gen.generator.sing_box_generator import encode_srs
+
+    rules = [
+        {
+            "domain": ["example.com", "a.example.org"],
+            "domain_suffix": [".example.net", "example.org"],
+            "domain_keyword": "ads",
+            "domain_regex": [r"^ad\d+\."],
+        },
+        {
+            "ip_cidr": ["10.0.0.0/25", "10.0.0.128/25", "2001:db8::/32"],
+            "port": [443],
+            "query_type": ["A", 28],
+            "invert": True,
+        },
+        {"type": "logical", "mode": "or", "rules": [{"network": "udp"}, {"process_name": "curl"}]},
+    ]
+    # Headers and uncompressed bodies written by `sing-box rule-set compile` 1.14.3.
+    golden = {
+        1: (
+            b"SRS\x01",
+            "0300020001000000718000000002aaaaaaaaaaaaaaa80000000000001e9626676d74726f"
+            "656f636e2e2e2e6565656c6c6c7070706d6d6d6161617878786565652e2e0d610d030103"
+            "6164730401085e61645c642b5c2eff000000020001001c06010000000000000002040a00"
+            "0000040a0000ff1020010db80000000000000000000000001020010db8ffffffffffffff"
+            "ffffffffff090101bbff0101010200010103756470ff00000b01046375726cff0000",
+        ),
+        4: (
+            b"SRS\x02",
+            "0300020001000000650000000002aaaaaaaaaaaaaaa80000000000001d6c26676d74726f"
+            "656f636e2e2e2e6565656c6c6c7070706d6d6d6161617878786565650a2e2e610d030103"
+            "6164730401085e61645c642b5c2eff000000020001001c06010000000000000002040a00"
+            "0000040a0000ff1020010db80000000000000000000000001020010db8ffffffffffffff"
+            "ffffffffff090101bbff0101010200010103756470ff00000b01046375726cff0000",
+        ),
+    }
+
+    for version, (header, body) in golden.items():
+        srs = encode_srs(rules, version)
+        assert srs[:4] == header and zlib.decompress(srs[4:]).hex() == body, version
+    with pytest.raises(ValueError, match="Unsupported rule set version 5"):
+        encode_srs(rules, 5)
+
+
+def test_native_rule_sets_are_encoded_offline(monkeypatch: pytest.MonkeyPatch) -> None:
+    from conf_gen.generator import sing_box_generator
+    from conf_gen.generator.sing_box_generator import RuleSetCompiler
+
+    def offline(url: str) -> str:
+        raise AssertionError(f"Unexpected lookup of {url}")
+
+    monkeypatch.setenv("PATH", "")
+    monkeypatch.setattr(sing_box_generator, "resolve_redirect", offline)
+    with RuleSetCompiler(ruleset_version=1) as compiler:
+        binaries = compiler.compile({"domains": {"domain_suffix": ["example.com"]}})
+    assert binaries["domains"].getvalue()[:4] == b"SRS\x01"
+
+
+def test_rule_sets_are_compiled_on_workers_in_tag_order() -> None:
+    from conf_gen.generator.sing_box_generator import _PARALLEL_MIN_SIZE
+    from conf_gen.generator.sing_box_generator import RuleSetCompiler
+
+    ruleset_literals: dict[str, Any] = {
+        f"route.{i}": {"domain_suffix": [f"{j}.example{i}.com" for j in range(_PARALLEL_MIN_SIZE)]}
+        for i in range(3)
+    }
+    ruleset_literals["dns.0"] = {"ip_cidr": ["10.0.0.0/8"]}
+
+    serial, parallel = RuleSetCompiler(max_workers=1), RuleSetCompiler(max_workers=2)
+    serial._ruleset_version = parallel._ruleset_version = 4
+    expected = serial.compile(ruleset_literals)
+    binaries = parallel.compile(ruleset_literals)
+    assert list(binaries) == list(ruleset_literals)
+    assert {t: b.getvalue() for t, b in binaries.items()} == {
+        t: b.getvalue() for t, b in expected.items()
+    }
+    with pytest.raises(RuntimeError, match=r"2 of 3 rule sets:\n  a: .*\n  c: .*geosite"):
+        parallel.compile(
+            {"a": {"geoip": "cn"}, "b": ruleset_literals["route.0"], "c": {"geosite": "cn"}}
+        )
@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import pickle
+
+import pytest
+
+
+def test_identical_irs_are_equal() -> None:
+    from conf_gen.rule.ir import Domain
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.ir import IPCIDR
+
+    assert Domain("example.com") == Domain("example.com")
+    with pytest.warns(UserWarning, match="port numbers"):
+        assert Domain("example.com:443") == Domain("example.com")
+    assert IPCIDR("1.0.0.0/24", resolve=False) != IPCIDR("1.0.0.0/24", resolve=True)
+    assert Domain("example.com") != DomainSuffix("example.com")
+    assert len({Domain("example.com"), Domain("example.com"), DomainSuffix("example.com")}) == 2
+
+
+def test_irs_are_immutable_slotted_values() -> None:
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.ir import Match
+
+    ir = DomainSuffix("example.com")
+    assert not hasattr(ir, "__dict__")
+    with pytest.raises(AttributeError, match="immutable"):
+        ir._val = "example.org"
+    assert pickle.loads(pickle.dumps(ir)) == ir
+    assert pickle.loads(pickle.dumps(Match(resolve=True))).clash_rule == "MATCH"
+
+
+def test_irs_take_no_more_memory_than_their_slots() -> None:
+    import tracemalloc
+
+    from conf_gen.rule.ir import DomainSuffix
+
+    vals = [f"{i}.example.com" for i in range(50_000)]
+    tracemalloc.start()
+    try:
+        irs = [DomainSuffix(val) for val in vals]
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # A slotted IR and its list entry, but no table entries kept alongside it.
+    assert size < 128 * len(irs)
+
+
+def test_rule_tokens() -> None:
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import Match
+    from conf_gen.rule.ir import UserAgent
+
+    ir = IPCIDR("1.0.0.0/24", resolve=False)
+    token = ir.clash_token
+    assert token is not None and ir.clash_token == token
+    assert token.line("DIRECT") == "IP-CIDR,1.0.0.0/24,DIRECT,no-resolve"
+    assert token.matcher("DIRECT") == "IP-CIDR,1.0.0.0/24"
+    assert ir.quantumult_token is not None
+    assert ir.quantumult_token.line("DIRECT") == "ip-cidr,1.0.0.0/24,DIRECT,no-resolve"
+    assert ir.sing_box_token == ("ip_cidr", "1.0.0.0/24")
+
+    match = Match(resolve=True).clash_token
+    assert match is not None and match.line("PROXY") == "MATCH,PROXY"
+    assert match.matcher("PROXY") == "MATCH,PROXY"
+    assert UserAgent("curl*").clash_token is None
+
+
+def test_shadowed_domain_filters_are_pruned() -> None:
+    from conf_gen.rule import prune_shadowed_domain_filters
+    from conf_gen.rule.ir import Domain
+    from conf_gen.rule.ir import DomainListItem
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.ir import DstPort
+
+    first = [
+        Domain("www.example.org"),
+        DomainSuffix("example.com"),
+        DomainSuffix("cdn.example.com"),
+    ]
+    conditional = [DstPort("443"), DomainSuffix("example.net"), Domain("a.example.net")]
+    last = [
+        Domain("a.b.example.com"),
+        DomainListItem("+.Example.COM"),
+        Domain("www.example.org"),
+        DomainSuffix("www.example.org"),
+        DomainSuffix("example.net"),
+        DomainListItem("*.example.com"),
+    ]
+
+    assert list(prune_shadowed_domain_filters([first, conditional, last])) == [
+        first[:2],
+        conditional[:2],
+        [DomainSuffix("www.example.org"), DomainSuffix("example.net"), last[-1]],
+    ]
+
+
+def test_ip_cidr_filters_are_aggregated() -> None:
+    from conf_gen.rule import aggregate_ip_cidr_filters
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import IPCIDR6
+    from conf_gen.rule.ir import DomainSuffix
+
+    first = [
+        IPCIDR("10.0.1.0/24", resolve=False),
+        DomainSuffix("example.com"),
+        IPCIDR("10.0.0.0/24", resolve=False),
+        IPCIDR("10.0.0.128/25", resolve=False),
+        IPCIDR6("2001:db8::/33", resolve=False),
+        IPCIDR6("2001:db8:8000::/33", resolve=False),
+    ]
+    second = [
+        IPCIDR("10.0.0.0/25", resolve=False),
+        IPCIDR("10.0.0.0/25", resolve=True),
+        IPCIDR("10.0.2.0/24", resolve=False),
+        IPCIDR("10.0.3.0/24", resolve=False),
+        IPCIDR("10.0.4.0/24", resolve=False),
+    ]
+
+    assert list(aggregate_ip_cidr_filters([first, second])) == [
+        [
+            IPCIDR("10.0.0.0/23", resolve=False),
+            DomainSuffix("example.com"),
+            IPCIDR6("2001:db8::/32", resolve=False),
+        ],
+        [
+            IPCIDR("10.0.0.0/25", resolve=True),
+            IPCIDR("10.0.2.0/23", resolve=False),
+            IPCIDR("10.0.4.0/24", resolve=False),
+        ],
+    ]
+
+
+def test_columnar_filters_round_trip() -> None:
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.ir import Match
+    from conf_gen.rule.ir import UserAgent
+    from conf_gen.rule.store import ColumnarFilters
+
+    irs = [
+        DomainSuffix("例子.example.com"),
+        IPCIDR("1.0.0.0/24", resolve=False),
+        IPCIDR("1.0.0.0/24", resolve=True),
+        UserAgent("curl*"),
+        DomainSuffix("例子.example.com"),
+        Match(resolve=True),
+    ]
+    filters = ColumnarFilters(irs)
+
+    assert len(filters) == len(irs)
+    assert filters == irs and list(filters) == irs
+    assert filters[1] == irs[1] and filters[-1] == irs[-1]
+    assert filters[2:4] == irs[2:4]
+    assert filters._offsets[0] == filters._offsets[4]
+    filters.extend(irs[:1])
+    assert filters[-1] == irs[0]
+
+
+def test_columnar_filters_are_pruned_and_aggregated_by_rows() -> None:
+    import tracemalloc
+
+    from conf_gen.rule import aggregate_ip_cidr_filters
+    from conf_gen.rule import prune_shadowed_domain_filters
+    from conf_gen.rule.ir import IPCIDR
+    from conf_gen.rule.ir import DomainSuffix
+    from conf_gen.rule.store import ColumnarFilters
+
+    irs = [DomainSuffix("example0.com")]
+    irs += [DomainSuffix(f"{i}.example{i % 7}.com") for i in range(50_000)]
+    irs += [IPCIDR(f"10.0.{i}.0/24", resolve=False) for i in range(256)]
+    filters = ColumnarFilters(irs)
+    del irs
+
+    # Neither pass creates an IR per row, which would take several times the rows' memory.
+    tracemalloc.start()
+    try:
+        (pruned,) = prune_shadowed_domain_filters([filters])
+        (aggregated,) = aggregate_ip_cidr_filters([pruned])
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 400 * len(filters)
+
+    assert isinstance(pruned, ColumnarFilters) and isinstance(aggregated, ColumnarFilters)
+    expected = [ir for ir in filters if not ir._val.endswith(".example0.com")]
+    assert pruned == expected
+    assert aggregated == expected[:-256] + [IPCIDR("10.0.0.0/16", resolve=False)]
+
+
+def test_ip_interval_index() -> None:
+    from conf_gen.rule import IPIntervalIndex
+
+    index = IPIntervalIndex()
+    index.add([(10, 19), (30, 39)], owner=0)
+    index.add([(15, 34), (50, 59)], owner=1)
+
+    assert index.covers(10, 39) and index.covers(52, 55)
+    assert not index.covers(5, 12) and not index.covers(38, 50)
+    assert index.owners(18, 21) == [0, 1]
+    assert index.owners(35, 52) == [0, 1]
+    assert index.owners(40, 49) == []
+
+    # Many ranges at once are spliced in, filling the gaps between those added before.
+    index = IPIntervalIndex()
+    index.add([(i, i + 4) for i in range(0, 1000, 10)], owner=0)
+    index.add([(i, i + 9) for i in range(0, 1000, 10)], owner=1)
+    assert index.covers(0, 999) and not index.covers(0, 1000)
+    assert index.owners(3, 7) == [0, 1]
+    assert index._starts == list(range(0, 1000, 5))
+
+
+def test_partially_overlapping_ip_rules_are_reported() -> None:
+    from conf_gen.rule import aggregate_ip_cidr_filters
+    from conf_gen.rule import prune_shadowed_sing_box_dst_ip_filters
+    from conf_gen.rule.ir import IPCIDR
+
+    first = [IPCIDR("10.0.0.0/24", resolve=False)]
+    second = [IPCIDR("10.0.0.0/16", resolve=False), IPCIDR("10.0.0.0/25", resolve=False)]
+    with pytest.warns(UserWarning, match=r"1 IP rules of Second partially overlap First"):
+        assert list(aggregate_ip_cidr_filters([first, second], names=["First", "Second"])) == [
+            first,
+            second[:1],
+        ]
+
+    dst_ip_filters = [
+        {"ip_cidr": ["10.0.0.0/24"], "action": "route", "outbound": "A"},
+        {"ip_cidr": ["10.0.0.0/25", "10.0.1.0/24"], "action": "route", "outbound": "B"},
+        {"ip_cidr": ["10.0.0.128/25"], "action": "route", "outbound": "C"},
+    ]
+    assert prune_shadowed_sing_box_dst_ip_filters(dst_ip_filters) == 2
+    assert [r["ip_cidr"] for r in dst_ip_filters] == [["10.0.0.0/24"], ["10.0.1.0/24"]]
+
+
+def test_ir_capabilities_are_computed_on_registration() -> None:
+    from conf_gen.rule._base_ir import IRCapability
+    from conf_gen.rule.ir import IPCIDR6
+    from conf_gen.rule.ir import DomainListItem
+    from conf_gen.rule.ir import GeoIP
+    from conf_gen.rule.ir import Match
+    from conf_gen.rule.ir import ProcessName
+    from conf_gen.rule.ir import UserAgent
+
+    assert UserAgent._capabilities == IRCapability.QUANTUMULT
+    assert DomainListItem._capabilities == (
+        IRCapability.CLASH
+        | IRCapability.QUANTUMULT
+        | IRCapability.SING_BOX
+        | IRCapability.RULE_SET_COMPLIANT
+    )
+    assert IRCapability.DST_IP in IPCIDR6._capabilities
+    assert IRCapability.RULE_SET_COMPLIANT not in GeoIP._capabilities
+    assert IRCapability.PROCESS in ProcessName._capabilities
+    assert IRCapability.SING_BOX not in Match._capabilities
+    assert Match(resolve=True).sing_box_token is None
+
+
+def test_ir_registry_only_memoizes_registered_spellings() -> None:
+    from conf_gen.rule._base_ir import _IR_REGISTRY
+    from conf_gen.rule.ir import IPCIDR
+
+    assert _IR_REGISTRY.lookup("Ip-Cidr") is IPCIDR
+    size = len(_IR_REGISTRY._flat)
+    for i in range(1000):
+        assert f"UNKNOWN-{i}" not in _IR_REGISTRY
+    assert _IR_REGISTRY.lookup("Ip-Cidr") is IPCIDR
+    assert len(_IR_REGISTRY._flat) == size
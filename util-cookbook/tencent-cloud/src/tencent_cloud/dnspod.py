@@ -8,9 +8,8 @@ from datetime import datetime
 from datetime import timezone
 from typing import Any
 
-import requests
-
 from common import secrets
+from common.http import get_session
 
 QCLOUD_API_HOSTNAME = "dnspod.tencentcloudapi.com"
 QCLOUD_PUBLIC_API: dict[str, str | None] = {
@@ -146,9 +145,11 @@ def _signed_request(action: str, payload: dict[str, Any]) -> dict[str, Any]:
     headers: dict[str, str] = normalize_dict(raw_headers)
     headers["Authorization"] = get_qcloud_auth(headers, payload)
 
-    response = requests.post(
-        f"https://{QCLOUD_API_HOSTNAME}", json=payload, headers=headers
-    ).json()["Response"]
+    response = (
+        get_session("dnspod")
+        .post(f"https://{QCLOUD_API_HOSTNAME}", json=payload, headers=headers)
+        .json()["Response"]
+    )
 
     if response.get("Error"):
         err_code = response["Error"]["Code"]
@@ -10,6 +10,8 @@ from typing import cast
 import requests
 import urllib3.util.connection as urllib3_cn
 
+from common.http import get_session
+
 IPType = Literal["A", "AAAA"]
 
 
@@ -33,7 +35,9 @@ class PublicIPGetter:
         urllib3_cn.allowed_gai_family = lambda: (
             socket.AF_INET6 if type == "AAAA" else socket.AF_INET
         )
-        r = requests.get(self.request_url)
+        # Pooled connections keep the family they were opened with, so never share them across
+        # address families.
+        r = get_session(f"public-ip-{type}").get(self.request_url)
         if r.status_code != 200:
             raise RuntimeError(r.reason)
         ip_str = self.parse_ipv6_response(r) if type == "AAAA" else self.parse_ipv4_response(r)